@@ -13,7 +13,15 @@ to be productive, efficient, or complete.
 If you have any questions regarding the implementation of
 the EIGER stream interface, please contact support@dectris.com.
 
-usage: DEigerStream.py [-h] -i IP [-p PORT] [-v] [-f FILENAME]
+usage: DEigerStream.py [-h] -i IP [-p PORT] [-v] [-f FILENAME] [-w WORKERS]
+                       [-q QUEUESIZE] [-n NPROCESSES] [--passthrough]
+                       [-m METRICSPORT] [--metricsHost METRICSHOST]
+                       [--statistics] [--correct]
+                       [--integrate NBINS]
+                       [--hitFinder THRESHOLD MINPIXELS]
+                       [--hitDecimate HITDECIMATE]
+                       [--roi NAME XSTART YSTART XEND YEND]
+                       [--sumFrames SUMFRAMES] [--binning BINNING] [--roiSums]
 
 Listen to stream interface and save data
 
@@ -24,8 +32,45 @@ optional arguments:
   -v, --verbose         print some more messages
   -f FILENAME, --filename FILENAME
                         /path/to/file.ext with extension
-                        [.bytes|.raw|.tiff|.tiff16|.cbf|.h5|.log|none] stream
+                        [.bytes|.raw|.seg|.sparse|.tiff|.tiff16|.cbf|.h5|.log|none] stream
                         data to ALBULA viewer window if filename is "albula"
+  -w WORKERS, --workers WORKERS
+                        number of decode/write worker threads
+  -q QUEUESIZE, --queueSize QUEUESIZE
+                        maximum number of messages in the ingest queue
+  -n NPROCESSES, --nProcesses NPROCESSES
+                        number of image decode processes, 0 decodes in
+                        worker threads
+  --passthrough         write bitshuffle-lz4 images to .h5 without
+                        decompression
+  -m METRICSPORT, --metricsPort METRICSPORT
+                        serve live metrics in Prometheus format on
+                        http://METRICSHOST:METRICSPORT/metrics
+  --metricsHost METRICSHOST
+                        interface of the metrics endpoint, 0.0.0.0 for all
+                        interfaces
+  --statistics          save per frame sum, max, saturated, overflow and
+                        masked pixel counts to basename_SERIES_statistics.npz
+  --correct             apply pixel mask and flatfield of the header
+                        (header_detail all) to the images
+  --integrate NBINS     save radial profiles of NBINS q bins per frame to
+                        basename_SERIES_integration.npz
+  --hitFinder THRESHOLD MINPIXELS
+                        write only images with at least MINPIXELS pixels
+                        above THRESHOLD counts, save the scores to
+                        basename_SERIES_hits.npz
+  --hitDecimate HITDECIMATE
+                        compute the hit score on every HITDECIMATE-th row
+                        and column
+  --roi NAME XSTART YSTART XEND YEND
+                        software ROI with inclusive pixel bounds, repeat for
+                        several ROIs, each ROI is written to
+                        basename_NAME.ext
+  --sumFrames SUMFRAMES
+                        sum every SUMFRAMES consecutive frames before writing
+  --binning BINNING     sum BINNING x BINNING pixels before writing
+  --roiSums             save only the ROI sums per frame to
+                        basename_SERIES_roi.npz, no images
 
 """
 
@@ -39,8 +84,12 @@ import argparse
 import os
 import sys
 import datetime
+import time
 #import pid
 import tempfile
+from streamPipeline import StreamPipeline, ProcessPipeline
+from fileWriter.writerPool import getWriterPool
+from fileWriter import metrics
 
 class ZMQStream():
     def __init__(self, host, port=9999, verbose=False):
@@ -51,6 +100,9 @@ class ZMQStream():
         self._port = port # tcp stream port
         self._verbose = verbose # verbosity
 
+        self._messages = metrics.registry.counter("eiger_stream_received_messages_total", "received ZMQ messages")
+        self._bytes = metrics.registry.counter("eiger_stream_received_bytes_total", "received ZMQ bytes")
+
         self.connect() # start stream
 
     def connect(self):
@@ -68,12 +120,15 @@ class ZMQStream():
         print "[OK] initialized stream receiver for host tcp://{0}:{1}".format(self._host,self._port)
         return self._receiver
 
-    def receive(self):
+    def receive(self, timeout=100):
         """
         receive and return zmq frames if available
+        timeout: poll timeout in ms
         """
-        if self._receiver.poll(100): # check if message available
+        if self._receiver.poll(timeout): # check if message available
             frames = self._receiver.recv_multipart(copy = False)
+            self._messages.inc()
+            self._bytes.inc(sum(len(frame) for frame in frames))
             if self._verbose:
                 t = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
                 print "[%s] received zmq frames with length %d" %(t,len(frames))
@@ -97,16 +152,34 @@ def parseArgs():
     parser.add_argument("-p", "--port", help="EIGER host port", type=int, default=9999)
     parser.add_argument("-v", "--verbose", help="print some more messages", action="store_true", default = False)
     parser.add_argument("-f", "--filename", help="""/path/to/file.ext with extension
-                                                    [.bytes|.raw|.tiff|.tiff16|.cbf|.h5|.log|none]
+                                                    [.bytes|.raw|.seg|.sparse|.tiff|.tiff16|.cbf|.h5|.log|none]
                                                     stream data to ALBULA viewer window if filename is \"albula\"
                                                     stream data to pyqt if filename is \"pyqt\" """, default = None)
-    #parser.add_argument("-roi", "--roi", type=int, nargs=4, help="roi mode", default=False)
+    parser.add_argument("-w", "--workers", help="number of decode/write worker threads", type=int, default=1)
+    parser.add_argument("-q", "--queueSize", help="maximum number of messages in the ingest queue", type=int, default=1000)
+    parser.add_argument("-n", "--nProcesses", help="number of image decode processes, 0 decodes in worker threads", type=int, default=0)
+    parser.add_argument("--passthrough", help="write bitshuffle-lz4 images to .h5 without decompression", action="store_true", default=False)
+    parser.add_argument("-m", "--metricsPort", help="serve live metrics in Prometheus format on http://METRICSHOST:METRICSPORT/metrics", type=int, default=0)
+    parser.add_argument("--metricsHost", help="interface of the metrics endpoint, 0.0.0.0 for all interfaces", type=str, default="127.0.0.1")
+    parser.add_argument("--statistics", help="save per frame sum, max, saturated, overflow and masked pixel counts to basename_SERIES_statistics.npz", action="store_true", default=False)
+    parser.add_argument("--correct", help="apply pixel mask and flatfield of the header (header_detail all) to the images", action="store_true", default=False)
+    parser.add_argument("--integrate", help="save radial profiles of NBINS q bins per frame to basename_SERIES_integration.npz", type=int, default=0, metavar="NBINS")
+    parser.add_argument("--hitFinder", help="write only images with at least MINPIXELS pixels above THRESHOLD counts, save the scores to basename_SERIES_hits.npz",
+                        type=int, nargs=2, metavar=("THRESHOLD", "MINPIXELS"), default=None)
+    parser.add_argument("--hitDecimate", help="compute the hit score on every HITDECIMATE-th row and column", type=int, default=1)
+    parser.add_argument("--roi", help="software ROI with inclusive pixel bounds, repeat for several ROIs, each ROI is written to basename_NAME.ext",
+                        nargs=5, action="append", metavar=("NAME", "XSTART", "YSTART", "XEND", "YEND"), default=[])
+    parser.add_argument("--sumFrames", help="sum every SUMFRAMES consecutive frames before writing", type=int, default=1)
+    parser.add_argument("--binning", help="sum BINNING x BINNING pixels before writing", type=int, default=1)
+    parser.add_argument("--roiSums", help="save only the ROI sums per frame to basename_SERIES_roi.npz, no images", action="store_true", default=False)
 
     args = parser.parse_args()
+    if args.roiSums and not args.roi:
+        parser.error("--roiSums requires at least one --roi")
 
     return args
 
-def getFileWriter(filename, verbosity):
+def getFileWriter(filename, verbosity, passthrough=False):
     """
     return file writer class corresponding to the file extension
     """
@@ -143,6 +216,12 @@ def getFileWriter(filename, verbosity):
     elif ftype == ".bytes":
         from fileWriter import stream2bytes
         fw = stream2bytes.Stream2Bytes(basename, output, verbosity)
+    elif ftype == ".seg":
+        from fileWriter import stream2seg
+        fw = stream2seg.Stream2Seg(basename, output, verbosity)
+    elif ftype == ".sparse":
+        from fileWriter import stream2sparse
+        fw = stream2sparse.Stream2Sparse(basename, output, verbosity)
     elif "tif" in ftype:
         if "16" in ftype:
             dtype = "int16"
@@ -155,7 +234,7 @@ def getFileWriter(filename, verbosity):
         fw = stream2cbf.Stream2Cbf(basename, output, verbosity)
     elif ftype == ".h5" or ftype == ".hdf":
         from fileWriter import stream2hdf
-        fw = stream2hdf.Stream2Hdf(basename, output, verbosity)
+        fw = stream2hdf.Stream2Hdf(basename, output, verbosity, passthrough)
 
     elif ftype == ".log":
         from fileWriter import stream2log
@@ -165,6 +244,62 @@ def getFileWriter(filename, verbosity):
         raise RuntimeError("Unkwon file type %s in %s" %(ftype,filename))
     return fw
 
+def addStages(fw, args):
+    """
+    add the processing stages selected by the arguments to the file writer
+    return: file writer, a FileWriterGroup with one writer per ROI if several ROIs are written
+    """
+    stages = []
+    if args.correct:
+        from fileWriter.correction import Correction
+        stages.append(Correction(verbose=args.verbose))
+    if args.statistics:
+        from fileWriter.frameStatistics import FrameStatistics
+        stages.append(FrameStatistics(fw.basename, fw.path, args.verbose))
+    if args.integrate:
+        from fileWriter.integration import RadialIntegration
+        stages.append(RadialIntegration(fw.basename, fw.path, args.integrate, args.verbose))
+    if args.hitFinder:
+        from fileWriter.hitFinder import HitFinder
+        threshold, minPixels = args.hitFinder
+        stages.append(HitFinder(fw.basename, fw.path, threshold, minPixels, args.hitDecimate, args.verbose))
+    reduction = None
+    if args.sumFrames > 1 or args.binning > 1:
+        from fileWriter.reduction import Reduction
+        reduction = lambda: Reduction(args.sumFrames, args.binning, args.verbose)
+    writers = []
+    if args.roi:
+        from fileWriter.fileWriter import ROI
+        rois = dict((roi[0], [int(i) for i in roi[1:]]) for roi in args.roi)
+        names = sorted(rois)
+        base, ftype = os.path.splitext(args.filename or "")
+        if len(names) > 1 and not args.roiSums and not ftype:
+            print "[WARNING] several ROIs need a filename with extension, writing ROI %s only" %names[0]
+            names = names[:1]
+        crop = names[0] if not ftype and not args.roiSums else None # no files written, crop in place
+        stages.append(ROI(rois, crop, args.roiSums, fw.basename, fw.path, args.verbose))
+        if ftype and not args.roiSums: # every ROI to basename_NAME.ext
+            for name in names:
+                writer = getFileWriter("%s_%s%s" %(base, name, ftype), args.verbose)
+                writer.addStage(ROI({name: rois[name]}, name, verbose=args.verbose))
+                if reduction:
+                    writer.addStage(reduction())
+                writers.append(writer)
+        if args.roiSums: # all images are dropped, do not create empty files
+            from fileWriter.fileWriter import FileWriter
+            fw = FileWriter(fw.basename, fw.path, "dummy", args.verbose)
+    if reduction and not writers:
+        stages.append(reduction())
+    if stages and not hasattr(fw, "addStage"):
+        print "[WARNING] %s does not support processing stages" %fw.__class__.__name__
+        return fw
+    if writers:
+        from fileWriter.fileWriter import FileWriterGroup
+        fw = FileWriterGroup(writers, args.verbose)
+    for stage in stages:
+        fw.addStage(stage)
+    return fw
+
 def versionControl(required=(2,7)):
     """
     check python version
@@ -179,18 +314,35 @@ if __name__ == "__main__":
     os.system("clear")
     versionControl((2,7)) # check if Python versions is >= 2.7.0
     args = parseArgs() # get cmd line args
-    fw = getFileWriter(args.filename, args.verbose) # create filewriter according to file type
+    if args.passthrough and (args.correct or args.statistics or args.integrate or args.hitFinder or args.roi or args.sumFrames > 1 or args.binning > 1):
+        print "[WARNING] passthrough writes unprocessed images, disabled for processing stages"
+        args.passthrough = False
+    if args.passthrough and args.nProcesses > 0:
+        print "[WARNING] passthrough writes the received blobs without decoding, using worker threads instead of decode processes"
+        args.nProcesses = 0
+    fw = getFileWriter(args.filename, args.verbose, args.passthrough) # create filewriter according to file type
+    fw = addStages(fw, args)
     stream = ZMQStream(args.ip, args.port, args.verbose)
+    if args.metricsPort:
+        metrics.serve(args.metricsPort, args.metricsHost)
     if not args.filename: stream._verbose = True
+    if args.nProcesses > 0:
+        pipeline = ProcessPipeline(stream, fw, args.nProcesses, args.queueSize, args.verbose)
+    else:
+        pipeline = StreamPipeline(stream, fw, args.workers, args.queueSize, args.verbose)
     try:
+        pipeline.start()
         print "[OK] stream listener ready"
         # listen to stream
         while True:
-            frames = stream.receive()
-            if frames:
-                fw.decodeFrames(frames)
+            time.sleep(1)
 
     except KeyboardInterrupt:
+        pipeline.stop()
+        print pipeline.report()
+        getWriterPool().join()
+        print getWriterPool().report()
+        fw.close()
         stream.close()
     #except pid.PidFileAlreadyLockedError as e:
     #        print "[ERROR] another instance of eigerStream.py is already running.", e
@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+"""
+convert.py converts recorded EIGER stream data offline. The messages of a
+segment log (.seg) or of a directory of .bytes or .raw dumps are grouped by
+series and converted with the file writer of the output file extension by a
+pool of processes.
+
+Series are converted by one job each. Writers storing every image in its own
+file (.tif, .tiff16, .cbf) get jobs of CHUNKSIZE images, so a single long
+series is converted in parallel as well. Finished jobs are recorded in the
+journal file .convert_journal in the output directory. Converting again after
+a crash or interrupt skips the finished jobs, unless --restart is given.
+The journal starts with the source, output file and chunk size of the
+conversion, converting with other arguments into the same directory is
+refused unless --restart is given.
+
+usage: convert.py [-h] -f FILENAME [-n NPROCESSES] [-c CHUNKSIZE] [--restart]
+                  [-v]
+                  source
+
+Convert recorded stream data
+
+positional arguments:
+  source                segment log /path/to/basename or directory with
+                        segment logs, .bytes or .raw dumps
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -f FILENAME, --filename FILENAME
+                        /path/to/file.ext with extension
+                        [.tiff|.tiff16|.cbf|.h5|.sparse|.log]
+  -n NPROCESSES, --nProcesses NPROCESSES
+                        number of conversion processes
+  -c CHUNKSIZE, --chunkSize CHUNKSIZE
+                        images per job of the .tif and .cbf writers
+  --restart             ignore the journal and convert all messages
+  -v, --verbose         print some more messages
+"""
+
+__author__ = "SasG"
+__date__ = "17/05/17"
+__version__ = "0.1"
+__reviewer__ = ""
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+from fileWriter.segmentLog import SegmentReader
+
+#images per job of the writers storing each image in its own file
+CHUNKSIZE = 100
+
+#file name of the journal of finished jobs in the output directory
+JOURNAL = ".convert_journal"
+
+#seconds between progress messages
+PROGRESSINTERVAL = 1.
+
+#frames of a dheader message per header_detail
+HEADERFRAMES = {"all": 8, "basic": 2, "none": 1}
+
+#maximum size of a dumped frame which is read to check for a json header
+MAXHEADERSIZE = 1 << 16
+
+class BytesFrame(bytes):
+    """
+    recorded frame which can be passed to the file writers like a zmq.Frame
+    """
+    @property
+    def bytes(self):
+        return self
+
+def parseArgs():
+    """
+    parse user input and return arguments
+    """
+    parser = argparse.ArgumentParser(description = "Convert recorded stream data")
+
+    parser.add_argument("source", help="segment log /path/to/basename or directory with segment logs, .bytes or .raw dumps")
+    parser.add_argument("-f", "--filename", help="/path/to/file.ext with extension [.tiff|.tiff16|.cbf|.h5|.sparse|.log]", required=True)
+    parser.add_argument("-n", "--nProcesses", help="number of conversion processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("-c", "--chunkSize", help="images per job of the .tif and .cbf writers", type=int, default=CHUNKSIZE)
+    parser.add_argument("--restart", help="ignore the journal and convert all messages", action="store_true", default=False)
+    parser.add_argument("-v", "--verbose", help="print some more messages", action="store_true", default=False)
+
+    return parser.parse_args()
+
+def parseHeader(data):
+    """
+    return the header dict if data is the first frame of a stream message, else None
+    """
+    try:
+        header = json.loads(data)
+    except ValueError:
+        return None
+    if isinstance(header, dict) and header.get("htype", "").startswith(("dheader-", "dimage-", "dseries_end")):
+        return header
+    return None
+
+def readFile(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def scan(source):
+    """
+    return list of (htype, series, frame, reference) of the recorded messages in source,
+    the reference is passed to load in the conversion processes
+    """
+    if not os.path.isdir(source):
+        return scanSegmentLog(re.sub(r"_\d{6}\.(seg|idx)$", "", source))
+    messages = []
+    for basename in sorted(set(re.sub(r"_\d{6}\.idx$", "", path) for path in glob.glob(os.path.join(source, "*_[0-9]*.idx")))):
+        messages += scanSegmentLog(basename)
+    messages += scanRaw(source)
+    messages += scanBytes(source)
+    return messages
+
+def scanSegmentLog(basename):
+    """
+    return messages of the segment log basename, see fileWriter/segmentLog.py
+    """
+    log = SegmentReader(basename)
+    messages = []
+    for series, frame, location in log.locations():
+        if frame is None: # header or end of series
+            header = parseHeader(bytes(log.readAt(location)[0]))
+            if header is None:
+                print "[WARNING] message %s of %s is not a stream message" %(location, basename)
+                continue
+            htype = header["htype"]
+        else:
+            htype = "dimage"
+        messages.append((htype, series, frame, ("seg", basename, location)))
+    log.close()
+    return messages
+
+def scanRaw(source):
+    """
+    return messages of the .raw dumps in directory source, see fileWriter/stream2raw.py
+    """
+    parts = {} # message prefix: frame files
+    for path in glob.glob(os.path.join(source, "*_ZMQframe[0-9]*.raw")):
+        parts.setdefault(path.rsplit("_ZMQframe", 1)[0], []).append(path)
+    messages = []
+    for prefix, paths in parts.items():
+        paths.sort()
+        header = parseHeader(readFile(paths[0]))
+        if header is None:
+            print "[WARNING] %s is not a stream message" %paths[0]
+            continue
+        messages.append((header["htype"], header.get("series") or 0, header.get("frame"), ("files", paths)))
+    return messages
+
+def scanBytes(source):
+    """
+    return messages of the .bytes dumps in directory source. The frames are
+    numbered in receive order and grouped into messages by their headers,
+    see fileWriter/stream2bytes.py
+    """
+    dumps = {} # basename: [(index, path)]
+    for path in glob.glob(os.path.join(source, "*.[0-9][0-9][0-9][0-9][0-9][0-9]")):
+        basename, index = path.rsplit(".", 1)
+        dumps.setdefault(basename, []).append((int(index), path))
+
+    messages = []
+    for basename in sorted(dumps):
+        paths = [path for index, path in sorted(dumps[basename])]
+        headers = {} # frame index: header dict or None
+        def header(i):
+            if i not in headers:
+                small = os.path.getsize(paths[i]) <= MAXHEADERSIZE
+                headers[i] = parseHeader(readFile(paths[i])) if small else None
+            return headers[i]
+
+        i = 0
+        while i < len(paths):
+            h = header(i)
+            if h is None:
+                print "[WARNING] skip %s, not the first frame of a stream message" %paths[i]
+                i += 1
+                continue
+            if h["htype"].startswith("dheader-"):
+                n = HEADERFRAMES[h["header_detail"]]
+            elif h["htype"].startswith("dimage-"):
+                n = 4
+            else:
+                n = 1
+            message = paths[i:i+n]
+            i += n
+            if i < len(paths) and header(i) is None: # appendix
+                message.append(paths[i])
+                i += 1
+            messages.append((h["htype"], h.get("series") or 0, h.get("frame"), ("files", message)))
+    return messages
+
+def createJobs(messages, chunkSize):
+    """
+    group messages by series and return list of jobs
+    (key, header reference, image references, end reference, restore)
+    restore: the header is only used to restore the series metadata of the writer
+    """
+    series = {} # series: {"header": reference, "end": reference, "images": {frame: reference}}
+    for htype, number, frame, reference in messages:
+        entry = series.setdefault(number, {"header": None, "end": None, "images": {}})
+        if htype.startswith("dheader"):
+            if entry["header"] is not None:
+                print "[WARNING] several headers of series %d, using the last one" %number
+            entry["header"] = reference
+        elif htype.startswith("dseries_end"):
+            entry["end"] = reference
+        else:
+            entry["images"][frame] = reference
+
+    jobs = []
+    for number in sorted(series):
+        entry = series[number]
+        frames = sorted(entry["images"])
+        if entry["header"] is None:
+            print "[WARNING] no header of series %d" %number
+        size = chunkSize or len(frames) or 1
+        chunks = [frames[i:i+size] for i in range(0, len(frames), size)] or [[]]
+        for i, chunk in enumerate(chunks):
+            key = "series %d frames %s-%s" %(number, chunk[0] if chunk else "", chunk[-1] if chunk else "")
+            jobs.append((key, entry["header"], [entry["images"][frame] for frame in chunk],
+                         entry["end"] if i == len(chunks) - 1 else None, i > 0))
+    return jobs
+
+def journalHeader(args, chunkSize):
+    """
+    return the first line of the journal identifying the conversion
+    """
+    return "# source %s filename %s chunkSize %d" %(os.path.abspath(args.source), os.path.abspath(args.filename), chunkSize)
+
+def readJournal(path, header):
+    """
+    return set of the finished jobs in journal path, None if the journal belongs to another conversion
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        lines = [line.strip() for line in f if line.strip()]
+    if not lines:
+        return set()
+    if lines[0] != header:
+        return None
+    return set(lines[1:])
+
+_fw = None # file writer of the conversion process
+_readers = {} # basename: SegmentReader of the conversion process
+
+def init(filename, verbose):
+    """
+    create the file writer of a conversion process
+    """
+    global _fw
+    from EIGERStream import getFileWriter
+    _fw = getFileWriter(filename, verbose)
+
+def load(reference):
+    """
+    return the frames of a recorded message
+    """
+    if reference[0] == "seg":
+        basename, location = reference[1:]
+        if basename not in _readers:
+            _readers[basename] = SegmentReader(basename)
+        return [BytesFrame(part) for part in _readers[basename].readAt(location)]
+    return [BytesFrame(readFile(path)) for path in reference[1]]
+
+def restoreHeader(fw, message):
+    """
+    set the series metadata of a .tif or .cbf writer without writing the header files again
+    """
+    fw.series = message.series
+    fw.metadata = dict(message.config or {})
+    if message.appendix:
+        fw.metadata["appendix"] = message.appendix
+
+def convert(job):
+    """
+    conversion process: convert the messages of job with the file writer
+    return: (key, number of images, error message or None)
+    """
+    from fileWriter.fileWriter import StreamMessage
+    from fileWriter.writerPool import getWriterPool
+    key, header, images, end, restore = job
+    errors = getWriterPool().statistics()["errors"]
+    try:
+        if header is not None:
+            message = StreamMessage(load(header))
+            if restore and hasattr(_fw, "metadata"):
+                restoreHeader(_fw, message)
+            else:
+                _fw.decodeMessage(message)
+        for reference in images:
+            _fw.decodeMessage(StreamMessage(load(reference)))
+        if end is not None:
+            _fw.decodeMessage(StreamMessage(load(end)))
+        getWriterPool().join()
+    except Exception as e:
+        return key, len(images), str(e)
+    if getWriterPool().statistics()["errors"] > errors:
+        return key, len(images), "write jobs failed"
+    return key, len(images), None
+
+def main(args):
+    output = os.path.dirname(os.path.abspath(args.filename))
+    ftype = os.path.splitext(args.filename)[1]
+    chunkSize = args.chunkSize if ftype.startswith(".tif") or ftype == ".cbf" else 0
+
+    if not os.path.isdir(output):
+        os.makedirs(output)
+
+    messages = scan(args.source)
+    jobs = createJobs(messages, chunkSize)
+    journal = os.path.join(output, JOURNAL)
+    header = journalHeader(args, chunkSize)
+    if args.restart and os.path.exists(journal):
+        os.remove(journal)
+    done = readJournal(journal, header)
+    if done is None:
+        print "[ERR] %s belongs to another conversion, convert with --restart or into another directory" %journal
+        return 1
+    todo = [job for job in jobs if job[0] not in done]
+    nImages = sum(len(job[2]) for job in todo)
+    print "[OK] %d series, %d jobs, %d done, converting %d images with %d processes" \
+          %(len(set(message[1] for message in messages)), len(jobs), len(jobs) - len(todo), nImages, args.nProcesses)
+
+    pool = multiprocessing.Pool(args.nProcesses, initializer=init, initargs=(args.filename, args.verbose))
+    failed = []
+    converted = 0
+    start = last = time.time()
+    try:
+        with open(journal, "a") as f:
+            if not done and not os.path.getsize(journal):
+                f.write(header + "\n")
+            for i, (key, n, error) in enumerate(pool.imap_unordered(convert, todo)):
+                if error:
+                    print "[ERR] %s: %s" %(key, error)
+                    failed.append(key)
+                else:
+                    f.write(key + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                converted += n
+                now = time.time()
+                if now - last > PROGRESSINTERVAL or i == len(todo) - 1:
+                    last = now
+                    rate = converted / max(now - start, 1e-9)
+                    print "[*] %d/%d jobs, %d/%d images, %.1f images/s, %.0f s remaining" \
+                          %(i + 1, len(todo), converted, nImages, rate, (nImages - converted) / max(rate, 1e-9))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        print "[INFO] interrupted, converting again resumes after the finished jobs"
+        raise
+    finally:
+        pool.join()
+
+    if failed:
+        print "[ERR] %d jobs failed, convert again to retry them" %len(failed)
+        return 1
+    print "[OK] converted %d images in %.1f s" %(converted, time.time() - start)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(parseArgs()))
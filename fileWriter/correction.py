@@ -0,0 +1,104 @@
+"""
+Correction stage: apply the pixel mask and the flatfield of the dheader
+message (header_detail all) to every decoded image in place. The tables are
+decoded once per series: the flat indices of the masked pixels and the
+flatfield as float array.
+
+Masked pixels are set to the maximum value of the image bit depth, like the
+detector does with pixel_mask_applied. Integer images are multiplied with
+the flatfield into a float32 buffer allocated once per series and worker
+thread, rounded and copied back, values exceeding the bit depth saturate at
+the maximum value - 1 (the largest float32 below it for 32 bit images),
+overflow pixels keep the maximum value. The flatfield is not applied again
+if the config reports flatfield_correction_applied.
+"""
+
+from stages import Stage
+import numpy as np
+import threading
+
+__author__ = "SasG"
+__date__ = "17/05/17"
+__version__ = "0.0.1"
+__reviewer__ = ""
+
+class Correction(Stage):
+    """
+    apply pixel mask and flatfield of the series to every image
+    mask, flatfield: apply the pixel mask, the flatfield
+    """
+    def __init__(self, mask=True, flatfield=True, verbose=False):
+        self.mask = mask
+        self.flatfield = flatfield
+        self._verbose = verbose
+        self._masked = None # flat indices of the masked pixels of the series, None if no mask
+        self._flatfield = None # flatfield of the series, None if not applied
+        self._bitDepth = None # image bit depth of the config, None if unknown
+        self._buffers = threading.local() # float32 product and valid pixel buffers of the series per thread
+        self._lock = threading.Lock()
+
+    def header(self, message):
+        with self._lock:
+            config = message.config or {}
+            self._bitDepth = config.get("bit_depth_image")
+            self._masked = None
+            self._flatfield = None
+            self._buffers = threading.local()
+            if self.mask:
+                mask = message.table("pixelmask")
+                if mask is not None:
+                    self._masked = np.flatnonzero(mask)
+                elif self._verbose:
+                    print("[INFO] no pixel mask in series %s" %message.series)
+            if self.flatfield:
+                flatfield = message.table("flatfield")
+                if config.get("flatfield_correction_applied"):
+                    if self._verbose:
+                        print("[INFO] flatfield of series %s is applied by the detector" %message.series)
+                elif flatfield is not None:
+                    self._flatfield = flatfield.astype(np.float32)
+                elif self._verbose:
+                    print("[INFO] no flatfield in series %s" %message.series)
+
+    def buffers(self, shape):
+        """
+        return the float32 product and boolean valid pixel buffers of shape of the calling thread
+        """
+        buffers = self._buffers
+        if getattr(buffers, "shape", None) != shape:
+            buffers.shape = shape
+            buffers.product = np.empty(shape, np.float32)
+            buffers.valid = np.empty(shape, bool)
+        return buffers.product, buffers.valid
+
+    def image(self, message, data):
+        masked, flatfield = self._masked, self._flatfield
+        if masked is None and flatfield is None:
+            return data
+        if not data.flags.writeable:
+            data = data.copy()
+        if data.dtype.kind == "f":
+            flag = np.nan
+        else:
+            flag = np.iinfo(data.dtype).max
+            if self._bitDepth and self._bitDepth < data.dtype.itemsize * 8:
+                flag = (1 << self._bitDepth) - 1
+
+        if flatfield is not None:
+            if flatfield.shape != data.shape:
+                raise ValueError("[ERR] flatfield shape %s does not match image shape %s" %(flatfield.shape, data.shape))
+            if data.dtype.kind == "f":
+                data *= flatfield
+            else:
+                product, valid = self.buffers(data.shape)
+                limit = np.float32(flag - 1)
+                if limit > flag - 1: # not representable as float32
+                    limit = np.nextafter(limit, np.float32(0))
+                np.less(data, flag, out=valid) # overflow pixels keep the flag
+                np.multiply(data, flatfield, out=product, dtype=np.float32)
+                np.rint(product, out=product)
+                np.minimum(product, limit, out=product)
+                np.copyto(data, product, casting="unsafe", where=valid)
+        if masked is not None:
+            data.flat[masked] = flag
+        return data
@@ -3,9 +3,16 @@ FileWriter class is a dummy object which decodes the EIGER zmq
 stream frames from header, images, and end of series meassages.
 Inherite from this class and modify following functions in order
 to create a FileWriter which actually saves files:
-__decodeHeader__(self, frames)
-__decodeImage__(self, frames)
-__decodeEndOfSeries__(self, frames)
+__decodeHeader__(self, message)
+__decodeImage__(self, message)
+__decodeEndOfSeries__(self, message)
+
+The json parts of a message are parsed once into a StreamMessage object
+which is passed to all of these functions.
+
+Processing stages added with addStage (see stages.py) are applied to every
+decoded image before __decodeImage__, readImage then returns the processed
+image. A stage returning None drops the image.
 """
 
 import lz4.block, bitshuffle
@@ -13,17 +20,100 @@ import numpy as np
 import json
 import os
 import struct
+import threading
+from writerPool import getWriterPool
+import metrics
+import time
+from stages import Stage, ColumnTable
 
 __author__ = "SasG"
 __date__ = "16/11/22"
-__version__ = "0.0.3"
+__version__ = "0.0.4"
 __reviewer__ = ""
 
+MESSAGES = {htype: metrics.registry.counter("eiger_stream_decoded_messages_total", "decoded stream messages", htype=htype)
+            for htype in ("dheader", "dimage", "dseries_end")}
+DECODETIME = metrics.registry.histogram("eiger_stream_decode_seconds", "image decode latency")
+DECODEDBYTES = metrics.registry.counter("eiger_stream_decoded_bytes_total", "decoded image bytes")
+DROPPED = metrics.registry.counter("eiger_stream_dropped_frames_total", "images missing at the end of a series")
+SERIESIMAGES = metrics.registry.gauge("eiger_stream_series_images", "received images of the current series")
+VETOED = metrics.registry.counter("eiger_stream_vetoed_images_total", "images dropped by a processing stage")
+SERIESEXPECTED = metrics.registry.gauge("eiger_stream_series_expected_images", "expected images nimages*ntrigger of the current series")
+
+class StreamMessage(object):
+    """
+    EIGER ZMQ stream message. The json parts of the multipart message are
+    parsed once on creation:
+        header:     header dict (all messages)
+        config:     detector config dict (dheader with header_detail basic|all)
+        tables:     {name: (header dict, data frame)} of flatfield, pixelmask and
+                    countrate_table (dheader with header_detail all)
+        info:       image info dict with shape, type and encoding (dimage)
+        timing:     image timing dict with start_time, stop_time and real_time (dimage)
+        appendix:   appendix bytes or None
+        image:      decoded and processed image data if processing stages are used, else None
+    """
+    __slots__ = ("frames", "header", "htype", "series", "frame",
+                 "config", "tables", "info", "timing", "appendix", "image")
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.header = json.loads(frames[0].bytes)
+        self.htype = self.header["htype"]
+        self.series = self.header.get("series")
+        self.frame = self.header.get("frame")
+        self.config = None
+        self.tables = {}
+        self.info = None
+        self.timing = None
+        self.appendix = None
+        self.image = None
+
+        if self.htype.startswith("dimage-"):
+            self.info = json.loads(frames[1].bytes)
+            self.timing = json.loads(frames[3].bytes)
+            if len(frames) == 5:
+                self.appendix = frames[4].bytes
+        elif self.htype.startswith("dheader-"):
+            detail = self.header["header_detail"]
+            if detail != "none":
+                self.config = json.loads(frames[1].bytes)
+            if detail == "all":
+                for i in (2, 4, 6):
+                    header = json.loads(frames[i].bytes)
+                    name = header["htype"].split("-")[0][1:] # e.g. dflatfield-1.0 -> flatfield
+                    self.tables[name] = (header, frames[i+1])
+            if len(frames) == 9:
+                self.appendix = frames[8].bytes
+
+    @property
+    def data(self):
+        """
+        image data blob frame
+        """
+        return self.frames[2]
+
+    def table(self, name):
+        """
+        return flatfield, pixelmask or countrate_table as np array, None if not available
+        """
+        if name not in self.tables:
+            return None
+        header, frame = self.tables[name]
+        if not header["shape"]: # table not sent
+            return None
+        data = np.frombuffer(frame, dtype=np.dtype(header["type"]))
+        return np.reshape(data, header["shape"][::-1])
+
 class FileWriter():
     """
     dummy class to decode zmq frames from EIGER ZMQ stream
     """
-    def __init__(self, basename="eigerStream", path=".", ftype="", verbose=False, roi=False):
+    # writers storing the messages without decoding set True, the pipelines then pass
+    # the messages in stream order on the receiving thread instead of the decode workers
+    undecoded = False
+
+    def __init__(self, basename="eigerStream", path=".", ftype="", verbose=False, roi=None):
 
         self.basename = basename
         self.ftype = ftype
@@ -32,107 +122,205 @@ class FileWriter():
         if not os.path.isdir(self.path):
             raise IOError("[ERR] path %s does not exist" %self.path)
 
-        if roi: self.roi = ROI(*roi,verbose=verbose)
-        else: self.roi = ROI(verbose=verbose)
-
         self._verbose = verbose
         if self._verbose:
             print "[OK] initialized %s FileWriter" %self.ftype
 
+        self._expected = 0 # expected images of the current series, 0 if unknown
+        self._received = 0 # received images of the current series
+        self._countLock = threading.Lock() # images are counted by concurrent workers
+        self.stages = [] # processing stages applied to decoded images
+        if roi is not None:
+            self.addStage(roi)
+
+    def addStage(self, stage):
+        """
+        append processing stage, see stages.py
+        """
+        self.stages.append(stage)
+
+    def submit(self, target, *args):
+        """
+        run write job target(*args) in the shared writer pool.
+        Blocks if too many write jobs of this writer are in flight.
+        """
+        pool = getWriterPool()
+        name = self.__class__.__name__
+        pool.setLimit(name)
+        pool.submit(name, target, *args)
+
+    def close(self):
+        """
+        release open files after all write jobs are done
+        """
+        pass
+
+    def countWritten(self, nbytes):
+        """
+        count nbytes written to files by this writer
+        """
+        metrics.registry.counter("eiger_stream_written_bytes_total", "bytes written to files",
+                                 writer=self.__class__.__name__).inc(nbytes)
+
     def decodeFrames(self, frames):
         """
         decode and proces EIGER ZMQ stream frames
         """
         try:
-            header = json.loads(frames[0].bytes)
+            message = StreamMessage(frames)
         except Exception as e:
             print "[ERR] decoding header: %s" %str(e)
             return False
-        if header["htype"].startswith("dheader-"):
-            self.__decodeHeader__(frames)
-        elif header["htype"].startswith("dimage-"):
-            self.__decodeImage__(frames)
-        elif header["htype"].startswith("dseries_end"):
-            self.__decodeEndOfSeries__(frames)
+        return self.decodeMessage(message)
+
+    def decodeMessage(self, message):
+        """
+        process decoded EIGER ZMQ stream message
+        """
+        if message.htype.startswith("dheader-"):
+            MESSAGES["dheader"].inc()
+        elif message.htype.startswith("dimage-"):
+            MESSAGES["dimage"].inc()
+        elif message.htype.startswith("dseries_end"):
+            MESSAGES["dseries_end"].inc()
         else:
             print "[ERR] not an EIGER ZMQ message"
             return False
+        self._countSeries(message)
+        self._process(message)
         return True
 
-    def __decodeImage__(self, frames):
+    def _process(self, message):
+        """
+        pass the message through the processing stages to the decode functions
+        """
+        if message.htype.startswith("dheader-"):
+            for stage in self.stages:
+                stage.header(message)
+            self.__decodeHeader__(message)
+        elif message.htype.startswith("dimage-"):
+            if self.stages and self._applyStages(message) is None:
+                return
+            self.__decodeImage__(message)
+        else:
+            for stage in self.stages:
+                stage.end(message)
+            self.__decodeEndOfSeries__(message)
+
+    def _applyStages(self, message):
+        """
+        decode the image and pass it through the processing stages
+        return: processed image, None if a stage dropped it
+        """
+        data = self.readImage(message)
+        for stage in self.stages:
+            data = stage.image(message, data)
+            if data is None:
+                if stage.vetoes:
+                    VETOED.inc()
+                return None
+        message.image = data
+        return data
+
+    def _countSeries(self, message):
+        """
+        track received and expected images of the series and count dropped images at the end
+        """
+        with self._countLock:
+            if message.htype.startswith("dheader-"):
+                self._received = 0
+                self._expected = 0
+                if message.config:
+                    self._expected = message.config.get("nimages", 0) * message.config.get("ntrigger", 1)
+                SERIESEXPECTED.set(self._expected)
+            elif message.htype.startswith("dimage-"):
+                self._received += 1
+            elif self._expected > self._received:
+                DROPPED.inc(self._expected - self._received)
+            SERIESIMAGES.set(self._received)
+
+    def __decodeImage__(self, message):
         """
         decode ZMQ image frames
         """
         if self._verbose:
             print "[*] decode image"
 
-        header = json.loads(frames[0].bytes) # header dict
-        info = json.loads(frames[1].bytes) # info dict
-
-        if info["encoding"] == "lz4<": #TODO: soft code flag
-            data = self.readLZ4(frames[2], info["shape"], info["type"])
-        elif "bs" in info["encoding"]:
-            data = self.readBSLZ4(frames[2], info["shape"], info["type"])
-        else:
-            raise IOError("[ERR] encoding %s is not implemented" %info["encoding"])
-
-        return data
+        return self.readImage(message)
 
-    def __decodeEndOfSeries__(self, frames):
+    def __decodeEndOfSeries__(self, message):
         if self._verbose:
-            print "[OK] received end of series ", json.loads(frames[0].bytes)
+            print "[OK] received end of series ", message.header
             return True
 
-    def __decodeHeader__(self, frames):
+    def __decodeHeader__(self, message):
         """
         decode and process ZMQ header frames
         """
         if self._verbose:
             print "[*] decode header"
-        header = json.loads(frames[0].bytes)
-        if header["header_detail"]:
-            if self._verbose:
-                print header
-        if header["header_detail"] is not "none":
-            if self._verbose:
-                print "detector config"
-                for key, value in json.loads(frames[1].bytes).iteritems():
-                    print key, value
-        if header["header_detail"] == "all":
-            if json.loads(frames[2].bytes)["htype"].startswith("dflatfield"):
-                if self._verbose:
-                    print "writing flatfield"
-            if json.loads(frames[4].bytes)["htype"].startswith("dpixelmask"):
-                if self._verbose:
-                    print "writing pixel mask"
-            if json.loads(frames[6].bytes)["htype"].startswith("dcountrate"):
-                if self._verbose:
-                    print "writing LUT"
-        if len(frames) == 9:
-            if self._verbose:
-                print "[*] appendix: ", json.loads(frames[8].bytes)
+            print message.header
+        if message.config and self._verbose:
+            print "detector config"
+            for key, value in message.config.iteritems():
+                print key, value
+        if self._verbose:
+            if "flatfield" in message.tables:
+                print "writing flatfield"
+            if "pixelmask" in message.tables:
+                print "writing pixel mask"
+            if "countrate_table" in message.tables:
+                print "writing LUT"
+        if message.appendix and self._verbose:
+            print "[*] appendix: ", message.appendix
+
+    def readImage(self, message):
+        """
+        decode image data of a dimage message and return np array,
+        the processed image if processing stages are used
+        """
+        if message.image is not None:
+            return message.image
+        info = message.info
+        start = time.time()
+
+        if info["encoding"] == "lz4<": #TODO: soft code flag
+            data = self.readLZ4(message.data, info["shape"], info["type"])
+        elif "bs" in info["encoding"]:
+            data = self.readBSLZ4(message.data, info["shape"], info["type"])
+        elif "lz4" not in info["encoding"]: # uncompressed
+            data = self.readRaw(message.data, info["shape"], info["type"])
+        else:
+            raise IOError("[ERR] encoding %s is not implemented" %info["encoding"])
+
+        if not info.get("decoded"): # counted by the coordinator of the decode processes
+            DECODETIME.observe(time.time() - start)
+            DECODEDBYTES.inc(data.nbytes)
+        return data
 
     def readBSLZ4(self, frame, shape, dtype):
         """
-        unpack bitshuffle-lz4 compressed frame and return np array image data
+        unpack bitshuffle-lz4 compressed frame and return np array image data.
+        The compressed blob is read directly from the frame buffer without copy.
         frame: zmq data blob frame
         shape: image shape
         dtype: image data type
         """
 
-        data = frame.bytes
-        blob = np.fromstring(data[12:], dtype=np.uint8)
+        data = np.frombuffer(frame, dtype=np.uint8) # view on the zmq frame buffer
         dtype = np.dtype(dtype)
         # blocksize is big endian uint32 starting at byte 8, divided by element size
-        blocksize = np.ndarray(shape=(), dtype=">u4", buffer=data[8:12])/dtype.itemsize
-        imgData = bitshuffle.decompress_lz4(blob, shape[::-1], dtype, blocksize)
+        blocksize = int(data[8:12].view(">u4")[0])/dtype.itemsize
+        imgData = bitshuffle.decompress_lz4(data[12:], shape[::-1], dtype, blocksize)
         if self._verbose:
             print "[OK] unpacked {0} bytes of bs-lz4 data".format(len(imgData))
         return imgData
 
     def readLZ4(self, frame, shape, dtype):
         """
-        unpack lz4 compressed frame and return np array image data
+        unpack lz4 compressed frame and return np array image data.
+        The frame buffer is decompressed without copy and the np array
+        is a writeable view on the decompressed buffer.
         frame: zmq data blob frame
         shape: image shape
         dtype:image data type
@@ -141,41 +329,140 @@ class FileWriter():
         dtype = np.dtype(dtype)
         dataSize = dtype.itemsize*shape[0]*shape[1] # bytes * image size
 
-
-        imgData = lz4.block.decompress(struct.pack('<I', dataSize) + frame.bytes)
+        imgData = lz4.block.decompress(frame, uncompressed_size=dataSize, return_bytearray=True)
         #imgData = lz4.loads(struct.pack('<I', dataSize) + frame.bytes)
         if self._verbose:
             print "[OK] unpacked {0} bytes of lz4 data".format(len(imgData))
 
-        return np.reshape(np.fromstring(imgData, dtype=dtype), shape[::-1])
+        return np.reshape(np.frombuffer(imgData, dtype=dtype), shape[::-1])
 
-class ROI():
+    def readRaw(self, frame, shape, dtype):
+        """
+        return np array image data of an uncompressed frame
+        frame: zmq data blob frame
+        shape: image shape
+        dtype: image data type
+        """
+        imgData = np.frombuffer(frame, dtype=np.dtype(dtype))
+        if self._verbose:
+            print "[OK] read {0} bytes of raw data".format(imgData.nbytes)
+
+        return np.reshape(imgData, shape[::-1])
+
+class FileWriterGroup(FileWriter):
     """
-    NOT IMPLEMENTED YET
-    software ROI
-    class ROI returns region of interest of a numpy array
+    pass the messages to several file writers, e.g. one per ROI.
+    Images are decoded and processed by the stages of the group once,
+    each writer then applies its own stages, e.g. its ROI, to a copy of the message.
     """
-    def __init__(self, start=[False,False], end=[False,False], verbose=False):
+    def __init__(self, writers, verbose=False):
+        FileWriter.__init__(self, writers[0].basename, writers[0].path, "group", verbose)
+        self.writers = writers
+
+    def copy(self, message):
+        """
+        return shallow copy of message, stages of the writers may replace e.g. its config or image
+        """
+        copy = StreamMessage.__new__(StreamMessage)
+        for key in StreamMessage.__slots__:
+            setattr(copy, key, getattr(message, key))
+        return copy
+
+    def __decodeHeader__(self, message):
+        for writer in self.writers:
+            writer._process(self.copy(message))
 
-        self.xstart, self.ystart = start[0],start[1]
-        self.xend, self.yend = end[0],end[1]
-        self.active = all([self.xstart, self.ystart, self.xend, self.yend])
+    def __decodeImage__(self, message):
+        data = self.readImage(message)
+        for writer in self.writers:
+            copy = self.copy(message)
+            copy.image = data
+            writer._process(copy)
+        return data
+
+    def __decodeEndOfSeries__(self, message):
+        for writer in self.writers:
+            writer._process(self.copy(message))
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+class ROI(Stage):
+    """
+    software ROI: named rectangles {name: (xstart, ystart, xend, yend)} with
+    inclusive pixel bounds. The sums of the unflagged pixels of all ROIs are
+    recorded per frame and saved per series to /path/basename_SERIES_roi.npz
+    if path is given.
+    crop: name of the ROI passed on instead of the full image, None passes the full image
+    sumsOnly: drop the images after summing, only the sums are saved
+    """
+    def __init__(self, rois, crop=None, sumsOnly=False, basename="eigerStream", path=None, verbose=False):
+        self.rois = dict((name, tuple(int(i) for i in rect)) for name, rect in rois.items())
+        for name, (xstart, ystart, xend, yend) in self.rois.items():
+            if xend < xstart or yend < ystart or min(xstart, ystart) < 0:
+                raise ValueError("[ERR] invalid ROI %s: %s" %(name, self.rois[name]))
+        if crop is not None and crop not in self.rois:
+            raise ValueError("[ERR] unknown ROI %s" %crop)
+        self.crop = crop
+        self.sumsOnly = sumsOnly
+        self.basename = basename
+        self.path = path
         self._verbose = verbose
+        self.series = None
+        self._flag = None # pixel value of masked and overflow pixels of the series
+        self.table = ColumnTable([("frame", "<u8")] + [(str(name), "<f8") for name in sorted(self.rois)])
 
         if self._verbose:
-            if self.active:
-                print "ROI active, start: %s, end: %s (ROI not yet implemented)" %(start, end)
-            else:
-                print "[INFO] software ROI inactive (ROI not yet implemented)"
+            print "[OK] %s" %self
 
     def __str__(self):
-        if active:
-            return "ROI start: %s end: %s" %(self.start, self.end)
-        else:
-            return "none"
+        rois = ", ".join("%s: %s" %(name, rect) for name, rect in sorted(self.rois.items()))
+        return "ROI %s, crop: %s, sums only: %s" %(rois, self.crop, self.sumsOnly)
 
-    def roi(data):
-        if self.active:
-            return data[self.ystart:self.yend+1, self.xstart:self.xend+1]
-        else:
-            return data
+    def header(self, message):
+        self.table.clear()
+        self.series = message.series
+        config = message.config or {}
+        self._flag = (1 << config["bit_depth_image"]) - 1 if "bit_depth_image" in config else None
+        shape = (config.get("x_pixels_in_detector"), config.get("y_pixels_in_detector"))
+        for name, (xstart, ystart, xend, yend) in self.rois.items():
+            if shape[0] and (xend >= shape[0] or yend >= shape[1]):
+                print "[WARNING] ROI %s %s exceeds the detector size %s" %(name, self.rois[name], shape)
+
+    def roi(self, data, name):
+        """
+        return region of interest name of the image data
+        """
+        xstart, ystart, xend, yend = self.rois[name]
+        return data[ystart:yend+1, xstart:xend+1]
+
+    def image(self, message, data):
+        if self.path is not None or self.sumsOnly:
+            sums = {}
+            flag = self._flag
+            if flag is None and data.dtype.kind in "ui":
+                flag = np.iinfo(data.dtype).max
+            for name in self.rois:
+                region = self.roi(data, name)
+                total = region.sum(dtype=np.float64)
+                if flag is not None:
+                    flagged = region >= flag
+                    if flagged.any():
+                        total -= region[flagged].sum(dtype=np.float64)
+                sums[str(name)] = total
+            self.table.append(frame=message.frame, **sums)
+        if self.sumsOnly:
+            return None
+        if self.crop is not None:
+            return np.ascontiguousarray(self.roi(data, self.crop))
+        return data
+
+    def end(self, message):
+        if self.path is None or not len(self.table):
+            return
+        self.table.sort("frame")
+        path = os.path.join(self.path, "%s_%05d_roi.npz" %(self.basename, self.series or message.series or 0))
+        self.table.save(path)
+        print "[OK] wrote ROI sums of %d frames to %s" %(len(self.table), path)
+        self.table.clear()
@@ -0,0 +1,121 @@
+"""
+Per frame statistics stage: sum, maximum and the number of saturated,
+overflow and masked pixels of every image. Pixels with the maximum value of
+the image bit depth are either masked in the pixel mask of the dheader
+message (gaps, defective pixels) or overflowing; they are excluded from the
+sum and the maximum. Pixels at or above countrate_correction_count_cutoff
+are counted as saturated, they are only searched if the maximum reaches
+the cutoff. The boolean and work arrays of these passes are allocated once
+per image shape and worker thread.
+
+The results are kept in a ColumnTable per series, saved at the end of the
+series to /path/basename_<series>_statistics.npz, and the values of the last
+frame are exported as metrics for live diagnostics.
+"""
+
+from stages import Stage, ColumnTable
+import metrics
+import numpy as np
+import os
+import threading
+
+__author__ = "SasG"
+__date__ = "17/05/17"
+__version__ = "0.0.1"
+__reviewer__ = ""
+
+COLUMNS = [("frame", "<u8"), ("sum", "<f8"), ("max", "<f8"),
+           ("saturated", "<u4"), ("overflow", "<u4"), ("masked", "<u4")]
+
+class FrameStatistics(Stage):
+    """
+    compute the statistics of every image and save them per series
+    """
+    def __init__(self, basename, path, verbose=False):
+        self.basename = basename
+        self.path = path
+        self._verbose = verbose
+        self.table = ColumnTable(COLUMNS)
+        self.series = None
+        self._cutoff = None # saturation count cutoff, None if unknown
+        self._bitDepth = None # image bit depth of the config, None if unknown
+        self._mask = None # flat indices of the pixel mask, None if not sent
+        self._buffers = threading.local() # boolean and work buffers per thread
+        self._lock = threading.Lock()
+
+        self._last = {}
+        for key in ("sum", "max", "saturated", "overflow", "masked"):
+            metrics.registry.gauge("eiger_stream_frame_statistics", "statistics of the last frame",
+                                   fn=lambda key=key: self._last.get(key, 0), stat=key)
+
+    def header(self, message):
+        with self._lock:
+            self.table.clear()
+            self.series = message.series
+            config = message.config or {}
+            self._cutoff = config.get("countrate_correction_count_cutoff")
+            self._bitDepth = config.get("bit_depth_image")
+            mask = message.table("pixelmask")
+            self._mask = np.flatnonzero(mask) if mask is not None else None
+
+    def image(self, message, data):
+        values = self.statistics(data)
+        self.table.append(frame=message.frame, **values)
+        self._last = values
+        return data
+
+    def buffers(self, shape, dtype):
+        """
+        return the boolean and the work buffer of shape and dtype of the calling thread
+        """
+        buffers = self._buffers
+        if getattr(buffers, "key", None) != (shape, dtype):
+            buffers.key = (shape, dtype)
+            buffers.mask = np.empty(shape, bool)
+            buffers.work = np.empty(shape, dtype)
+        return buffers.mask, buffers.work
+
+    def statistics(self, data):
+        """
+        return dict of the statistics of image data
+        """
+        flat = data.reshape(-1)
+        flag = np.iinfo(data.dtype).max if data.dtype.kind in "ui" else np.inf
+        if self._bitDepth and self._bitDepth < data.dtype.itemsize * 8:
+            flag = (1 << self._bitDepth) - 1
+        flagged, work = self.buffers(flat.shape, flat.dtype)
+        nFlagged = int(np.count_nonzero(np.greater_equal(flat, flag, out=flagged)))
+        masked = int(np.count_nonzero(flagged[self._mask])) if nFlagged and self._mask is not None else 0
+
+        total = flat.sum(dtype=np.float64 if data.dtype.kind == "f" else np.uint64)
+        if not nFlagged:
+            maximum = flat.max()
+        elif nFlagged == flat.size:
+            total, maximum = total.dtype.type(0), 0
+        elif data.dtype.kind == "u" and flag == np.iinfo(data.dtype).max: # flagged pixels have the flag value
+            total -= total.dtype.type(nFlagged) * total.dtype.type(flag)
+            maximum = np.add(flat, data.dtype.type(1), out=work).max() - 1 # flagged pixels wrap around to 0
+        else:
+            total -= flat[flagged].sum(dtype=total.dtype)
+            if data.dtype.kind == "f":
+                maximum = flat[~flagged].max()
+            else:
+                maximum = np.multiply(flat, np.logical_not(flagged, out=flagged), out=work).max() # flagged pixels count as 0
+        saturated = 0
+        if self._cutoff and maximum >= self._cutoff: # no pass if all unflagged pixels are below the cutoff
+            saturated = int(np.count_nonzero(np.greater_equal(flat, self._cutoff, out=flagged))) - nFlagged
+
+        return {"sum": total, "max": maximum, "saturated": max(saturated, 0),
+                "overflow": nFlagged - masked, "masked": masked}
+
+    def end(self, message):
+        with self._lock:
+            if not len(self.table):
+                return
+            self.table.sort("frame")
+            path = os.path.join(self.path, "%s_%05d_statistics.npz" %(self.basename, self.series or message.series or 0))
+            self.table.save(path)
+            if self._verbose:
+                total = self.table.column("sum")
+                print("[OK] wrote statistics of %d frames to %s, mean sum %.1f" %(len(total), path, total.mean()))
+            self.table.clear()
@@ -0,0 +1,87 @@
+"""
+Hit finder stage for serial crystallography: the hit score of every image
+is the number of pixels above threshold counts, excluding masked and
+overflow pixels. Only images with a score of at least minPixels are passed
+on to the writer, the other images are dropped. The score is computed on
+every decimate-th row and column only if decimate > 1.
+
+The scores of all frames are kept in a ColumnTable per series and saved at
+the end of the series to /path/basename_<series>_hits.npz.
+"""
+
+from stages import Stage, ColumnTable
+import metrics
+import numpy as np
+import os
+import threading
+
+__author__ = "SasG"
+__date__ = "17/05/17"
+__version__ = "0.0.1"
+__reviewer__ = ""
+
+COLUMNS = [("frame", "<u8"), ("score", "<u4"), ("hit", "u1")]
+
+HITS = metrics.registry.counter("eiger_stream_hits_total", "images passed by the hit finder")
+
+class HitFinder(Stage):
+    """
+    drop images with less than minPixels pixels above threshold
+    """
+    def __init__(self, basename, path, threshold, minPixels, decimate=1, verbose=False):
+        self.basename = basename
+        self.path = path
+        self.threshold = threshold
+        self.minPixels = minPixels
+        self.decimate = max(decimate, 1)
+        self._verbose = verbose
+        self.table = ColumnTable(COLUMNS)
+        self.series = None
+        self._valid = None # unmasked pixels of the decimated image, None if no pixel mask
+        self._flag = None # pixel value of masked and overflow pixels of the series
+        self._lock = threading.Lock()
+
+    def header(self, message):
+        with self._lock:
+            self.table.clear()
+            self.series = message.series
+            config = message.config or {}
+            self._flag = (1 << config["bit_depth_image"]) - 1 if "bit_depth_image" in config else None
+            mask = message.table("pixelmask")
+            self._valid = None
+            if mask is not None:
+                self._valid = np.ascontiguousarray(mask[::self.decimate, ::self.decimate] == 0)
+
+    def score(self, data):
+        """
+        return the number of unmasked pixels of data above the threshold
+        """
+        view = data[::self.decimate, ::self.decimate] if self.decimate > 1 else data
+        above = view > self.threshold
+        if data.dtype.kind in "ui":
+            flag = self._flag if self._flag is not None else np.iinfo(data.dtype).max
+            above &= view < flag
+        if self._valid is not None and self._valid.shape == above.shape:
+            above &= self._valid
+        return int(np.count_nonzero(above))
+
+    def image(self, message, data):
+        score = self.score(data)
+        hit = score >= self.minPixels
+        self.table.append(frame=message.frame, score=score, hit=hit)
+        if not hit:
+            return None
+        HITS.inc()
+        return data
+
+    def end(self, message):
+        with self._lock:
+            if not len(self.table):
+                return
+            self.table.sort("frame")
+            path = os.path.join(self.path, "%s_%05d_hits.npz" %(self.basename, self.series or message.series or 0))
+            self.table.save(path)
+            hits = int(self.table.column("hit").sum())
+            print("[OK] %d hits in %d frames (%.1f%%), wrote scores to %s"
+                  %(hits, len(self.table), 100. * hits / len(self.table), path))
+            self.table.clear()
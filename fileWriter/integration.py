@@ -0,0 +1,112 @@
+"""
+Radial integration stage: integrate every image into a 1-D profile of the
+mean intensity in nbins bins of the momentum transfer
+q = 4 pi sin(theta) / wavelength [1/A]. The bin index of every pixel is
+computed once per series from beam_center_x/y, detector_distance,
+x/y_pixel_size and wavelength of the dheader config, masked pixels of the
+pixel mask are excluded. The images are then integrated with np.bincount.
+Overflow pixels are excluded per image. No solid angle or polarization
+correction is applied.
+
+The profiles are saved at the end of the series to
+/path/basename_<series>_integration.npz with the arrays frame, profile
+(frames x nbins), q (bin centers) and pixels (unmasked pixels per bin).
+"""
+
+from stages import Stage, ColumnTable
+import numpy as np
+import os
+import threading
+
+__author__ = "SasG"
+__date__ = "17/05/17"
+__version__ = "0.0.1"
+__reviewer__ = ""
+
+GEOMETRY = ("beam_center_x", "beam_center_y", "detector_distance", "x_pixel_size", "y_pixel_size", "wavelength")
+
+class RadialIntegration(Stage):
+    """
+    integrate every image radially and save the profiles per series
+    """
+    def __init__(self, basename, path, nbins=1000, verbose=False):
+        self.basename = basename
+        self.path = path
+        self.nbins = nbins
+        self._verbose = verbose
+        self.table = ColumnTable([("frame", "<u8"), ("profile", "<f8", (nbins,))])
+        self.series = None
+        self._index = None # q bin of every pixel, nbins for masked pixels, None if the geometry is unknown
+        self._pixels = None # unmasked pixels per bin
+        self._q = None # q bin centers
+        self._flag = None # pixel value of masked and overflow pixels
+        self._lock = threading.Lock()
+
+    def header(self, message):
+        with self._lock:
+            self.table.clear()
+            self.series = message.series
+            self._index = None
+            config = message.config or {}
+            missing = [key for key in GEOMETRY + ("x_pixels_in_detector", "y_pixels_in_detector")
+                       if key not in config or (not key.startswith("beam_center") and config[key] <= 0)]
+            if missing:
+                print("[WARNING] no radial integration of series %s, missing or invalid %s" %(message.series, ", ".join(missing)))
+                return
+            self._flag = (1 << config["bit_depth_image"]) - 1 if "bit_depth_image" in config else None
+            self.geometry(config, message.table("pixelmask"))
+
+    def geometry(self, config, mask=None):
+        """
+        compute the q bin of every pixel of the detector
+        config: detector config dict
+        mask: pixel mask, pixels != 0 are excluded
+        """
+        x = (np.arange(config["x_pixels_in_detector"]) + 0.5 - config["beam_center_x"]) * config["x_pixel_size"]
+        y = (np.arange(config["y_pixels_in_detector"]) + 0.5 - config["beam_center_y"]) * config["y_pixel_size"]
+        r = np.hypot(x[np.newaxis, :], y[:, np.newaxis])
+        q = 4 * np.pi * np.sin(np.arctan2(r, config["detector_distance"]) / 2) / config["wavelength"]
+        qmax = q.max()
+        index = np.minimum((q * (self.nbins / qmax)).astype(np.intp), self.nbins - 1).reshape(-1)
+        if mask is not None:
+            index[np.flatnonzero(mask)] = self.nbins
+        self._index = index
+        self._pixels = np.bincount(index, minlength=self.nbins + 1)[:self.nbins]
+        self._q = (np.arange(self.nbins) + 0.5) * (qmax / self.nbins)
+        if self._verbose:
+            print("[OK] radial integration into %d bins up to q = %.4f 1/A" %(self.nbins, qmax))
+
+    def integrate(self, data):
+        """
+        return the mean intensity per q bin of image data, nan for bins without pixels
+        """
+        flat = data.reshape(-1)
+        if flat.size != self._index.size:
+            raise ValueError("[ERR] image size %d does not match the detector size %d" %(flat.size, self._index.size))
+        sums = np.bincount(self._index, weights=flat, minlength=self.nbins + 1)
+        pixels = self._pixels
+        if data.dtype.kind in "ui":
+            flag = self._flag if self._flag is not None else np.iinfo(data.dtype).max
+            flagged = np.flatnonzero(flat >= flag)
+            if flagged.size:
+                index = self._index[flagged]
+                sums -= np.bincount(index, weights=flat[flagged], minlength=self.nbins + 1)
+                pixels = pixels - np.bincount(index, minlength=self.nbins + 1)[:self.nbins]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return sums[:self.nbins] / pixels
+
+    def image(self, message, data):
+        if self._index is not None:
+            self.table.append(frame=message.frame, profile=self.integrate(data))
+        return data
+
+    def end(self, message):
+        with self._lock:
+            if not len(self.table):
+                return
+            self.table.sort("frame")
+            path = os.path.join(self.path, "%s_%05d_integration.npz" %(self.basename, self.series or message.series or 0))
+            np.savez(path, q=self._q, pixels=self._pixels, **self.table.columns())
+            if self._verbose:
+                print("[OK] wrote radial profiles of %d frames to %s" %(len(self.table), path))
+            self.table.clear()
@@ -0,0 +1,225 @@
+"""
+In-process metrics registry of the stream receiver.
+Counters, gauges and latency histograms are updated by the receiver, the
+decoding and the writers and are exposed in Prometheus text format over
+a local HTTP endpoint:
+
+    from fileWriter import metrics
+    metrics.serve(9100) # http://127.0.0.1:9100/metrics
+
+Rates (messages/s, MB/s) are derived from the counters, e.g.
+rate(eiger_stream_received_bytes_total[10s]).
+This module is compatible with Python 2 and 3.
+"""
+
+import threading
+import time
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+__author__ = "SasG"
+__date__ = "17/05/17"
+__version__ = "0.0.1"
+__reviewer__ = ""
+
+#default latency histogram buckets in s
+BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+
+def _labelString(labels, extra=None):
+    items = sorted(labels.items())
+    if extra:
+        items.append(extra)
+    if not items:
+        return ""
+    return "{" + ",".join('%s="%s"' %(k, v) for k, v in items) + "}"
+
+class Counter():
+    """
+    monotonically increasing value
+    """
+    kind = "counter"
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+    def render(self, name):
+        return ["%s%s %s" %(name, _labelString(self.labels), self.value)]
+
+class Gauge():
+    """
+    value which can go up and down, or is read from a callback function
+    """
+    kind = "gauge"
+
+    def __init__(self, labels, fn=None):
+        self.labels = labels
+        self.value = 0
+        self.fn = fn
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+    def dec(self, n=1):
+        self.inc(-n)
+
+    def render(self, name):
+        value = self.value
+        if self.fn:
+            try:
+                value = self.fn()
+            except Exception:
+                return []
+        return ["%s%s %s" %(name, _labelString(self.labels), value)]
+
+class Histogram():
+    """
+    distribution of observed values, e.g. latencies
+    """
+    kind = "histogram"
+
+    def __init__(self, labels, buckets=BUCKETS):
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # last bin is +Inf
+        self.sum = 0.
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """
+        return context manager observing the duration of its block
+        """
+        return _Timer(self)
+
+    def render(self, name):
+        lines = []
+        cumulative = 0
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        for le, n in zip(self.buckets + ("+Inf",), counts):
+            cumulative += n
+            lines.append("%s_bucket%s %d" %(name, _labelString(self.labels, ("le", le)), cumulative))
+        lines.append("%s_sum%s %s" %(name, _labelString(self.labels), total))
+        lines.append("%s_count%s %d" %(name, _labelString(self.labels), count))
+        return lines
+
+class _Timer():
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self._histogram.observe(time.time() - self._start)
+        return False
+
+class Registry():
+    """
+    collection of named metrics, metrics of the same name differ by their labels
+    """
+    def __init__(self):
+        self._metrics = {} # name: (help, {labels: metric})
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = (help, {})
+            family = self._metrics[name][1]
+            if key not in family:
+                family[key] = cls(labels, **kwargs)
+            elif kwargs.get("fn"): # re-registered gauge callback
+                family[key].fn = kwargs["fn"]
+            return family[key]
+
+    def counter(self, name, help="", **labels):
+        """
+        return counter name with labels, create it if not existing
+        """
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help="", fn=None, **labels):
+        """
+        return gauge name with labels, create it if not existing.
+        fn: optional callback returning the current value
+        """
+        return self._get(Gauge, name, help, labels, fn=fn)
+
+    def histogram(self, name, help="", buckets=BUCKETS, **labels):
+        """
+        return histogram name with labels, create it if not existing
+        """
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self):
+        """
+        return all metrics in Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            families = sorted((name, help, list(family.values())) for name, (help, family) in self._metrics.items())
+        for name, help, metrics in families:
+            if help:
+                lines.append("# HELP %s %s" %(name, help))
+            lines.append("# TYPE %s %s" %(name, metrics[0].kind))
+            for metric in metrics:
+                lines.extend(metric.render(name))
+        return "\n".join(lines) + "\n"
+
+#registry shared by all stages
+registry = Registry()
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") not in ("", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass # do not log every scrape
+
+def serve(port, host="127.0.0.1", registry=registry):
+    """
+    serve registry on http://host:port/metrics from a daemon thread
+    host: interface to bind, "" or "0.0.0.0" exposes the metrics on all interfaces
+    return: HTTPServer
+    """
+    server = HTTPServer((host, port), _Handler)
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever, name="metrics")
+    thread.daemon = True
+    thread.start()
+    print("[OK] serving metrics on http://%s:%d/metrics" %(host or "0.0.0.0", port))
+    return server
@@ -0,0 +1,159 @@
+"""
+Reduction stage: sum every nframes consecutive frames and/or bin
+binning x binning pixels before the images are written, like the detector
+setting nframes_sum in software. Frame i of the series is summed into the
+reduced frame i // nframes, which is passed on with this frame number when
+all of its frames are received, so frames decoded out of order by several
+workers are summed correctly. Incomplete reduced frames at the end of a
+series are dropped.
+
+Integer images are accumulated as uint64 and passed on as uint32. Sums
+exceeding uint32 saturate at 2**32-2, pixels summed from a masked or
+overflow pixel (maximum value of the image bit depth) keep the flag value
+2**32-1. Rows and columns not filling a complete bin are cut off.
+
+The detector config of the dheader message is rewritten for the reduced
+images, so the writers store the geometry and exposure of the written data:
+pixel sizes, detector size and beam center are scaled by the binning, the
+number of images, count and frame time, the angle increments and the count
+cutoff by the number of summed frames.
+"""
+
+from stages import Stage
+import metrics
+import numpy as np
+import threading
+
+__author__ = "SasG"
+__date__ = "17/05/17"
+__version__ = "0.0.1"
+__reviewer__ = ""
+
+FLAG = np.iinfo(np.uint32).max # value of masked and overflow pixels of reduced images
+
+MERGED = metrics.registry.counter("eiger_stream_merged_images_total", "images merged into a following reduced image")
+
+ANGLES = ("chi", "kappa", "omega", "phi", "two_theta")
+
+class Reduction(Stage):
+    """
+    sum nframes consecutive frames and bin binning x binning pixels
+    """
+    vetoes = False # summed frames are merged, not rejected
+
+    def __init__(self, nframes=1, binning=1, verbose=False):
+        if nframes < 1 or binning < 1:
+            raise ValueError("[ERR] invalid reduction nframes %d binning %d" %(nframes, binning))
+        self.nframes = nframes
+        self.binning = binning
+        self._verbose = verbose
+        self._flag = None # pixel value of masked and overflow pixels of the series
+        self._sums = {} # reduced frame: [accumulator, flagged pixels, number of summed frames]
+        self._lock = threading.Lock()
+
+        if self._verbose:
+            print("[OK] %s" %self)
+
+    def __str__(self):
+        return "Reduction sum %d frames, bin %dx%d pixels" %(self.nframes, self.binning, self.binning)
+
+    def header(self, message):
+        with self._lock:
+            self._sums = {}
+            config = message.config or {}
+            self._flag = (1 << config["bit_depth_image"]) - 1 if "bit_depth_image" in config else None
+            if message.config:
+                message.config = self.reduceConfig(message.config)
+
+    def reduceConfig(self, config):
+        """
+        return copy of the detector config dict describing the reduced images
+        """
+        config = dict(config)
+        b, n = self.binning, self.nframes
+        def scale(key, factor, op=lambda value, factor: value * factor):
+            if isinstance(config.get(key), (int, float)) and not isinstance(config[key], bool):
+                config[key] = op(config[key], factor)
+        for axis in ("x", "y"):
+            scale(axis + "_pixel_size", b)
+            scale(axis + "_pixels_in_detector", b, lambda value, factor: value // factor)
+            scale("beam_center_" + axis, b, lambda value, factor: value / float(factor))
+        if n > 1:
+            if isinstance(config.get("nimages"), int):
+                config["nimages"] = config["nimages"] * config.get("ntrigger", 1) // n
+                config["ntrigger"] = 1
+            for key in ("count_time", "frame_time", "nframes_sum"):
+                scale(key, n)
+            for angle in ANGLES:
+                scale(angle + "_increment", n)
+                scale(angle + "_range_average", n)
+        scale("countrate_correction_count_cutoff", n * b * b)
+        config["bit_depth_image"] = 32
+        return config
+
+    def bin(self, data):
+        """
+        return the sum of binning x binning pixels of data as uint64 or float64
+        """
+        dtype = np.float64 if data.dtype.kind == "f" else np.uint64
+        if self.binning == 1:
+            return data.astype(dtype)
+        b = self.binning
+        y, x = data.shape[0] // b, data.shape[1] // b
+        return data[:y*b, :x*b].reshape(y, b, x, b).sum(axis=(1, 3), dtype=dtype)
+
+    def flagged(self, data):
+        """
+        return boolean array of the binned pixels containing masked or overflow pixels, None if there are none
+        """
+        if data.dtype.kind == "f":
+            return None
+        flag = self._flag if self._flag is not None else np.iinfo(data.dtype).max
+        flagged = data >= flag
+        if not flagged.any():
+            return None
+        if self.binning == 1:
+            return flagged
+        b = self.binning
+        y, x = data.shape[0] // b, data.shape[1] // b
+        return flagged[:y*b, :x*b].reshape(y, b, x, b).any(axis=(1, 3))
+
+    def image(self, message, data):
+        binned = self.bin(data)
+        flagged = self.flagged(data)
+        if self.nframes == 1:
+            return self.finish(binned, flagged)
+
+        number = message.frame // self.nframes
+        with self._lock:
+            entry = self._sums.get(number)
+            if entry is None:
+                self._sums[number] = entry = [binned, flagged, 0]
+            else:
+                entry[0] += binned
+                if flagged is not None:
+                    entry[1] = flagged if entry[1] is None else entry[1] | flagged
+            entry[2] += 1
+            if entry[2] < self.nframes:
+                MERGED.inc()
+                return None
+            del self._sums[number]
+        message.frame = number
+        return self.finish(entry[0], entry[1])
+
+    def finish(self, data, flagged):
+        """
+        return the reduced image, uint32 with saturated sums and flagged pixels or float32
+        """
+        if data.dtype.kind == "f":
+            return data.astype(np.float32)
+        data = np.minimum(data, FLAG - 1).astype(np.uint32)
+        if flagged is not None:
+            data[flagged] = FLAG
+        return data
+
+    def end(self, message):
+        with self._lock:
+            if self._sums:
+                print("[WARNING] dropped %d incomplete reduced frames of series %s" %(len(self._sums), message.series))
+            self._sums = {}
@@ -0,0 +1,93 @@
+"""
+Bounded reorder buffer for images completed out of order by parallel workers.
+Items are pushed with their frame number and released in frame order. A
+missing frame (gap) is skipped if the buffer holds more than window items or
+if the oldest held item waited longer than timeout, so memory and latency
+stay bounded when frames are lost. Frames arriving after their gap was
+skipped are released immediately and counted as late.
+This module is compatible with Python 2 and 3.
+"""
+
+import time
+
+__author__ = "SasG"
+__date__ = "17/05/17"
+__version__ = "0.0.1"
+__reviewer__ = ""
+
+#maximum number of held items
+WINDOW = 64
+
+#maximum time in s an item is held waiting for a missing frame
+TIMEOUT = 1.
+
+class ReorderBuffer(object):
+    """
+    release pushed items in the order of their integer key, e.g. the frame number
+    """
+    def __init__(self, first=0, window=WINDOW, timeout=TIMEOUT):
+        self.window = window
+        self.timeout = timeout
+        self.counters = {"released": 0, # released items
+                         "gaps": 0, # skipped missing keys
+                         "late": 0, # items released after their key was skipped
+                         }
+        self.reset(first)
+
+    def reset(self, first=0):
+        """
+        drop held items and expect key first next, e.g. at the start of a series
+        """
+        self._next = first # next key to release
+        self._items = {} # key: (push time, item)
+
+    def __len__(self):
+        return len(self._items)
+
+    def push(self, key, item):
+        """
+        add item with key
+        return: list of items which can be released in order
+        """
+        if key < self._next: # gap was already skipped
+            self.counters["late"] += 1
+            self.counters["released"] += 1
+            return [item] + self.poll()
+        self._items[key] = (time.time(), item)
+        return self.poll()
+
+    def poll(self):
+        """
+        return list of items which can be released in order, skip gaps
+        if the window is full or the oldest item timed out
+        """
+        released = self._release()
+        while self._items and (len(self._items) > self.window or self._oldest() > self.timeout):
+            first = min(self._items)
+            self.counters["gaps"] += first - self._next
+            self._next = first
+            released += self._release()
+        return released
+
+    def flush(self):
+        """
+        return all held items in key order, e.g. at the end of a series
+        """
+        released = []
+        for key in sorted(self._items):
+            self.counters["gaps"] += key - self._next
+            released.append(self._items.pop(key)[1])
+            self._next = key + 1
+        self.counters["released"] += len(released)
+        return released
+
+    def _release(self):
+        released = []
+        while self._next in self._items:
+            released.append(self._items.pop(self._next)[1])
+            self._next += 1
+        self.counters["released"] += len(released)
+        return released
+
+    def _oldest(self):
+        return time.time() - min(pushed for pushed, item in self._items.values())
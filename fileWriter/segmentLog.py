@@ -0,0 +1,301 @@
+"""
+Append-only segment log for raw stream dumps.
+Messages are appended as they are received into large pre-allocated segment
+files basename_000001.seg, basename_000002.seg, ... which are rolled when
+the next message does not fit. Every message part (ZMQ frame) gets a record
+in the binary index file of its segment, basename_000001.idx:
+
+    series   uint64  series number
+    frame    uint64  frame/image number, NOFRAME for header and end messages
+    part     uint16  index of the ZMQ frame in the multipart message
+    offset   uint64  byte offset in the segment
+    length   uint64  byte length
+    crc32    uint32  checksum of the bytes
+
+so a session is written with few large sequential writes instead of one file
+per frame. The SegmentReader memory-maps the segments for random access by
+(series, frame), e.g. to convert the dump to tif, cbf or h5 later.
+The index records are kept in memory until the data they point to is flushed
+and synced to disk (every SYNCSIZE bytes, at flush, roll and close), only
+then they are written to the index. An index record therefore always points
+to complete data, also after a crash; the messages appended after the last
+sync are lost. The syncs run in order on a sync thread of the writer, so the
+appending thread only hands over the records and never waits for the disk,
+except in close, which returns when all data and index records are synced.
+This module is compatible with Python 2 and 3.
+"""
+
+import numpy as np
+import glob
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+try:
+    import queue
+except ImportError: # Python 2
+    import Queue as queue
+
+__author__ = "SasG"
+__date__ = "17/05/17"
+__version__ = "0.0.1"
+__reviewer__ = ""
+
+PY2 = sys.version_info[0] == 2
+
+#size of pre-allocated segment files in bytes
+SEGMENTSIZE = 1 << 30
+
+#frame number of messages without frame, e.g. header and end of series
+NOFRAME = (1 << 64) - 1
+
+#bytes appended between syncs of the data and the index
+SYNCSIZE = 1 << 26
+
+RECORD = struct.Struct("<QQHQQI")
+INDEXDTYPE = np.dtype([("series", "<u8"), ("frame", "<u8"), ("part", "<u2"),
+                       ("offset", "<u8"), ("length", "<u8"), ("crc32", "<u4")])
+
+def _buffer(part):
+    """
+    return bytes-like of a message part without copy if possible
+    """
+    part = getattr(part, "bytes" if PY2 else "buffer", part) # zmq.Frame
+    if PY2 and isinstance(part, memoryview):
+        return part.tobytes()
+    return part
+
+class SegmentWriter(object):
+    """
+    append messages to pre-allocated segment files and their index
+    """
+    def __init__(self, basename, segmentSize=SEGMENTSIZE, syncSize=SYNCSIZE):
+        self.basename = basename
+        self.segmentSize = segmentSize
+        self.syncSize = syncSize
+        self.segment = 0 # number of the open segment
+        self.offset = 0 # write position in the open segment
+        self.written = 0 # bytes written to all segments
+        self._data = None
+        self._index = None
+        self._records = [] # index records of data not yet synced
+        self._unsynced = 0 # bytes appended since the last sync
+        self._lock = threading.Lock()
+        self._syncs = queue.Queue() # (data file, index file, records, final offset or None)
+        self._error = None # exception of a failed sync, raised by the next call
+        thread = threading.Thread(target=self._syncer, name="segmentSync")
+        thread.daemon = True
+        thread.start()
+
+    def append(self, series, frame, parts):
+        """
+        append a message, i.e. a list of parts (bytes, memoryview or zmq.Frame)
+        series, frame: index keys, frame is None for header and end messages
+        return: (segment number, offset) of the message
+        """
+        self._raise()
+        if frame is None:
+            frame = NOFRAME
+        parts = [_buffer(part) for part in parts]
+        lengths = [len(part) for part in parts]
+        with self._lock:
+            if self._data is None or (self.offset and self.offset + sum(lengths) > self.segmentSize):
+                self.roll()
+            start = offset = self.offset
+            records = []
+            for i, part in enumerate(parts):
+                self._data.write(part)
+                records.append(RECORD.pack(series, frame, i, offset, lengths[i], zlib.crc32(part) & 0xffffffff))
+                offset += lengths[i]
+            self._records += records
+            self.offset = offset
+            self.written += offset - start
+            self._unsynced += offset - start
+            if self._unsynced >= self.syncSize:
+                self._sync()
+            return self.segment, start
+
+    def _sync(self, final=False):
+        """
+        pass the appended data and its index records to the sync thread,
+        the segment is closed after the sync if final
+        """
+        if self._data is None or not (self._records or final):
+            return
+        self._data.flush()
+        self._syncs.put((self._data, self._index, self._records, self.offset if final else None))
+        self._records = []
+        self._unsynced = 0
+
+    def _syncer(self):
+        """
+        sync thread: sync the data to disk, then write the index records pointing to it
+        """
+        while True:
+            data, index, records, final = self._syncs.get()
+            try:
+                if records:
+                    os.fsync(data.fileno())
+                    index.write(b"".join(records))
+                    index.flush()
+                    os.fsync(index.fileno())
+                if final is not None:
+                    data.truncate(final) # release the unused pre-allocation
+                    data.close()
+                    index.close()
+            except Exception as e:
+                self._error = e
+            finally:
+                self._syncs.task_done()
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise IOError("sync of segment log %s failed: %s" %(self.basename, error))
+
+    def roll(self):
+        """
+        close the open segment and open the next pre-allocated one
+        """
+        self._close()
+        self.segment += 1
+        path = self.path(".seg")
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.posix_fallocate(fd, 0, self.segmentSize)
+        except (AttributeError, OSError): # Python 2 or not supported by the file system
+            os.ftruncate(fd, self.segmentSize)
+        self._data = os.fdopen(fd, "r+b")
+        self._index = open(self.path(".idx"), "wb")
+        self.offset = 0
+
+    def path(self, ext):
+        """
+        return path of the open segment (.seg) or its index (.idx)
+        """
+        return "%s_%06d%s" %(self.basename, self.segment, ext)
+
+    def flush(self):
+        """
+        sync data and index to disk, e.g. at the end of a series, without waiting for it
+        """
+        self._raise()
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        """
+        close the open segment and wait until all data and index records are synced
+        """
+        with self._lock:
+            self._close()
+        self._syncs.join()
+        self._raise()
+
+    def _close(self):
+        if self._data is not None:
+            self._sync(final=True)
+            self._data = self._index = None
+
+class SegmentReader(object):
+    """
+    memory-mapped random access to the messages of a segment log
+    """
+    def __init__(self, basename, verify=False):
+        self.basename = basename
+        self.verify = verify
+        self._paths = [] # path of each segment
+        self._maps = [] # mmap of each segment
+        self._records = [] # index records of each segment
+        self._messages = {} # (series, frame): (segment, first record, number of parts)
+        for indexPath in sorted(glob.glob(basename + "_[0-9]*.idx")):
+            with open(indexPath, "rb") as f:
+                raw = f.read()
+            records = np.frombuffer(raw[:len(raw) - len(raw) % INDEXDTYPE.itemsize], INDEXDTYPE)
+            segment = len(self._maps)
+            self._paths.append(indexPath[:-len(".idx")] + ".seg")
+            with open(self._paths[-1], "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                self._maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b"")
+            self._records.append(records)
+            for first, n in self._group(records):
+                self._messages[(int(records["series"][first]), int(records["frame"][first]))] = (segment, first, n)
+
+    def __len__(self):
+        return sum(int(np.count_nonzero(records["part"] == 0)) for records in self._records)
+
+    def keys(self):
+        """
+        return (series, frame) of the messages, frame is None for header and end messages
+        """
+        return [(series, None if frame == NOFRAME else frame) for series, frame in self._messages]
+
+    def messages(self):
+        """
+        yield (series, frame, parts) of all messages in the order they were written.
+        parts are views of the mapped segments and valid until close
+        """
+        for series, frame, location in self.locations():
+            yield series, frame, self.readAt(location)
+
+    def locations(self):
+        """
+        return (series, frame, location) of all messages in the order they were written.
+        Unlike (series, None) the location also identifies the header and the end
+        message of a series, see readAt
+        """
+        locations = []
+        for segment, records in enumerate(self._records):
+            for first, n in self._group(records):
+                frame = int(records["frame"][first])
+                locations.append((int(records["series"][first]), None if frame == NOFRAME else frame, (segment, first, n)))
+        return locations
+
+    def _group(self, records):
+        """
+        yield (first record, number of parts) of the messages in records
+        """
+        starts = np.flatnonzero(records["part"] == 0)
+        for i, first in enumerate(starts):
+            end = starts[i + 1] if i + 1 < len(starts) else len(records)
+            yield int(first), int(end - first)
+
+    def read(self, series, frame=None):
+        """
+        return the parts of message (series, frame), the last header or end
+        message of the series if frame is None
+        """
+        key = (series, NOFRAME if frame is None else frame)
+        if key not in self._messages:
+            raise KeyError("no message for series %d frame %s in %s" %(series, frame, self.basename))
+        return self._parts(*self._messages[key])
+
+    def readAt(self, location):
+        """
+        return the parts of the message at location returned by locations
+        """
+        return self._parts(*location)
+
+    def _parts(self, segment, first, n):
+        parts = []
+        for record in self._records[segment][first:first + n]:
+            offset, length = int(record["offset"]), int(record["length"])
+            if PY2:
+                part = buffer(self._maps[segment], offset, length)
+            else:
+                part = memoryview(self._maps[segment])[offset:offset + length]
+            if self.verify and zlib.crc32(part) & 0xffffffff != record["crc32"]:
+                raise IOError("checksum mismatch at offset %d of %s" %(offset, self._paths[segment]))
+            parts.append(part)
+        return parts
+
+    def close(self):
+        for m in self._maps:
+            if isinstance(m, mmap.mmap):
+                try:
+                    m.close()
+                except BufferError: # parts are still referenced, the map is released with them
+                    pass
+        self._maps = []
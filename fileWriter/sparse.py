@@ -0,0 +1,179 @@
+"""
+Sparse image format for low occupancy data. Every image is stored as the
+flat indices and values of its nonzero pixels. The pixels flagged in every
+image of a series (masked and gap pixels with the maximum value of the bit
+depth) are stored once per chunk as static pixels, a static pixel is only
+stored with the image if its value differs from the flag value, so the
+images are reconstructed losslessly.
+
+The images of a series are written in chunks of CHUNKFRAMES images to
+/path/basename_<series>_sparse_000001.npz, ... with the arrays
+
+    frame     uint64   frame numbers of the images
+    offset    uint64   start of the pixels of image i in index and value, len(frame)+1
+    index     uint32   flat pixel indices
+    value     dtype    pixel values in the image data type
+    static    uint32   flat indices of the static pixels
+    flag      dtype    value of the static pixels
+    shape     int64    image shape (y, x)
+
+The SparseReader returns dense images on demand by frame number.
+This module is compatible with Python 2 and 3.
+"""
+
+import numpy as np
+import glob
+import threading
+
+__author__ = "SasG"
+__date__ = "17/05/17"
+__version__ = "0.0.1"
+__reviewer__ = ""
+
+#images per chunk file
+CHUNKFRAMES = 1000
+
+class SparseEncoder(object):
+    """
+    encode the images of a series into sparse chunks
+    """
+    def __init__(self, prefix, chunkFrames=CHUNKFRAMES, chunks=0):
+        self.prefix = prefix # /path/basename_<series>
+        self.chunkFrames = chunkFrames
+        self.chunks = chunks # number of the last chunk file
+        self.pixels = 0 # stored pixels
+        self.frames = 0 # stored images
+        self._static = None # flat indices of the static pixels
+        self._isStatic = None # boolean flat array of the static pixels
+        self._flag = None
+        self._shape = None
+        self._dtype = None
+        self._pending = [] # (frame, index, value) of the next chunk
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self._static is not None
+
+    def setup(self, shape, dtype, flag, static=None):
+        """
+        set the image shape, data type, flag value and the flat indices of the static pixels
+        """
+        self._shape = tuple(shape)
+        self._dtype = np.dtype(dtype)
+        self._flag = flag
+        self._static = np.asarray(static if static is not None else [], np.uint32)
+        self._isStatic = np.zeros(int(np.prod(shape)), bool)
+        self._isStatic[self._static] = True
+
+    def encode(self, data):
+        """
+        return flat indices and values of the pixels of image data which have to be stored
+        """
+        flat = data.reshape(-1)
+        index = np.flatnonzero(flat)
+        if self._static.size:
+            index = index[~self._isStatic[index]]
+            values = flat[self._static]
+            changed = self._static[values != self._flag]
+            if changed.size:
+                index = np.concatenate((index, changed))
+        return index.astype(np.uint32), flat[index]
+
+    def append(self, frame, data):
+        """
+        encode image data and append it to the current chunk
+        return: list of (path, arrays) of full chunks to be saved
+        """
+        index, value = self.encode(data)
+        with self._lock:
+            self._pending.append((frame, index, value))
+            self.pixels += index.size
+            self.frames += 1
+            if len(self._pending) < self.chunkFrames:
+                return []
+            return [self._take()]
+
+    def flush(self):
+        """
+        return list of (path, arrays) of the incomplete chunk
+        """
+        with self._lock:
+            return [self._take()] if self._pending else []
+
+    def _take(self):
+        pending, self._pending = self._pending, []
+        self.chunks += 1
+        frames = np.array([item[0] for item in pending], np.uint64)
+        offset = np.zeros(len(pending) + 1, np.uint64)
+        offset[1:] = np.cumsum([item[1].size for item in pending])
+        arrays = {"frame": frames, "offset": offset,
+                  "index": np.concatenate([item[1] for item in pending]),
+                  "value": np.concatenate([item[2] for item in pending]).astype(self._dtype),
+                  "static": self._static, "flag": np.array([self._flag], self._dtype),
+                  "shape": np.array(self._shape, np.int64)}
+        return "%s_sparse_%06d.npz" %(self.prefix, self.chunks), arrays
+
+def save(path, arrays):
+    """
+    write the arrays of a chunk
+    """
+    np.savez(path, **arrays)
+
+class SparseReader(object):
+    """
+    read the sparse images of a series /path/basename_<series>_sparse_*.npz
+    """
+    def __init__(self, prefix):
+        self.paths = sorted(glob.glob(prefix + "_sparse_[0-9]*.npz"))
+        if not self.paths:
+            raise IOError("[ERR] no sparse chunks %s_sparse_*.npz" %prefix)
+        self._chunks = {} # chunk number: loaded arrays
+        self._frames = {} # frame: (chunk number, position)
+        for i, path in enumerate(self.paths):
+            with np.load(path) as f:
+                for position, frame in enumerate(f["frame"]):
+                    self._frames[int(frame)] = (i, position)
+
+    def __len__(self):
+        return len(self._frames)
+
+    def frames(self):
+        """
+        return sorted list of the frame numbers
+        """
+        return sorted(self._frames)
+
+    def _chunk(self, i):
+        if i not in self._chunks:
+            with np.load(self.paths[i]) as f:
+                self._chunks = {i: dict((key, f[key]) for key in f.files)} # keep only the last chunk
+        return self._chunks[i]
+
+    def sparse(self, frame):
+        """
+        return flat indices and values of the stored pixels of frame
+        """
+        i, position = self._frames[frame]
+        chunk = self._chunk(i)
+        start, stop = chunk["offset"][position:position+2]
+        return chunk["index"][start:stop], chunk["value"][start:stop]
+
+    def read(self, frame):
+        """
+        return dense image of frame
+        """
+        i, position = self._frames[frame]
+        chunk = self._chunk(i)
+        index, value = self.sparse(frame)
+        data = np.zeros(int(np.prod(chunk["shape"])), chunk["value"].dtype)
+        data[chunk["static"]] = chunk["flag"][0]
+        data[index] = value
+        return data.reshape(tuple(chunk["shape"]))
+
+    def __iter__(self):
+        """
+        yield (frame, dense image) chunk by chunk in the stored order
+        """
+        for frame in sorted(self._frames, key=lambda frame: self._frames[frame]):
+            yield frame, self.read(frame)
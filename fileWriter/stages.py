@@ -0,0 +1,95 @@
+"""
+Processing stages applied by the FileWriter to every decoded image before
+it is passed to the writer, see FileWriter.addStage. A stage gets the
+header, image and end of series messages of the stream:
+
+    header(message)         dheader message, e.g. read the pixel mask
+    image(message, data)    decoded image, return the (processed) image data
+                            passed to the next stage and the writer, or None
+                            to drop the image. Dropped images are counted as
+                            vetoed unless the stage sets vetoes = False, e.g.
+                            if the image was merged into another one
+    end(message)            dseries_end message, e.g. save the series results
+
+Stages run in the decode/write worker threads, per series state has to be
+guarded by a lock if several workers are used.
+This module is compatible with Python 2 and 3.
+"""
+
+import numpy as np
+import threading
+
+__author__ = "SasG"
+__date__ = "17/05/17"
+__version__ = "0.0.1"
+__reviewer__ = ""
+
+class Stage(object):
+    """
+    pass through stage, inherit and overwrite header, image and end
+    """
+    vetoes = True # images dropped by image() are counted as vetoed
+
+    def header(self, message):
+        pass
+
+    def image(self, message, data):
+        return data
+
+    def end(self, message):
+        pass
+
+class ColumnTable(object):
+    """
+    growing table with one numpy array per column, e.g. per frame results of a series
+    columns: list of (name, dtype)
+    """
+    def __init__(self, columns, size=1024):
+        self.dtype = np.dtype(columns)
+        self._columns = dict((name, np.zeros(size, self.dtype[name])) for name in self.dtype.names)
+        self._n = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._n
+
+    def append(self, **values):
+        """
+        append a row given as column=value
+        """
+        with self._lock:
+            if self._n == len(self._columns[self.dtype.names[0]]):
+                for name, column in self._columns.items():
+                    self._columns[name] = np.concatenate((column, np.zeros_like(column)))
+            for name, value in values.items():
+                self._columns[name][self._n] = value
+            self._n += 1
+
+    def column(self, name):
+        return self._columns[name][:self._n]
+
+    def columns(self):
+        """
+        return dict of name: column array
+        """
+        with self._lock:
+            return dict((name, self.column(name)) for name in self.dtype.names)
+
+    def sort(self, name):
+        """
+        sort the rows by column name, e.g. by frame number
+        """
+        with self._lock:
+            order = np.argsort(self._columns[name][:self._n], kind="mergesort")
+            for key, column in self._columns.items():
+                column[:self._n] = column[:self._n][order]
+
+    def save(self, path):
+        """
+        save the columns as .npz, np.load(path)[name] returns a column
+        """
+        np.savez(path, **self.columns())
+
+    def clear(self):
+        with self._lock:
+            self._n = 0
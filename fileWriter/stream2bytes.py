@@ -25,10 +25,11 @@ class Stream2Bytes(FileWriter):
         self.__verbose__ = verbose # verbosity
         self.ftype = ".bytes" # file extension
 
-        FileWriter().__init__(basename, path, self.ftype, verbose) # filewriter init routine
+        FileWriter.__init__(self, basename, path, self.ftype, verbose) # filewriter init routine
 
         self.filename = os.path.join(path, basename) # create filename
         self.index = 0 # file index
+        self._lock = threading.Lock() # reserve file indices of concurrent workers
 
     def decodeFrames(self, frames):
         """
@@ -36,14 +37,25 @@ class Stream2Bytes(FileWriter):
         arg: frames, list of ZMQ frames
         return: file index number
         """
-        threading.Thread(target=self.__processFrames,args=(frames,)).start()
-        return
+        with self._lock: # reserve file indices before the frames are queued
+            first = self.index + 1
+            self.index += len(frames)
+            last = self.index
+        self.submit(self.__processFrames, frames, first)
+        return last
+
+    def decodeMessage(self, message):
+        """
+        write frame bytes of an already decoded message to file
+        """
+        return self.decodeFrames(message.frames)
 
-    def __processFrames(self, frames):
+    def __processFrames(self, frames, first):
         for i in range(len(frames)):
-            self.index +=1
-            filename = "{}.{:06d}".format(self.filename,self.index)
+            filename = "{}.{:06d}".format(self.filename,first+i)
+            data = frames[i].bytes
             with open(filename, "wb") as f:
-                f.write(frames[i].bytes)
+                f.write(data)
                 f.close()
-        return self.index
+            self.countWritten(len(data))
+        return first+len(frames)-1
@@ -6,7 +6,6 @@ TODO:
 """
 
 from fileWriter import FileWriter
-import threading
 import cbf
 import lz4, bitshuffle
 import numpy as np
@@ -36,38 +35,31 @@ class Stream2Cbf(FileWriter):
         self.series = 0
         self.metadata = {}
 
-        FileWriter().__init__(basename, path, self.ftype, verbose)
+        FileWriter.__init__(self, basename, path, self.ftype, verbose)
 
-    def saveConfig(self, frames):
+    def saveConfig(self, message):
         """
         save detector config as plain text
         """
-        if len(frames) == 9:
-            appendix = frames[8]
-        else:
-            appendix = None
-        self.series = json.loads(frames[0].bytes)["series"]
+        self.series = message.series
         path = os.path.join(self.path, self.basename + "_%05d_config.json" %(self.series))
-        data = json.loads(frames[1].bytes)
-        if appendix:
-            data["appendix"] = appendix.bytes
+        data = dict(message.config)
+        if message.appendix:
+            data["appendix"] = message.appendix
         self.metadata = data
         with open(path,"wb") as f:
             json.dump(data,f)
             f.close
+        self.countWritten(os.path.getsize(path))
         print "[OK] wrote %s" %path
 
-    def saveTable(self, frames, name="", ftype=".dat"):
+    def saveTable(self, data, name="", ftype=".dat"):
         """
         save pixel mask, flatfield or LUT
         """
 
         path = os.path.join(self.path, self.basename+"_%05d_%s%s" %(self.series,name,ftype))
 
-        header = json.loads(frames[0].bytes)
-        dtype = np.dtype(header["type"])
-        data = np.reshape(np.fromstring(frames[1].bytes, dtype=dtype), header["shape"][::-1])
-
         if ftype == ".dat":
             np.savetxt(path, data)
         elif ftype == ".cbf":
@@ -75,6 +67,7 @@ class Stream2Cbf(FileWriter):
         else:
             raise IOError("file type %s not known. Allowed are .cbf|.dat" %ftype)
 
+        self.countWritten(os.path.getsize(path))
         print "[OK] wrote %s" %path
 
     def saveImage(self, data, series, frame):
@@ -86,6 +79,7 @@ class Stream2Cbf(FileWriter):
             albula.DImageWriter.write(albula.DImage().fromData(data), path)
         else:
             cbf.write(path, data, header = self._createHeader(self.metadata))
+        self.countWritten(os.path.getsize(path))
         print "[OK] wrote %s" %path
         return path
 
@@ -98,41 +92,35 @@ class Stream2Cbf(FileWriter):
             header += "# %s: %s\n" %(key, value)
         return header
 
-    def __decodeHeader__(self, frames):
+    def __decodeHeader__(self, message):
         """
-        decode and process ZMQ header frames
+        decode and process ZMQ header message
         """
-        header = json.loads(frames[0].bytes)
-        if header["header_detail"]:
+        if message.header["header_detail"]:
             if self._verbose:
-                print "[OK] decode header ", header
-        if header["header_detail"] is not "none":
-            if len(frames) == 9 and self._verbose:
-                print "[*] Appendix:", frames[8].bytes
+                print "[OK] decode header ", message.header
+        if message.config:
+            if message.appendix and self._verbose:
+                print "[*] Appendix:", message.appendix
 
-            self.saveConfig(frames[0:2])
+            self.saveConfig(message)
             if self._verbose:
                 print "[OK] detector config:"
-                for key, value in json.loads(frames[1].bytes).iteritems():
+                for key, value in message.config.iteritems():
                     print "[*] ", key, value
 
-        if header["header_detail"] == "all":
-            if json.loads(frames[2].bytes)["htype"].startswith("dflatfield"):
-                threading.Thread(target=self.saveTable,args=(frames[2:4],"flatfield",".cbf")).start()
-            if json.loads(frames[4].bytes)["htype"].startswith("dpixelmask"):
-                threading.Thread(target=self.saveTable,args=(frames[4:6],"pixelmask",".cbf")).start()
-            if json.loads(frames[6].bytes)["htype"].startswith("dcountrate"):
-                threading.Thread(target=self.saveTable,args=(frames[6:8],"countrate",".dat")).start()
+        for name, fname, ftype in (("flatfield", "flatfield", ".cbf"), ("pixelmask", "pixelmask", ".cbf"), ("countrate_table", "countrate", ".dat")):
+            data = message.table(name)
+            if data is not None:
+                self.submit(self.saveTable, data, fname, ftype)
 
-    def __decodeImage__(self, frames):
+    def __decodeImage__(self, message):
         """
-        decode ZMQ image frames and save as .cbf
+        decode ZMQ image message and save as .cbf
         """
-        data = FileWriter().__decodeImage__(frames) # read back image data
-        info = json.loads(frames[1].bytes)
-        header = json.loads(frames[0].bytes)
-        if len(frames)==5:
-            self.metadata["appendix"] = frames[4].bytes
-        self.metadata["real_time"] = json.loads(frames[3].bytes)["real_time"]
-        threading.Thread(target=self.saveImage,args=(data, header["series"], header["frame"])).start()
+        data = self.readImage(message) # read back image data
+        if message.appendix:
+            self.metadata["appendix"] = message.appendix
+        self.metadata["real_time"] = message.timing["real_time"]
+        self.submit(self.saveImage, data, message.series, message.frame)
         return data
@@ -3,8 +3,13 @@ Decode EIGER ZMQ stream frames and save data as .h5.
 The h5 structure is mimicked from the default EIGER file format.
 The data arrays are stored as compressed containers according to
 NIMAGESPERFILE, the meta data is stored as standard NEXUS tree.
-Change NIMAGESPERFILE according to processing power and storge
-capacity.
+Each image is written into its slot of a preallocated container dataset
+as it arrives. Change NIMAGESPERFILE according to the desired file size.
+
+In passthrough mode bitshuffle-lz4 encoded images are not decompressed.
+The received blobs are written with direct chunk writes into datasets
+declared with the bitshuffle HDF5 filter, which gives the same data layout
+as the detector's own filewriter.
 
 DISCLAIMER:
 This code is build for demonstration purpose only. It is not meant
@@ -19,6 +24,7 @@ __version__ = "0.1.0"
 __reviewer__ = ""
 
 from fileWriter import FileWriter
+import metrics
 import threading
 import os
 import h5py
@@ -35,6 +41,9 @@ NIMAGESPERFILE = 100
 #custom filters might be applied as well
 COMPRESSION = "lzf"
 
+#h5py >= 3 writes direct chunks from any buffer, older versions require a bytes copy
+DIRECTBUFFER = int(h5py.__version__.split(".")[0]) >= 3
+
 # nodes mapping table: {node : {entry:/nexus/path, attr: {key:val, key2:val2}}}
 # todo: implement key dtype
 NXNODES = {     "entry" : {"entry" : "entry", "attrs" : {'NX_class': 'NXentry'}},
@@ -139,22 +148,26 @@ class Stream2Hdf(FileWriter):
     """
     h5 file writer class, extends FileFriwter
     """
-    def __init__(self, basename, path, verbose=False):
+    def __init__(self, basename, path, verbose=False, passthrough=False):
         """
         create Stream2Hdf instance.
         args:
             basename:   file basename
             path:       file path
             verbose:    verbosity
+            passthrough: write bitshuffle-lz4 encoded images without decompression
         """
         self.basename = basename # file basename
         self.path = path # file path
         self.ftype = ".h5" # file extension
 
         self._verbose = verbose # verbosity
-        FileWriter().__init__(self.basename, path, self.ftype, verbose) # FileWrite init procedure
+        FileWriter.__init__(self, self.basename, path, self.ftype, verbose) # FileWrite init procedure
 
         self.nimagesPerFile = NIMAGESPERFILE # images per h5 container. adapt this value according to memory and cpu capaciy.
+        self.passthrough = passthrough # write bslz4 blobs as direct chunks
+        self.__lock__ = threading.Lock() # serialize writes to the open container
+        self.__writeTime__ = metrics.registry.histogram("eiger_stream_hdf_append_seconds", "latency of appending an image to the HDF5 container")
 
         self.__initParams__()
 
@@ -166,24 +179,26 @@ class Stream2Hdf(FileWriter):
         self.__frameID__ = [] # frame id array
         self.__nimages__ = 0 # number of collected images in series
         self.__imageIndex__ = 0 # image container id
-        self.__dataBuffer__ = [] # data buffer which stores image data arrays
+        self.__nexpected__ = 0 # number of expected images nimages*ntrigger, 0 if unknown
+        self.__dataFile__ = None # (h5py file, dataset name, file name) of the open container
+        self.__dataset__ = None # open container dataset
+        self.__containerImages__ = 0 # number of images written to the open container
         self.__startTime__ = None # start time of acquisition
         self.master = None # master file name. Is created when receiving a dheader message
+        self.__masterFile__ = None # h5py handle of the master file, open until end of series
 
-    def __createMaster__(self, frames):
+    def __createMaster__(self, message):
         """
-        create master hdf file from a dheader frame.
+        create master hdf file from a dheader message.
         name structure: /path/basename_seriesId_master.h5
-        arg: dheader frames
+        arg: dheader message
         return: master filename
         """
-
-        header = json.loads(frames[0].bytes) # header dict
-
+        self.__closeData__() # close container of a previous, unfinished series
+        self.__closeMaster__()
         self.__imageIndex__ = 0 # reset image index
         self.__nimages__ = 0 # reset number of collected images
-        self.__dataBuffer__ = [] # reset data buffer
-        self.__series__ = header["series"] # series id
+        self.__series__ = message.series # series id
         self.__frameID__ = [] # frame ID array
         self.__startTime__ = datetime.now()
 
@@ -191,181 +206,250 @@ class Stream2Hdf(FileWriter):
         # build master filename /path/fname_<series_ID>_master.h5
         self.master = os.path.join(self.path,self.basename+"_{}_master{}".format(self.__series__,self.ftype))
 
-        # write master file with empty group entries, set NX attributes
-        with h5py.File(self.master, "w", libver='earliest') as f:
-            for key, entry in NXNODES.iteritems():
-                try:
-                    group = f.create_group(entry["entry"])
-                except ValueError: # group already exists
-                    group = f[entry["entry"]]
-                for attr, v in entry["attrs"].iteritems():
-                    group.attrs.create(attr,v)
-            print "[OK] wrote %s" %self.master
-            f.close()
+        # write master file with empty group entries, set NX attributes.
+        # the file stays open until the end of series
+        f = h5py.File(self.master, "w", libver='earliest')
+        for key, entry in NXNODES.iteritems():
+            try:
+                group = f.create_group(entry["entry"])
+            except ValueError: # group already exists
+                group = f[entry["entry"]]
+            for attr, v in entry["attrs"].iteritems():
+                group.attrs.create(attr,v)
+        self.__masterFile__ = f
+        print "[OK] created %s" %self.master
 
         return self.master
 
-    def __writeConfig__(self, frame):
+    def __closeMaster__(self):
         """
-        write config entries from the header frames to the master file.
-        arg: frame (zmq config frame)
+        close master file handle
+        return: master filename
+        """
+        if self.__masterFile__ is None:
+            return None
+        self.__masterFile__.close()
+        self.__masterFile__ = None
+        self.countWritten(os.path.getsize(self.master))
+        print "[OK] wrote %s" %self.master
+        return self.master
+
+    def __writeConfig__(self, data):
+        """
+        write config entries from the header message to the master file.
+        arg: data (detector config dict)
         return: number of written config params
         """
-        data = json.loads(frame.bytes)
 
-        with h5py.File(self.master, "a", libver='earliest') as f:
-            for key, value in data.iteritems():
-                self.__setParam__(f, key, value)
+        self.__nexpected__ = data.get("nimages", 0) * data.get("ntrigger", 1)
+
+        f = self.__masterFile__
+        for key, value in data.iteritems():
+            self.__setParam__(f, key, value)
 
+        if self.passthrough:
+            self.__setParam__(f, "compression", "bslz4") # set compression used in h5py
+        else:
             self.__setParam__(f, "compression", str(COMPRESSION)) # set compression used in h5py
-            f.close()
-            print "[OK] wrote %d parameters to %s" %(len(data)+1, self.master)
+        print "[OK] wrote %d parameters to %s" %(len(data)+1, self.master)
 
         return len(data)
 
-    def __writeCorrection__(self, frames):
+    def __writeCorrection__(self, message, name):
         """
         decode and write flatfiled, pixel mask, or lut to master .h5 file.
         args:
-            frames: info and data blob zmq frames
+            message: dheader message
+            name: table name, flatfield|pixelmask|countrate_table
         returns: data numpy array
         """
-        htypes = {"dflatfield-1.0":"flatfield", "dpixelmask-1.0":"pixel_mask", "dcountrate_table-1.0":"countrate_correction_table"}
-        header = json.loads(frames[0].bytes) # header dict
-        key = htypes[header["htype"]] # get correction type name
-
-        dtype = np.dtype(header["type"]) # data type
-        data = np.reshape(np.fromstring(frames[1].bytes, dtype=dtype), header["shape"][::-1]) # decode data
+        keys = {"flatfield":"flatfield", "pixelmask":"pixel_mask", "countrate_table":"countrate_correction_table"}
+        key = keys[name] # get correction type name
+        data = message.table(name) # decode data
+        if data is None:
+            return None
 
-        with h5py.File(self.master, "a", libver='earliest') as f:
-                self.__setParam__(f, key, data)
-                f.close()
+        self.__setParam__(self.__masterFile__, key, data)
 
         return data
 
-    def __appendData__(self, data=None):
+    def __appendData__(self, data, shape, dtype):
         """
-        append data array to data buffer and write data buffer to file
-        if image numbers exceeds self.nimagesPerFile.
-        args: data, 3 dimensional np.array
+        write image into the next slot of the open data container. A new container
+        is opened if none is open, the container is closed when it is full.
+        args:
+            data: 2 dimensional np.array or blob frame in passthrough mode
+            shape: image shape (y, x)
+            dtype: image data type
         """
-        # append data to data buffer stack
-        if data is not None:
-            # append data to buffer
-            self.__dataBuffer__.append(data)
+        with self.__lock__, self.__writeTime__.time():
+            if self.__dataset__ is None:
+                self.__openData__(shape, dtype)
+
+            index = self.__containerImages__
+            if index >= self.__dataset__.shape[0]: # container size unknown, grow in large steps
+                self.__dataset__.resize(index + self.nimagesPerFile, axis=0)
+
+            if isinstance(data, np.ndarray):
+                self.__dataset__[index] = data
+            else: # passthrough blob
+                self.__dataset__.id.write_direct_chunk((index, 0, 0), data.buffer if DIRECTBUFFER else data.bytes)
+            self.__containerImages__ += 1
             self.__nimages__ += 1
 
-        # check if container must be written
-        if len(self.__dataBuffer__) >= self.nimagesPerFile:
-            threading.Thread(target=self.__writeData__,args=(self.__dataBuffer__,)).start()
-            self.__dataBuffer__ = []
+            if self.__containerImages__ >= self.nimagesPerFile:
+                self.__closeData__()
 
-    def __writeData__(self, data):
+    def __openData__(self, shape, dtype):
         """
-        write data buffer to h5 container file and link container to master file.
-        return: data file name
-
-        TODO: implement better compression: compression=bitshuffle.h5.H5FILTER,
-                                            compression_opts=(block_size = 8, bitshuffle.h5.H5_COMPRESS_LZ4))
+        create data container file with a preallocated /entry/data/data dataset.
+        The dataset holds self.nimagesPerFile images or the number of remaining images
+        of the series if known from the header config.
+        args:
+            shape: image shape (y, x)
+            dtype: image data type
+        return: h5py dataset
         """
-        #pack data to container
-        if data:
-            self.__imageIndex__ += 1 # increment data file index
-            dname = "data_{:06d}".format(self.__imageIndex__) # data file basename
-            dfile = self.basename+"_{}_{}{}".format(self.__series__,dname,self.ftype) # data file name
-            filePath = os.path.join(self.path, dfile) # data file path
-
-            # write data file
-            with h5py.File(filePath, "w", libver='earliest') as f:
-                    data = np.vstack(data)
-                    dset = f.create_dataset("/entry/data/data", data=data, chunks=(1,) + data.shape[-2:], compression=COMPRESSION)
-
-                    f["entry"].attrs.create('NX_class', 'NXentry')
-                    f["entry/data"].attrs.create('NX_class','NXdata')
-                    dset.attrs.create("image_nr_high", np.shape(data)[0], dtype="int32")
-                    dset.attrs.create("image_nr_low", 1, dtype="int32")
-                    f.close()
-                    print "[OK] wrote %s" %filePath
-
-            # link data container to master file if exists and set bitdepth entry
-            if self.master:
-                with h5py.File(self.master, "a", libver='earliest') as f:
+        self.__imageIndex__ += 1 # increment data file index
+        dname = "data_{:06d}".format(self.__imageIndex__) # data file basename
+        dfile = self.basename+"_{}_{}{}".format(self.__series__,dname,self.ftype) # data file name
+        filePath = os.path.join(self.path, dfile) # data file path
+
+        nimages = self.nimagesPerFile
+        if self.__nexpected__ > self.__nimages__:
+            nimages = min(nimages, self.__nexpected__ - self.__nimages__)
+
+        if self.passthrough:
+            compression = {"compression": bitshuffle.h5.H5FILTER,
+                           "compression_opts": (0, bitshuffle.h5.H5_COMPRESS_LZ4)}
+        else:
+            compression = {"compression": COMPRESSION}
 
-                    f["/entry/data/"+dname] = h5py.ExternalLink(dfile, "/entry/data/data/")
-                    f["/entry/data"].attrs.create("NX_class", "NXdata")
-                    f["/entry"].attrs.create("NX_class", "NXentry")
-                    self.__setParam__(f, "bit_depth_image", data.dtype.itemsize * 8) # set bit depth
-                    f.close()
+        f = h5py.File(filePath, "w", libver='earliest')
+        self.__dataset__ = f.create_dataset("/entry/data/data", shape=(nimages,) + tuple(shape), maxshape=(None,) + tuple(shape),
+                                            dtype=dtype, chunks=(1,) + tuple(shape), **compression)
+        f["entry"].attrs.create('NX_class', 'NXentry')
+        f["entry/data"].attrs.create('NX_class','NXdata')
 
-            return dfile
+        self.__dataFile__ = (f, dname, dfile)
+        self.__containerImages__ = 0
+        return self.__dataset__
 
-        else:
+    def __closeData__(self):
+        """
+        shrink data container to the number of written images, close it
+        and link container to master file.
+        return: data file name
+        """
+        if self.__dataset__ is None:
             return None # return None if no data file was written
 
-    def __decodeImage__(self, frames):
+        f, dname, dfile = self.__dataFile__
+        dset = self.__dataset__
+        if dset.shape[0] != self.__containerImages__:
+            dset.resize(self.__containerImages__, axis=0)
+        low = self.__nimages__ - self.__containerImages__ + 1
+        dset.attrs.create("image_nr_high", low + self.__containerImages__ - 1, dtype="int32")
+        dset.attrs.create("image_nr_low", low, dtype="int32")
+        bitDepth = dset.dtype.itemsize * 8
+        f.close()
+        self.countWritten(os.path.getsize(os.path.join(self.path, dfile)))
+        print "[OK] wrote %s" %os.path.join(self.path, dfile)
+
+        self.__dataset__ = None
+        self.__dataFile__ = None
+
+        # link data container to master file if exists and set bitdepth entry
+        if self.__masterFile__:
+            f = self.__masterFile__
+            f["/entry/data/"+dname] = h5py.ExternalLink(dfile, "/entry/data/data/")
+            if self.__imageIndex__ == 1:
+                self.__setParam__(f, "bit_depth_image", bitDepth) # set bit depth
+
+        return dfile
+
+    def __decodeImage__(self, message):
         """
-        decode ZMQ image frames and pass np array to the write function.
-        args: frames, image info and data blob frames
+        decode ZMQ image message and pass np array to the write function.
+        args: message, image message
         return: np data array
         """
-        data = FileWriter().__decodeImage__(frames) # read back image data
+        if self.passthrough and "bs" in message.info["encoding"]:
+            data = None # keep compressed blob
+        else:
+            data = self.readImage(message) # read back image data
 
-        if len(frames)==5 and self._verbose: # image appendix.
+        if message.appendix and self._verbose: # image appendix.
             # TODO: maybe append to nexus tree. Discuss with AndF.
-            print "[*] appendix: %s\n" %frames[4].bytes
-
-        header = json.loads(frames[0].bytes)
+            print "[*] appendix: %s\n" %message.appendix
 
         if not self.__series__: # if series id not given e.g. if arm was not detected
-            self.__series__ = header["series"]
+            self.__series__ = message.series
 
-        self.__frameID__.append(header["frame"])
+        self.__frameID__.append(message.frame)
 
-        self.__appendData__(data=np.array(data,ndmin=3)) # handle data, must be 3 dim
+        if data is None:
+            shape = tuple(message.info["shape"][::-1])
+            self.__appendData__(message.data, shape, np.dtype(message.info["type"])) # handle compressed blob
+        else:
+            self.__appendData__(data, data.shape, data.dtype) # handle data, e.g. cropped to a ROI
         return data
 
-    def __decodeHeader__(self, frames):
+    def __decodeHeader__(self, message):
         """
-        decode and process ZMQ header frames and pass framses to corresponding module, either
+        decode and process ZMQ header message and pass it to corresponding module, either
         createMaster, writeConfig or writeCorrection.
-        arg: frames, ZMQ header message frames
+        arg: message, ZMQ header message
         return: True/False
         """
-        header = json.loads(frames[0].bytes) #header dict
-
-        if header["header_detail"]:
+        if message.header["header_detail"]:
             if self._verbose:
-                print "[OK]received header ", header
-            self.__createMaster__(frames)
-            if header["header_detail"] is not "none":
-                self.__writeConfig__(frames[1])
-            if header["header_detail"] == "all":
-                self.__writeCorrection__(frames[2:4]) # flatfield
-                self.__writeCorrection__(frames[4:6]) # pixelmask
-                self.__writeCorrection__(frames[6:8]) # countrate_correction_table
-            if len(frames) == 9:
+                print "[OK]received header ", message.header
+            self.__createMaster__(message)
+            if message.config:
+                self.__writeConfig__(message.config)
+            for name in ("flatfield", "pixelmask", "countrate_table"):
+                if name in message.tables:
+                    self.__writeCorrection__(message, name)
+            if message.appendix:
                 if self._verbose:
-                    print "[*] Appendix: ", json.loads(frames[8].bytes) #TODO discuss how to handle appendix
+                    print "[*] Appendix: ", message.appendix #TODO discuss how to handle appendix
             return True
         else:
             print "[WARNING] Could not decode dheader frames"
             return False
 
-    def __decodeEndOfSeries__(self, frames):
+    def __decodeEndOfSeries__(self, message):
         """
         Decode end of series message and write down image buffer.
-        args: frames, ZMQ EndOfSeries Frame(s)
+        args: message, ZMQ EndOfSeries message
         return: True
         """
-        FileWriter().__decodeEndOfSeries__(frames)
-        self.__writeData__(self.__dataBuffer__) # write image buffer
+        FileWriter.__decodeEndOfSeries__(self, message)
+        with self.__lock__:
+            self.__closeData__() # close open data container
         self.__calcAngles__()  # calculate and write goniometer angles
+        self.__closeMaster__()
 
         print self.__getStatistics__() # print series statistics
         self.__initParams__() # reset variables
 
         return True
 
+    def close(self):
+        """
+        close the data container and master file of an unfinished series,
+        e.g. on interrupt before the end of series message
+        """
+        with self.__lock__:
+            self.__closeData__() # shrink and link open data container
+        if self.__masterFile__ is None:
+            return
+        self.__calcAngles__()
+        self.__closeMaster__()
+        print self.__getStatistics__()
+        self.__initParams__()
+
     def __getStatistics__(self):
         """
         print statistic message including number of decoded images.
@@ -399,34 +483,33 @@ class Stream2Hdf(FileWriter):
         angle, angle_end, angle_range_total into master file. Call this method at end
         of series. Assumption: all images were received, none dropped.
         """
-        if self.master:
+        if self.__masterFile__:
+            f = self.__masterFile__
             for angle in ["chi","kappa","omega","phi","two_theta"]:
                 try:
-                    with h5py.File(self.master, "a", libver='earliest') as f:
-                        # calculate angles
-                        start = f[PARAMTABLE[angle + "_start"]["entry"]].value
-                        increment = f[PARAMTABLE[angle + "_increment"]["entry"]].value
-                        if self.__frameID__:
-                            data = start + np.multiply(self.__frameID__, increment)
-                        else:
-                            data = [start]
-                        data_end = start + increment
-
-                        # write params to h5
-                        self.__setParam__(f, angle, data)
-                        self.__setParam__(f, angle+"_end", data_end)
-                        self.__setParam__(f, angle+"_range_total", data[-1]-data[0])
-                        self.__setParam__(f, angle+"_range_average", increment)
-
-                        # delete not used parameters from h5
-                        self.__delParam__(f, angle+"_start")
-                        self.__delParam__(f, angle+"_increment")
-
-                        if self._verbose:
-                            print "[OK] angle: %s, start: %f, end: %f, n: %d" %(angle, start, data[-1], self.__nimages__)
-                        f.close()
+                    # calculate angles
+                    start = f[PARAMTABLE[angle + "_start"]["entry"]][()]
+                    increment = f[PARAMTABLE[angle + "_increment"]["entry"]][()]
+                    if self.__frameID__:
+                        data = start + np.multiply(self.__frameID__, increment)
+                    else:
+                        data = [start]
+                    data_end = start + increment
+
+                    # write params to h5
+                    self.__setParam__(f, angle, data)
+                    self.__setParam__(f, angle+"_end", data_end)
+                    self.__setParam__(f, angle+"_range_total", data[-1]-data[0])
+                    self.__setParam__(f, angle+"_range_average", increment)
+
+                    # delete not used parameters from h5
+                    self.__delParam__(f, angle+"_start")
+                    self.__delParam__(f, angle+"_increment")
+
+                    if self._verbose:
+                        print "[OK] angle: %s, start: %f, end: %f, n: %d" %(angle, start, data[-1], self.__nimages__)
                 except Exception as e:
-                    print "[ERROR] %s" %s
+                    print "[ERROR] %s" %e
 
     def __setParam__(self, filehandler, key, data):
         """
@@ -2,6 +2,7 @@
 
 """
 from __future__ import print_function
+from fileWriter import StreamMessage
 import json
 import os
 import datetime
@@ -35,20 +36,37 @@ class Stream2Log():
 
         print("[OK] write timing information from stream to %s" %fname)
 
-        logger.addHandler(logging.FileHandler(fname, 'a'))
+        self._handler = logging.FileHandler(fname, 'a')
+        logger.addHandler(self._handler)
+
+    def close(self):
+        """
+        close the log file
+        """
+        logger.removeHandler(self._handler)
+        self._handler.close()
 
     def decodeFrames(self, frames):
         """
         decode and proces EIGER ZMQ stream frames
         """
         try:
-            header = json.loads(frames[0].bytes)
-            if header["htype"].startswith("dheader-"):
-                self._decodeHeader(frames)
-            elif header["htype"].startswith("dimage-"):
-                self._decodeImage(frames)
-            elif header["htype"].startswith("dseries_end"):
-                self._decodeEndOfSeries(frames)
+            return self.decodeMessage(StreamMessage(frames))
+        except Exception as e:
+            print(e)
+            return False
+
+    def decodeMessage(self, message):
+        """
+        process decoded EIGER ZMQ stream message
+        """
+        try:
+            if message.htype.startswith("dheader-"):
+                self._decodeHeader(message)
+            elif message.htype.startswith("dimage-"):
+                self._decodeImage(message)
+            elif message.htype.startswith("dseries_end"):
+                self._decodeEndOfSeries(message)
             else:
                 raise IOError("[ERR] not an EIGER ZMQ message")
         except Exception as e:
@@ -57,44 +75,40 @@ class Stream2Log():
 
         return True
 
-    def _decodeImage(self, frames):
+    def _decodeImage(self, message):
         """
-        decode time parameters from ZMQ image frames
+        decode time parameters from ZMQ image message
         """
-        info = json.loads(frames[0].bytes)
-        config = json.loads(frames[3].bytes)
         print("[%s] image info:" % self._getTimeStamp())
-        print("\t %s" %info)
-        print("\t %s" %config)
+        print("\t %s" %message.header)
+        print("\t %s" %message.timing)
 
-        return config
+        return message.timing
 
-    def _decodeEndOfSeries(self, frames):
-        series = json.loads(frames[0].bytes)["series"]
-        print("[%s] end of series %s" %(self._getTimeStamp(),series))
+    def _decodeEndOfSeries(self, message):
+        print("[%s] end of series %s" %(self._getTimeStamp(),message.series))
         return True
 
-    def _decodeHeader(self, frames):
+    def _decodeHeader(self, message):
         """
-        decode and process ZMQ header frames
+        decode and process ZMQ header message
         """
-        header = json.loads(frames[0].bytes)
-        if header["header_detail"]:
-            print("[%s] start series %s" %(self._getTimeStamp(),header["series"]))
-        if self._verbose and header["header_detail"] is not "none":
+        if message.header["header_detail"]:
+            print("[%s] start series %s" %(self._getTimeStamp(),message.series))
+        if self._verbose and message.config:
             print("[OK] detector config")
-            for key, value in json.loads(frames[1].bytes).iteritems():
+            for key, value in message.config.iteritems():
                 print("\t %s: %s" %(key, value))
-        if self._verbose and header["header_detail"] == "all":
-            if json.loads(frames[2].bytes)["htype"].startswith("dflatfield"):
+        if self._verbose:
+            if "flatfield" in message.tables:
                 print("[*] received flatfield")
-            if json.loads(frames[4].bytes)["htype"].startswith("dpixelmask"):
+            if "pixelmask" in message.tables:
                 print("[*] received pixel mask")
-            if json.loads(frames[6].bytes)["htype"].startswith("dcountrate"):
+            if "countrate_table" in message.tables:
                 print("[*] received LUT")
-        if len(frames) == 9:
+        if message.appendix:
             if self._verbose:
-                print("[*] received appendix: %s" %json.loads(frames[8].bytes))
+                print("[*] received appendix: %s" %message.appendix)
 
     def _getTimeStamp(self):
         return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
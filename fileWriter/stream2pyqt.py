@@ -25,7 +25,7 @@ class Stream2PyQT(FileWriter):
         self.series = 0
         self.metadata = {}
         self.data = np.zeros((1000,1000))
-        FileWriter().__init__(basename, path, self.ftype, verbose)
+        FileWriter.__init__(self, basename, path, self.ftype, verbose)
         threading.Thread(target=self.openViewer()).start()
 
     def openViewer(self):
@@ -50,33 +50,28 @@ class Stream2PyQT(FileWriter):
     def updateImage(self):
         self.imv.setImage(self.data)
 
-    def saveConfig(self, frames, appendix=None):
+    def saveConfig(self, message):
         """
         save detector config as plain text
         """
-        self.series = json.loads(frames[0].bytes)["series"]
+        self.series = message.series
         path = os.path.join(self.path, self.basename + "_%05d_config.json" %(self.series))
-        data = json.loads(frames[1].bytes)
-        if appendix:
-            data["appendix"] = appendix.bytes
+        data = dict(message.config)
+        if message.appendix:
+            data["appendix"] = message.appendix
         self.metadata = data
         with open(path,"wb") as f:
             json.dump(data,f)
             f.close()
         print "[OK] wrote %s" %path
 
-    def saveTable(self, frames, name="", ftype=".dat"):
+    def saveTable(self, data, name="", ftype=".dat"):
         """
         save pixel mask, flatfield or LUT
         """
 
         path = os.path.join(self.path, self.basename+"_%05d_%s%s" %(self.series,name,ftype))
 
-        header = json.loads(frames[0].bytes)
-        dtype = np.dtype(header["type"])
-
-        data = np.reshape(np.fromstring(frames[1].bytes, dtype=dtype), header["shape"][::-1])
-
         if ftype == ".dat":
             np.savetxt(path, data)
         elif ftype == ".tif" or ftype == ".tiff":
@@ -94,43 +89,34 @@ class Stream2PyQT(FileWriter):
             print "[OK] got image s%05d_f%05d" %(series, frame)
         self.data = data
 
-    def __decodeHeader__(self, frames):
+    def __decodeHeader__(self, message):
         """
-        decode and process ZMQ header frames
+        decode and process ZMQ header message
         """
-
-        header = json.loads(frames[0].bytes)
-        if header["header_detail"]:
+        if message.header["header_detail"]:
             if self._verbose:
-                print "[OK] decode header ", header
-        if header["header_detail"] is not "none":
-            if len(frames) == 9:
-                if self._verbose:
-                    print "Appendix:", frames[8].bytes
-                self.saveConfig(frames[0:2],frames[8])
-            else:
-                self.saveConfig(frames[0:2])
+                print "[OK] decode header ", message.header
+        if message.config:
+            if message.appendix and self._verbose:
+                print "Appendix:", message.appendix
+            self.saveConfig(message)
             if self._verbose:
                 print "[OK] detector config:"
-                for key, value in json.loads(frames[1].bytes).iteritems():
+                for key, value in message.config.iteritems():
                     print "[*]" , key, value
-        if header["header_detail"] == "all":
-            if json.loads(frames[2].bytes)["htype"].startswith("dflatfield"):
-                threading.Thread(target=self.saveTable,args=(frames[2:4],"flatfield",".tif")).start()
-            if json.loads(frames[4].bytes)["htype"].startswith("dpixelmask"):
-                threading.Thread(target=self.saveTable,args=(frames[4:6],"pixelmask",".tif")).start()
-            if json.loads(frames[6].bytes)["htype"].startswith("dcountrate"):
-                threading.Thread(target=self.saveTable,args=(frames[6:8],"countrate",".dat")).start()
-
-    def __decodeImage__(self, frames):
+        for name, fname, ftype in (("flatfield", "flatfield", ".tif"), ("pixelmask", "pixelmask", ".tif"), ("countrate_table", "countrate", ".dat")):
+            data = message.table(name)
+            if data is not None:
+                self.submit(self.saveTable, data, fname, ftype)
+
+    def __decodeImage__(self, message):
         """
-        decode ZMQ image frames and save as .tif
+        decode ZMQ image message and display it
         """
-        header = json.loads(frames[0].bytes)
-        data = FileWriter().__decodeImage__(frames) # read back image data
+        data = self.readImage(message) # read back image data
 
-        if len(frames)==5:
-            self.metadata["appendix"] = frames[4].bytes
-        self.metadata["real_time"] = json.loads(frames[3].bytes)["real_time"]
-        threading.Thread(target=self.displayImage,args=(data, header["series"], header["frame"])).start()
+        if message.appendix:
+            self.metadata["appendix"] = message.appendix
+        self.metadata["real_time"] = message.timing["real_time"]
+        self.submit(self.displayImage, data, message.series, message.frame)
         return data
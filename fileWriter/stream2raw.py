@@ -3,7 +3,6 @@ write bytes of zmq frames to .json without decoding contents.
 """
 
 from fileWriter import FileWriter
-import threading
 import numpy as np
 import json
 import os
@@ -20,51 +19,52 @@ class Stream2Raw(FileWriter):
         self.__verbose__ = verbose
         self.ftype = ".raw"
 
-        FileWriter().__init__(basename, path, self.ftype, verbose)
+        FileWriter.__init__(self, basename, path, self.ftype, verbose)
 
-    def frames2raw(self,frames):
+    def frames2raw(self,message):
         """
         write frame bytes to file
         """
-        header = json.loads(frames[0].bytes)
-        fname = "%s_%s_%05d" %(self.basename,header["htype"],header["series"])
-        if "frame" in header.keys(): # add frame id
-            fname += "_%05d" %header["frame"]
+        frames = message.frames
+        fname = "%s_%s_%05d" %(self.basename,message.htype,message.series)
+        if message.frame is not None: # add frame id
+            fname += "_%05d" %message.frame
 
         for i in range(len(frames)):
             path = os.path.join(self.path, fname + "_ZMQframe%05d%s" %(i, self.ftype))
+            data = frames[i].bytes
             with open(path, "wb") as f:
-                f.write(frames[i].bytes)
+                f.write(data)
                 f.close()
                 print "[OK] wrote file %s" %path
+            self.countWritten(len(data))
 
-    def __decodeHeader__(self, frames):
+    def __decodeHeader__(self, message):
         """
-        decode and process ZMQ header frames
+        decode and process ZMQ header message
         """
-        header = json.loads(frames[0].bytes)
-        if header["header_detail"] and self.__verbose__:
-            print "[OK] decode header ", header
-        if header["header_detail"] is not "none":
+        if message.header["header_detail"] and self.__verbose__:
+            print "[OK] decode header ", message.header
+        if message.config:
             if self.__verbose__:
                 print "[OK] detector config:"
-                for key, value in json.loads(frames[1].bytes).iteritems():
+                for key, value in message.config.iteritems():
                     print "[*] ", key, value
-        if len(frames) == 9:
+        if message.appendix:
             if self.__verbose__:
-                print "Appendix:", frames[8].bytes
-        threading.Thread(target=self.frames2raw,args=(frames,)).start()
+                print "Appendix:", message.appendix
+        self.submit(self.frames2raw, message)
 
 
-    def __decodeEndOfSeries__(self, frames):
+    def __decodeEndOfSeries__(self, message):
         if self.__verbose__:
-            print "[OK] decode end of series ", json.loads(frames[0].bytes)
-        threading.Thread(target=self.frames2raw,args=(frames,)).start()
+            print "[OK] decode end of series ", message.header
+        self.submit(self.frames2raw, message)
 
-    def __decodeImage__(self, frames):
+    def __decodeImage__(self, message):
         """
-        decode ZMQ image frames
+        decode ZMQ image message
         """
         if self.__verbose__:
             print "[OK] decode image"
-        threading.Thread(target=self.frames2raw,args=(frames,)).start()
+        self.submit(self.frames2raw, message)
@@ -0,0 +1,70 @@
+"""
+Append received ZMQ messages without decoding to a segment log
+/path/basename_000001.seg with its index /path/basename_000001.idx.
+Large pre-allocated segments replace the one file per ZMQ frame of
+Stream2Bytes and Stream2Raw, see segmentLog.py for the format and reader.
+The messages are appended synchronously by the calling thread, the pipelines
+call the writer on their receiving thread so the log keeps the stream order.
+The fsyncs of the log run on its own sync thread and do not stall receiving.
+
+DISCLAIMER:
+This code is build for demonstration pupose only. It is not meant
+to be productive, nor efficient or complete.
+
+If you have any questions regarding the implementation of
+the EIGER stream interface, please contact support@dectris.com.
+"""
+from fileWriter import FileWriter, StreamMessage
+from segmentLog import SegmentWriter
+import os
+
+__author__ = "SasG"
+__date__ = "17/05/17"
+__version__ = "0.0.1"
+__reviewer__ = ""
+
+class Stream2Seg(FileWriter):
+    undecoded = True # append on the receiving thread in stream order
+
+    def __init__(self, basename, path, verbose=False):
+        self.basename = basename # file basename
+        self.path = path # file path
+        self.__verbose__ = verbose # verbosity
+        self.ftype = ".seg" # file extension
+
+        FileWriter.__init__(self, basename, path, self.ftype, verbose) # filewriter init routine
+
+        self.log = SegmentWriter(os.path.join(path, basename))
+
+    def decodeFrames(self, frames):
+        """
+        append the frames of a message to the segment log
+        arg: frames, list of ZMQ frames
+        """
+        try:
+            message = StreamMessage(frames)
+        except Exception as e:
+            print "[ERR] decoding header: %s" %str(e)
+            return False
+        return self.decodeMessage(message)
+
+    def decodeMessage(self, message):
+        """
+        append the frames of an already decoded message to the segment log
+        """
+        self._countSeries(message)
+        self.__append(message)
+        return True
+
+    def __append(self, message):
+        written = self.log.written
+        segment, offset = self.log.append(message.series or 0, message.frame, message.frames)
+        self.countWritten(self.log.written - written)
+        if message.htype.startswith("dseries_end"):
+            self.log.flush()
+            if self.__verbose__:
+                print "[OK] wrote %d bytes to %s" %(self.log.written, self.log.path(self.ftype))
+        return segment, offset
+
+    def close(self):
+        self.log.close()
@@ -0,0 +1,103 @@
+"""
+Save the images as sparse pixel lists /path/basename_SERIES_sparse_000001.npz,
+see sparse.py for the format and the SparseReader. The images are encoded
+with np.flatnonzero in the decode workers, the chunks of CHUNKFRAMES images
+are saved by the writer pool.
+
+DISCLAIMER:
+This code is build for demonstration pupose only. It is not meant
+to be productive, nor efficient or complete.
+
+If you have any questions regarding the implementation of
+the EIGER stream interface, please contact support@dectris.com.
+"""
+from fileWriter import FileWriter
+from sparse import SparseEncoder, CHUNKFRAMES, save
+import numpy as np
+import os
+import threading
+
+__author__ = "SasG"
+__date__ = "17/05/17"
+__version__ = "0.0.1"
+__reviewer__ = ""
+
+class Stream2Sparse(FileWriter):
+    def __init__(self, basename, path, verbose=False, chunkFrames=CHUNKFRAMES):
+        self.basename = basename # file basename
+        self.path = path # file path
+        self.ftype = ".sparse" # file extension
+        self.chunkFrames = chunkFrames # images per chunk file
+
+        FileWriter.__init__(self, basename, path, self.ftype, verbose) # filewriter init routine
+
+        self._encoder = None # SparseEncoder of the current series
+        self._chunks = {} # prefix: number of the last chunk file, continued by later encoders
+        self._bitDepth = None # image bit depth of the config, None if unknown
+        self._lock = threading.Lock()
+
+    def __decodeHeader__(self, message):
+        """
+        start a new series, the static pixels are set up with its first image
+        """
+        self.__decodeEndOfSeries__(message)
+        config = message.config or {}
+        self._bitDepth = config.get("bit_depth_image")
+        with self._lock:
+            self._encoder = self.__encoder(message)
+
+    def __encoder(self, message):
+        prefix = os.path.join(self.path, self.basename + "_%05d" %(message.series or 0))
+        return SparseEncoder(prefix, self.chunkFrames, self._chunks.get(prefix, 0))
+
+    def encoder(self, message, data):
+        """
+        return the encoder of the series, set up with the first image:
+        its flagged pixels (gaps, masked pixels) are the static pixels of the series
+        """
+        with self._lock:
+            if self._encoder is None: # no header received
+                self._encoder = self.__encoder(message)
+            encoder = self._encoder
+            if not encoder.ready:
+                static = None
+                if data.dtype.kind in "ui":
+                    flag = np.iinfo(data.dtype).max
+                    if self._bitDepth and self._bitDepth < data.dtype.itemsize * 8:
+                        flag = (1 << self._bitDepth) - 1
+                    static = np.flatnonzero(data.reshape(-1) == flag)
+                else:
+                    flag = 0
+                encoder.setup(data.shape, data.dtype, flag, static)
+        return encoder
+
+    def __decodeImage__(self, message):
+        """
+        encode the image and save full chunks
+        """
+        data = self.readImage(message)
+        for path, arrays in self.encoder(message, data).append(message.frame, data):
+            self.submit(self.__save, path, arrays)
+        return data
+
+    def __decodeEndOfSeries__(self, message):
+        """
+        save the incomplete chunk of the series
+        """
+        with self._lock:
+            encoder, self._encoder = self._encoder, None
+        if encoder is None:
+            return
+        for path, arrays in encoder.flush():
+            self.submit(self.__save, path, arrays)
+        self._chunks[encoder.prefix] = encoder.chunks
+        if encoder.frames:
+            print "[OK] %d images with %.1f pixels per image in %d chunks %s_sparse_*.npz" \
+                  %(encoder.frames, float(encoder.pixels) / encoder.frames, encoder.chunks, encoder.prefix)
+
+    def __save(self, path, arrays):
+        save(path, arrays)
+        self.countWritten(os.path.getsize(path))
+        if self._verbose:
+            print "[OK] wrote %s" %path
+        return path
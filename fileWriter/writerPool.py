@@ -0,0 +1,137 @@
+"""
+Shared, bounded thread pool for the file writers.
+Write jobs are submitted to a fixed number of writer threads through a
+bounded queue. Submitting blocks if the queue is full or if a writer
+exceeds its number of jobs in flight, which caps the memory held by
+queued frames and applies back pressure to the receiver when the storage
+slows down.
+"""
+
+import threading
+import Queue
+import time
+import metrics
+
+__author__ = "SasG"
+__date__ = "17/05/17"
+__version__ = "0.0.1"
+__reviewer__ = ""
+
+#number of writer threads
+NTHREADS = 8
+
+#maximum number of queued write jobs
+QUEUESIZE = 256
+
+#maximum number of write jobs in flight (queued or running) per writer
+WRITERLIMIT = 64
+
+class WriterPool():
+    """
+    fixed size thread pool with bounded submission queue and per writer limits
+    """
+    def __init__(self, nThreads=NTHREADS, queueSize=QUEUESIZE):
+        self._queue = Queue.Queue(maxsize=queueSize)
+        self._limits = {} # writer name: BoundedSemaphore
+        self._lock = threading.Lock()
+        self.counters = {"submitted": 0, # submitted write jobs
+                         "completed": 0, # finished write jobs
+                         "errors": 0, # write jobs raising an exception
+                         "waitTime": 0., # accumulated queue wait time in s
+                         "maxWaitTime": 0., # maximum queue wait time in s
+                         }
+
+        self._wait = metrics.registry.histogram("eiger_stream_writer_queue_wait_seconds", "wait time of write jobs in the writer pool queue")
+        metrics.registry.gauge("eiger_stream_writer_queue_depth", "write jobs in the writer pool queue", fn=self._queue.qsize)
+        for key in ("submitted", "completed", "errors"):
+            metrics.registry.gauge("eiger_stream_writer_pool", "writer pool counters",
+                                   fn=lambda key=key: self.counters[key], stat=key)
+
+        for i in range(nThreads):
+            thread = threading.Thread(target=self._work, name="writer%d" %i)
+            thread.daemon = True
+            thread.start()
+
+    def setLimit(self, name, limit=WRITERLIMIT):
+        """
+        set maximum number of write jobs in flight for writer name
+        """
+        with self._lock:
+            if name not in self._limits:
+                self._limits[name] = threading.BoundedSemaphore(limit)
+
+    def submit(self, name, target, *args):
+        """
+        queue write job target(*args) of writer name. Blocks if the queue is full
+        or writer name has reached its limit.
+        """
+        limit = self._limits.get(name)
+        if limit:
+            limit.acquire()
+        self._queue.put((name, time.time(), target, args))
+        with self._lock:
+            self.counters["submitted"] += 1
+
+    def join(self):
+        """
+        block until all queued write jobs are done
+        """
+        self._queue.join()
+
+    def statistics(self):
+        """
+        return dict of pool counters including the current queue depth
+        """
+        with self._lock:
+            stats = dict(self.counters)
+        stats["queueDepth"] = self._queue.qsize()
+        return stats
+
+    def report(self):
+        """
+        return pool statistics as string
+        """
+        stats = self.statistics()
+        done = max(1, stats["completed"] + stats["errors"])
+        return "[INFO] writer pool: submitted: %d, completed: %d, errors: %d, queue depth: %d, mean wait: %.3f s, max wait: %.3f s" \
+               %(stats["submitted"], stats["completed"], stats["errors"], stats["queueDepth"], stats["waitTime"]/done, stats["maxWaitTime"])
+
+    def _work(self):
+        """
+        writer thread: execute queued write jobs
+        """
+        while True:
+            name, submitted, target, args = self._queue.get()
+            start = time.time()
+            wait = start - submitted
+            self._wait.observe(wait)
+            with self._lock:
+                self.counters["waitTime"] += wait
+                self.counters["maxWaitTime"] = max(self.counters["maxWaitTime"], wait)
+            try:
+                target(*args)
+                metrics.registry.histogram("eiger_stream_write_seconds", "write latency", writer=name).observe(time.time() - start)
+                key = "completed"
+            except Exception as e:
+                print "[ERR] %s write job: %s" %(name, str(e))
+                key = "errors"
+            finally:
+                limit = self._limits.get(name)
+                if limit:
+                    limit.release()
+                self._queue.task_done()
+            with self._lock:
+                self.counters[key] += 1
+
+_pool = None
+_poolLock = threading.Lock()
+
+def getWriterPool():
+    """
+    return the writer pool shared by all file writers, create it on first use
+    """
+    global _pool
+    with _poolLock:
+        if _pool is None:
+            _pool = WriterPool()
+    return _pool
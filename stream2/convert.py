@@ -0,0 +1,238 @@
+"""
+Convert recorded stream2 messages offline with a pool of processes.
+The .cbor files dumped by receiver.py -f cbor and the segment logs written
+with -f segment are grouped by series and converted to one .tif file per
+image and threshold channel (-f tif) or to .h5 master and data files
+(-f hdf5, see hdfWriter.py).
+
+The images of a series are converted in jobs of --chunkSize images, each
+hdf5 job writes its own data files, which are linked in the master file when
+all jobs of the series are done. Finished jobs are recorded in the journal
+file .convert_journal in the output directory. Converting again after a crash
+or interrupt skips the finished jobs, unless --restart is given. The journal
+starts with the source, format and chunk size of the conversion, converting
+with other arguments into the same directory is refused unless --restart is
+given.
+
+example: python3 convert.py /path/to/dump -d /path/to/output -f hdf5 -n 16
+"""
+
+import argparse
+import glob, logging, mmap, multiprocessing, os, re, sys, time
+
+logging.basicConfig(format='%(asctime)s | %(levelname)s: %(message)s', level=logging.INFO)
+
+import decoding
+import hdfWriter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fileWriter.segmentLog import SegmentReader
+
+# images per tif conversion job
+CHUNKSIZE = 100
+
+# file name of the journal of finished jobs in the output directory
+JOURNAL = '.convert_journal'
+
+# s between progress messages
+PROGRESSINTERVAL = 1.
+
+def readFile(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def scan(source):
+    """
+    return list of (header, reference) of the recorded messages in source,
+    header: routing fields of the message, see decoding.peekMessage
+    reference: passed to load in the conversion processes
+    """
+    if not os.path.isdir(source):
+        return scanSegmentLog(re.sub(r'_\d{6}\.(seg|idx)$', '', source))
+    messages = []
+    for basename in sorted({re.sub(r'_\d{6}\.idx$', '', path) for path in glob.glob(os.path.join(source, '*_[0-9]*.idx'))}):
+        messages += scanSegmentLog(basename)
+    for path in sorted(glob.glob(os.path.join(source, '*.cbor'))):
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            view = memoryview(m)
+            header = decoding.peekMessage(view) # reads only the pages of the header fields
+            view.release()
+        messages.append((header, ('cbor', path)))
+    return messages
+
+def scanSegmentLog(basename):
+    log = SegmentReader(basename)
+    messages = []
+    for series, frame, location in log.locations():
+        parts = log.readAt(location)
+        messages.append((decoding.peekMessage(parts[0]), ('seg', basename, location)))
+    log.close()
+    return messages
+
+def createJobs(messages, chunkSize):
+    """
+    group messages by series and return dict of series: {"start": reference, "end": reference, "jobs": jobs}
+    job: (key, start reference, image references, restore)
+    restore: the start message only restores the series of the writer
+    """
+    series = {}
+    for header, reference in messages:
+        key = (header["series_unique_id"], header["series_number"])
+        entry = series.setdefault(key, {"start": None, "end": None, "images": {}})
+        if header["type"] == "image":
+            entry["images"][header["image_number"]] = reference
+        elif header["type"] in ("start", "end"):
+            if entry[header["type"]] is not None:
+                logging.warning(f'several {header["type"]} messages of series {key[1]}, using the last one')
+            entry[header["type"]] = reference
+
+    for key, entry in series.items():
+        if entry["start"] is None:
+            logging.warning(f'no start message of series {key[1]}')
+        images = entry.pop("images")
+        frames = sorted(images)
+        chunks = [frames[i:i+chunkSize] for i in range(0, len(frames), chunkSize)] or [[]]
+        entry["jobs"] = [(f'series {key[0]} {key[1]} images {chunk[0] if chunk else ""}-{chunk[-1] if chunk else ""}',
+                          entry["start"], [images[frame] for frame in chunk], i > 0)
+                         for i, chunk in enumerate(chunks)]
+    return series
+
+_readers = {} # basename: SegmentReader of the conversion process
+
+def load(reference):
+    """
+    return the decoded recorded message
+    """
+    if reference[0] == 'seg':
+        basename, location = reference[1:]
+        if basename not in _readers:
+            _readers[basename] = SegmentReader(basename)
+        return decoding.loads(_readers[basename].readAt(location)[0])
+    return decoding.loads(readFile(reference[1]))
+
+def convert(job, outDir, format, chunk):
+    """
+    conversion process: convert the messages of job
+    chunk: number of the job in its series, id of the hdf5 data files
+    return: (key, number of images, error message or None)
+    """
+    key, start, images, restore = job
+    try:
+        if format == 'hdf5':
+            sink = hdfWriter.Cbor2Hdf(outDir, id=chunk, imagesPerFile=max(len(images), 1))
+            if start is not None:
+                message = load(start)
+                sink.startSeries(message)
+                if not restore:
+                    sink.writeMaster(message)
+            for reference in images:
+                sink.image(load(reference))
+            sink.closeData()
+        else:
+            if start is not None and not restore:
+                decoding.convertMessage(load(start), outDir)
+            for reference in images:
+                decoding.convertMessage(load(reference), outDir)
+    except Exception as e:
+        return key, len(images), str(e)
+    return key, len(images), None
+
+def work(args):
+    return convert(*args)
+
+def link(outDir, start):
+    """
+    link all data files of the series of the start message in its master file
+    """
+    sink = hdfWriter.Cbor2Hdf(outDir)
+    message = load(start)
+    files = [os.path.basename(path) for path in glob.glob(sink.prefix(message) + '_data_*.h5')]
+    sink.linkData(message, files)
+
+def journalHeader(args, chunkSize):
+    """
+    return the first line of the journal identifying the conversion
+    """
+    return f'# source {os.path.abspath(args.source)} format {args.format} chunkSize {chunkSize}'
+
+def readJournal(path, header):
+    """
+    return set of the finished jobs in journal path, None if the journal belongs to another conversion
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        lines = [line.strip() for line in f if line.strip()]
+    if not lines:
+        return set()
+    if lines[0] != header:
+        return None
+    return set(lines[1:])
+
+def main(args):
+    os.makedirs(args.dir, exist_ok=True)
+    chunkSize = args.chunkSize or (hdfWriter.IMAGESPERFILE if args.format == 'hdf5' else CHUNKSIZE)
+    series = createJobs(scan(args.source), chunkSize)
+
+    journal = os.path.join(args.dir, JOURNAL)
+    header = journalHeader(args, chunkSize)
+    if args.restart and os.path.exists(journal):
+        os.remove(journal)
+    done = readJournal(journal, header)
+    if done is None:
+        logging.error(f'{journal} belongs to another conversion, convert with --restart or into another directory')
+        return 1
+    todo = [(job, args.dir, args.format, i) for entry in series.values()
+            for i, job in enumerate(entry["jobs"]) if job[0] not in done]
+    nImages = sum(len(item[0][2]) for item in todo)
+    nJobs = sum(len(entry["jobs"]) for entry in series.values())
+    logging.info(f'{len(series)} series, {nJobs} jobs, {nJobs - len(todo)} done, '
+                 f'converting {nImages} images with {args.nProcesses} processes')
+
+    failed = []
+    converted = 0
+    start = last = time.time()
+    with multiprocessing.Pool(args.nProcesses) as pool, open(journal, 'a') as f:
+        if not done and not os.path.getsize(journal):
+            f.write(header + '\n')
+        for i, (key, n, error) in enumerate(pool.imap_unordered(work, todo)):
+            if error:
+                logging.error(f'{key}: {error}')
+                failed.append(key)
+            else:
+                f.write(key + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            converted += n
+            now = time.time()
+            if now - last > PROGRESSINTERVAL or i == len(todo) - 1:
+                last = now
+                rate = converted / max(now - start, 1e-9)
+                logging.info(f'{i + 1}/{len(todo)} jobs, {converted}/{nImages} images, {rate:.1f} images/s, '
+                             f'{(nImages - converted) / max(rate, 1e-9):.0f} s remaining')
+
+    if args.format == 'hdf5':
+        for entry in series.values():
+            if entry["start"] is not None and not any(job[0] in failed for job in entry["jobs"]):
+                link(args.dir, entry["start"])
+
+    if failed:
+        logging.error(f'{len(failed)} jobs failed, convert again to retry them')
+        return 1
+    logging.info(f'converted {converted} images in {time.time() - start:.1f} s')
+    return 0
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description = "convert recorded stream2 messages")
+
+    parser.add_argument("source", help="segment log /path/to/basename or directory with .cbor files or segment logs")
+    parser.add_argument("-d", "--dir", help="/path/to/output/dir", default = ".")
+    parser.add_argument("-f", "--format", help="tif: one .tif per image and channel, hdf5: .h5 master and data files", choices=["tif", "hdf5"], default="tif")
+    parser.add_argument("-n", "--nProcesses", help="number of conversion processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("-c", "--chunkSize", help=f"images per job, default {CHUNKSIZE} (tif) or hdfWriter.IMAGESPERFILE (hdf5)", type=int, default=0)
+    parser.add_argument("--restart", help="ignore the journal and convert all messages", action="store_true")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    sys.exit(main(parseArgs()))
@@ -1,7 +1,7 @@
 import cbor2
 from dectris.compression import decompress
 import numpy as np
-import logging, os
+import logging, os, struct
 import tifffile
 
 logging.basicConfig()
@@ -21,7 +21,7 @@ def decode_multi_dim_array(tag, column_major):
 
 
 def decode_typed_array(tag, dtype):
-    if not isinstance(tag.value, bytes):
+    if not isinstance(tag.value, (bytes, memoryview)):
         raise cbor2.CBORDecodeValueError("expected byte string in typed array")
     return np.frombuffer(tag.value, dtype=dtype)
 
@@ -60,6 +60,179 @@ def tag_hook(decoder, tag):
     return tag_decoder(tag) if tag_decoder else tag
 
 
+# top level fields needed to route and name a message
+ROUTING_KEYS = ("type", "series_number", "series_unique_id", "image_number")
+
+_FLOATS = {25: struct.Struct(">e"), 26: struct.Struct(">f"), 27: struct.Struct(">d")}
+_SIMPLE = {20: False, 21: True, 22: None, 23: None}
+_BREAK = 0xff
+
+
+def _head(buf, pos):
+    """
+    return major type, additional info, argument and position after the head of the item at pos
+    """
+    initial = buf[pos]
+    major, info = initial >> 5, initial & 0x1f
+    pos += 1
+    if info < 24:
+        return major, info, info, pos
+    if info == 31: # indefinite length
+        return major, info, None, pos
+    if major == 7 and info in _FLOATS: # float argument is decoded by the caller
+        return major, info, None, pos
+    n = 1 << (info - 24)
+    return major, info, int.from_bytes(buf[pos:pos + n], "big"), pos + n
+
+
+def _skip(buf, pos):
+    """
+    return position after the cbor item at pos without decoding it
+    """
+    major, info, arg, pos = _head(buf, pos)
+    if major in (2, 3): # byte and text strings
+        if arg is None:
+            while buf[pos] != _BREAK:
+                pos = _skip(buf, pos)
+            return pos + 1
+        return pos + arg
+    if major in (4, 5): # arrays and maps
+        if arg is None:
+            while buf[pos] != _BREAK:
+                pos = _skip(buf, pos)
+            return pos + 1
+        for i in range(arg * (2 if major == 5 else 1)):
+            pos = _skip(buf, pos)
+        return pos
+    if major == 6: # tag
+        return _skip(buf, pos)
+    if major == 7 and info in _FLOATS:
+        return pos + _FLOATS[info].size
+    return pos
+
+
+def _scalar(buf, pos):
+    """
+    return value of the integer, text or simple item at pos and position after it,
+    other items are skipped and returned as None
+    """
+    major, info, arg, end = _head(buf, pos)
+    if major == 0:
+        return arg, end
+    if major == 1:
+        return -1 - arg, end
+    if major == 3:
+        if arg is None: # indefinite length text of definite length chunks
+            chunks = []
+            while buf[end] != _BREAK:
+                chunk, end = _scalar(buf, end)
+                chunks.append(chunk)
+            return "".join(chunks), end + 1
+        return bytes(buf[end:end + arg]).decode(), end + arg
+    if major == 7:
+        if info in _FLOATS:
+            return _FLOATS[info].unpack_from(buf, end)[0], end + _FLOATS[info].size
+        return _SIMPLE.get(info), end
+    return None, _skip(buf, pos)
+
+
+def peekMessage(frame, keys=ROUTING_KEYS):
+    """
+    return dict of the top level fields keys of the cbor message in frame
+    without decoding the other fields, e.g. the image data
+    """
+    buf = memoryview(frame).cast("B")
+    major, info, arg, pos = _head(buf, 0)
+    while major == 6: # e.g. self described cbor tag 55799
+        major, info, arg, pos = _head(buf, pos)
+    if major != 5:
+        raise ValueError("cbor message is not a map")
+
+    fields = {}
+    i = 0
+    while (buf[pos] != _BREAK if arg is None else i < arg) and len(fields) < len(keys):
+        key, pos = _scalar(buf, pos)
+        if key in keys:
+            fields[key], pos = _scalar(buf, pos)
+        else:
+            pos = _skip(buf, pos)
+        i += 1
+    return fields
+
+
+def loads(frame):
+    """
+    decode the cbor message in frame, e.g. the buffer of a zmq.Frame, without copying
+    its contents: byte strings are returned as memoryview slices of frame and typed
+    arrays as numpy arrays referencing frame, which must be kept alive while they are used.
+    Other semantic tags are decoded by cbor2.
+    """
+    buf = memoryview(frame).cast("B")
+    return _decode(buf, 0)[0]
+
+
+def _decode(buf, pos):
+    """
+    return value of the cbor item at pos and position after it
+    """
+    start = pos
+    major, info, arg, pos = _head(buf, pos)
+    if major == 0:
+        return arg, pos
+    if major == 1:
+        return -1 - arg, pos
+    if major in (2, 3): # byte and text strings
+        if arg is None: # indefinite length strings are joined
+            chunks = []
+            while buf[pos] != _BREAK:
+                chunk, pos = _decode(buf, pos)
+                chunks.append(chunk)
+            return (b"" if major == 2 else "").join(chunks), pos + 1
+        if major == 2:
+            return buf[pos:pos + arg], pos + arg
+        return bytes(buf[pos:pos + arg]).decode(), pos + arg
+    if major == 4:
+        items = []
+        while (buf[pos] != _BREAK) if arg is None else (len(items) < arg):
+            item, pos = _decode(buf, pos)
+            items.append(item)
+        return items, pos + (arg is None)
+    if major == 5:
+        items = {}
+        i = 0
+        while (buf[pos] != _BREAK) if arg is None else (i < arg):
+            key, pos = _decode(buf, pos)
+            if isinstance(key, memoryview):
+                key = bytes(key)
+            items[key], pos = _decode(buf, pos)
+            i += 1
+        return items, pos + (arg is None)
+    if major == 6:
+        if arg == 55799: # self described cbor
+            return _decode(buf, pos)
+        if arg not in tag_decoders: # other semantic tags, e.g. date/time, are decoded by cbor2
+            end = _skip(buf, start)
+            return cbor2.loads(buf[start:end], tag_hook=tag_hook), end
+        value, pos = _decode(buf, pos)
+        return tag_hook(None, cbor2.CBORTag(arg, value)), pos
+    if info in _FLOATS:
+        return _FLOATS[info].unpack_from(buf, pos)[0], pos + _FLOATS[info].size
+    return _SIMPLE.get(info), pos
+
+
+DTYPES = {"uint8": np.dtype("u1"), "uint16le": np.dtype("<u2"), "uint32le": np.dtype("<u4")}
+
+
+def _decompress(encoded, compression, dtype):
+    if compression == "bslz4":
+        return decompress(encoded, "bslz4-h5", elem_size=dtype.itemsize)
+    elif compression == "lz4":
+        return decompress(encoded, "lz4-h5")
+    elif compression == "none":
+        return encoded
+    raise NotImplementedError(f"unknown compression: {compression}")
+
+
 def decompress_channel_data(channel):
     data = channel["data"]
 
@@ -67,28 +240,75 @@ def decompress_channel_data(channel):
         return data
 
     dimensions, encoded = data
+    dtype = DTYPES[channel["data_type"]]
+    decompressed = _decompress(encoded, channel["compression"], dtype)
+    return np.frombuffer(decompressed, dtype=dtype).reshape(dimensions)
 
-    compression = channel["compression"]
-    data_type = channel["data_type"]
-    dtype = {"uint8": "u1", "uint16le": "<u2", "uint32le": "<u4"}[data_type]
-    elem_size = {"uint8": 1, "uint16le": 2, "uint32le": 4}[data_type]
 
-    if compression == "bslz4":
-        decompressed = decompress(encoded, "bslz4-h5", elem_size=elem_size)
-    elif compression == "lz4":
-        decompressed = decompress(encoded, "lz4-h5")
-    elif compression == "none":
-        decompressed = encoded
-    else:
-        raise NotImplementedError(f"unknown compression: {compression}")
+class ChannelStack():
+    """
+    decompress the threshold channels of image messages into one preallocated
+    (n_thresholds, y, x) array, which is reused for the following images.
+    The layout is taken from the start message (channels, image_size_y,
+    image_size_x, image_dtype) or else from the first image message and the
+    array is reallocated only if the layout changes.
+    """
+    def __init__(self, start=None):
+        self.array = None
+        self.thresholds = [] # thresholds of the channel in each row of the array
+        if start is not None:
+            self.configure(start)
 
-    return np.frombuffer(decompressed, dtype=dtype).reshape(dimensions)
+    def configure(self, start):
+        """
+        allocate the array for the channel layout of the start message
+        """
+        channels = start.get("channels")
+        if channels and "image_size_x" in start and "image_dtype" in start:
+            self.allocate((len(channels), start["image_size_y"], start["image_size_x"]), DTYPES[start["image_dtype"]])
+
+    def allocate(self, shape, dtype):
+        if self.array is None or self.array.shape != shape or self.array.dtype != dtype:
+            self.array = np.empty(shape, dtype)
+
+    def decode(self, message):
+        """
+        decompress all channels of the image message into the array.
+        return: (n_thresholds, y, x) array, overwritten by the next decode
+        """
+        channels = message["channels"]
+        first = channels[0]["data"]
+        shape = tuple(first.shape if isinstance(first, np.ndarray) else first[0])
+        self.allocate((len(channels),) + shape, DTYPES[channels[0]["data_type"]])
+        self.thresholds = []
+        for i, channel in enumerate(channels):
+            data = channel["data"]
+            if isinstance(data, (np.ndarray, np.generic)):
+                self.array[i] = data
+            else:
+                dtype = DTYPES[channel["data_type"]]
+                decompressed = _decompress(data[1], channel["compression"], dtype)
+                if len(decompressed) != self.array[i].nbytes or dtype != self.array.dtype:
+                    raise ValueError(f'channel {channel["thresholds"]} does not match the {self.array.dtype} {self.array.shape[1:]} layout')
+                self.array[i] = np.frombuffer(decompressed, dtype=dtype).reshape(shape)
+            self.thresholds.append(tuple(channel["thresholds"]))
+        return self.array
 
 
-def processMessage(frame, outDir):
-    message = cbor2.loads(frame, tag_hook=tag_hook)
+def processMessage(frame, outDir, sink=None):
+    """
+    dump the cbor message in frame to outDir or pass it decoded to sink.
+    frame: bytes-like, e.g. the memoryview zmq.Frame.buffer
+    """
+    if sink is not None: # e.g. hdfWriter.Cbor2Hdf
+        sink.write(loads(frame))
+        return
+    
+    # route by the header fields, only the start message is fully decoded
+    message = peekMessage(frame)
     
     if message["type"] == "start":
+        message = loads(frame)
         log.info(f'**** start series {message["series_number"]}')
         for key, value in message.items():
             print(key, value)
@@ -110,12 +330,21 @@ def processMessage(frame, outDir):
         #for channel in message["channels"]:
         #    channel["data"] = decompress_channel_data(channel)
 
+# channel stack reused by convertMessage
+_stack = ChannelStack()
+
 def processFile(fname, outDir):
     with open(fname, 'rb') as f:
-        message = cbor2.loads(f.read(), tag_hook=tag_hook)
+        message = loads(f.read())
     
     os.makedirs(outDir, exist_ok=True)
-    
+    convertMessage(message, outDir)
+
+def convertMessage(message, outDir):
+    """
+    write the decoded message to outDir: the start message as metadata .txt,
+    the channels of an image message as .tif
+    """
     if message["type"] == "start":
         log.info(f'proocess series {message["series_unique_id"]} {message["series_number"]}')
         fname = f'{message["series_unique_id"]}_s{message["series_number"]:06d}_metaData.txt'
@@ -131,9 +360,9 @@ def processFile(fname, outDir):
         fname = f'{message["series_unique_id"]}_{message["series_number"]:06d}_{message["image_number"]:06d}.tif'
         path = os.path.join(outDir, fname)
     
-        for channel in message["channels"]:
-            channel["data"] = decompress_channel_data(channel)  
-            thresholds = "_".join(map(str, channel["thresholds"]))  
+        stack = _stack.decode(message)
+        for thresholds, data in zip(_stack.thresholds, stack):
+            thresholds = "_".join(map(str, thresholds))  
             imgName = path.replace('.tif', f'_{thresholds}.tif')
-            tifffile.imsave(imgName, channel["data"])       
+            tifffile.imsave(imgName, data)       
             log.info(f'wrote {imgName}')     
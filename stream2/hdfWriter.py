@@ -0,0 +1,239 @@
+"""
+Aggregate stream2 cbor messages into chunked HDF5 data files.
+Each receiver process appends the image messages it receives to its own
+data files with one dataset per threshold channel, e.g.
+/entry/data/threshold_1, and an /entry/data/image_number dataset, as
+images are distributed round robin over the receiver processes.
+The coordinator of the receiver processes writes the start message to the
+master file and links the data files reported by all processes at the end
+of the series: every dataset of data file <prefix>_data_XX_NNNNNN.h5 is
+linked as /entry/data/<dataset>/data_XX_NNNNNN, e.g.
+/entry/data/threshold_1/data_00_000001 is an image dataset like
+/entry/data/data_000001 of the EIGER master files.
+
+lz4 and bslz4 compressed channel data are written as direct chunks into
+datasets declared with the HDF5 lz4 (32004) or bitshuffle (32008) filter,
+so the data is not decompressed. Reading the files requires the filter
+plugins, e.g. import hdf5plugin.
+
+The datasets of a data file are allocated for number_of_images of the start
+message, at most imagesPerFile images, grown by doubling if more images
+arrive and shrunk to the written images when the file is closed. Chunks are
+allocated on write, so unused slots take no space in the file.
+"""
+
+import h5py
+import numpy as np
+import logging, os
+
+log = logging.getLogger(__name__)
+
+#specify number of images per data file
+IMAGESPERFILE = 1000
+
+#HDF5 filter id and options of the stream2 channel compression
+FILTERS = {"lz4": (32004, (0,)), "bslz4": (32008, (0, 2))}
+
+DTYPES = {"uint8": "<u1", "uint16le": "<u2", "uint32le": "<u4"}
+
+# start message keys written to the NeXus tree, other keys are written to detectorSpecific
+PARAMTABLE = {
+    "incident_wavelength": ("entry/instrument/beam/incident_wavelength", "angstrom"),
+    "incident_energy": ("entry/instrument/beam/incident_energy", "eV"),
+    "beam_center_x": ("entry/instrument/detector/beam_center_x", "pixel"),
+    "beam_center_y": ("entry/instrument/detector/beam_center_y", "pixel"),
+    "count_time": ("entry/instrument/detector/count_time", "s"),
+    "frame_time": ("entry/instrument/detector/frame_time", "s"),
+    "detector_distance": ("entry/instrument/detector/detector_distance", "m"),
+    "pixel_size_x": ("entry/instrument/detector/x_pixel_size", "m"),
+    "pixel_size_y": ("entry/instrument/detector/y_pixel_size", "m"),
+    "sensor_thickness": ("entry/instrument/detector/sensor_thickness", "m"),
+    "sensor_material": ("entry/instrument/detector/sensor_material", None),
+    "detector_description": ("entry/instrument/detector/description", None),
+    "detector_serial_number": ("entry/instrument/detector/detector_number", None),
+    "saturation_value": ("entry/instrument/detector/saturation_value", None),
+}
+
+NXCLASSES = {"entry": "NXentry", "entry/data": "NXdata", "entry/instrument": "NXinstrument",
+             "entry/instrument/beam": "NXbeam", "entry/instrument/detector": "NXdetector",
+             "entry/instrument/detector/detectorSpecific": "NXcollection"}
+
+def channelName(channel):
+    return "threshold_" + "_".join(map(str, channel["thresholds"]))
+
+class Cbor2Hdf():
+    """
+    stream2 sink writing the decoded cbor messages of one receiver process to .h5
+    """
+    def __init__(self, outDir, id=0, imagesPerFile=IMAGESPERFILE):
+        self.outDir = outDir
+        self.id = id
+        self.imagesPerFile = imagesPerFile
+        self.series = None # (series_unique_id, series_number) of the open data file
+        self.start = None # start message of the series
+        self.dataFile = None
+        self.files = {} # series: data files of the series
+        self.nImages = 0 # number of images in the open data file
+        self.capacity = 0 # allocated images of the datasets in the open data file
+
+    def prefix(self, message):
+        return os.path.join(self.outDir, f'{message["series_unique_id"]}_{message["series_number"]:06d}')
+
+    def write(self, message):
+        """
+        process decoded stream2 message
+        """
+        if message["type"] == "start":
+            self.startSeries(message)
+        elif message["type"] == "image":
+            self.image(message)
+        elif message["type"] == "end":
+            self.end(message)
+
+    def startSeries(self, message):
+        """
+        keep the start message and start the series
+        """
+        self.closeData()
+        self.series = (message["series_unique_id"], message["series_number"])
+        self.start = message
+        self.files[self.series] = []
+
+    def writeMaster(self, message):
+        """
+        write the start message to the master file
+        """
+        path = self.prefix(message) + "_master.h5"
+        with h5py.File(path, "w") as f:
+            for group, nxclass in NXCLASSES.items():
+                f.require_group(group).attrs["NX_class"] = nxclass
+            for key, value in message.items():
+                if key == "type":
+                    continue
+                entry, units = PARAMTABLE.get(key, ("entry/instrument/detector/detectorSpecific/" + key, None))
+                self.writeParam(f, entry, value)
+                if units and entry in f:
+                    f[entry].attrs["units"] = units
+        log.info(f'wrote {path}')
+
+    def writeParam(self, f, entry, value):
+        if isinstance(value, dict): # e.g. flatfield or pixel_mask per channel
+            for key, item in value.items():
+                self.writeParam(f, f'{entry}/{key}', item)
+            return
+        if isinstance(value, (list, tuple)) and len(value) == 2 and isinstance(value[1], (bytes, memoryview, np.ndarray)):
+            value = np.asarray(value[1]) # undecoded multi dim array
+        try:
+            f.create_dataset(entry, data=value)
+        except (TypeError, ValueError) as e:
+            log.warning(f'could not write {entry}: {e}')
+
+    def image(self, message):
+        """
+        append the channels of the image message to the open data file
+        """
+        series = (message["series_unique_id"], message["series_number"])
+        if series != self.series: # series without start message
+            self.closeData()
+            self.series = series
+            self.start = None
+        if self.dataFile is None:
+            self.openData(message)
+
+        i = self.nImages
+        if i == self.capacity:
+            self.resize(min(2 * self.capacity, self.imagesPerFile))
+        self.dataFile["entry/data/image_number"][i] = message["image_number"]
+        for channel in message["channels"]:
+            dset = self.dataFile["entry/data"].get(channelName(channel))
+            if dset is None:
+                dset = self.createChannel(channel)
+            data = channel["data"]
+            if isinstance(data, (np.ndarray, np.generic)):
+                dset[i] = data
+            elif channel["compression"] in FILTERS:
+                dset.id.write_direct_chunk((i, 0, 0), data[1])
+            else:
+                dset[i] = np.frombuffer(data[1], DTYPES[channel["data_type"]]).reshape(data[0])
+        self.nImages += 1
+
+        if self.nImages == self.imagesPerFile:
+            self.closeData()
+
+    def openData(self, message):
+        self.nImages = 0
+        self.capacity = self.imagesPerFile
+        if self.start and self.start.get("number_of_images"):
+            self.capacity = max(1, min(self.capacity, self.start["number_of_images"]))
+        files = self.files.setdefault(self.series, [])
+        path = f'{self.prefix(message)}_data_{self.id:02d}_{len(files) + 1:06d}.h5'
+        files.append(os.path.basename(path))
+        self.dataFile = h5py.File(path, "w")
+        self.dataFile.require_group("entry").attrs["NX_class"] = "NXentry"
+        self.dataFile.require_group("entry/data").attrs["NX_class"] = "NXdata"
+        self.dataFile.create_dataset("entry/data/image_number", shape=(self.capacity,), maxshape=(None,), dtype="<u8")
+
+    def createChannel(self, channel):
+        """
+        create the resizable, chunked image dataset of channel in the open data file
+        """
+        data = channel["data"]
+        shape = tuple(data.shape if isinstance(data, (np.ndarray, np.generic)) else data[0])
+        kwargs = {}
+        if channel["compression"] in FILTERS:
+            kwargs["compression"], kwargs["compression_opts"] = FILTERS[channel["compression"]]
+            kwargs["allow_unknown_filter"] = True
+        return self.dataFile.create_dataset("entry/data/" + channelName(channel), shape=(self.capacity,) + shape,
+                                            maxshape=(None,) + shape, chunks=(1,) + shape,
+                                            dtype=DTYPES[channel["data_type"]], **kwargs)
+
+    def resize(self, n):
+        """
+        resize the datasets of the open data file to n images
+        """
+        for dset in self.dataFile["entry/data"].values():
+            if dset.shape[0] != n:
+                dset.resize(n, axis=0)
+        self.capacity = n
+
+    def closeData(self):
+        if self.dataFile is not None:
+            self.resize(self.nImages)
+            log.info(f'wrote {self.dataFile.filename} with {self.nImages} images')
+            self.dataFile.close()
+            self.dataFile = None
+
+    def end(self, message):
+        """
+        close the data file of the series
+        return: list of data files of the series written by this sink
+        """
+        series = (message["series_unique_id"], message["series_number"])
+        if series == self.series:
+            self.closeData()
+            self.series = None
+        return self.files.pop(series, [])
+
+    def linkData(self, message, files):
+        """
+        link the data files of the series in the master file
+        """
+        master = self.prefix(message) + "_master.h5"
+        if not os.path.exists(master):
+            log.warning(f'no master file {master} for end of series {message["series_number"]}')
+            return
+        with h5py.File(master, "a") as f:
+            for name in sorted(files):
+                link = "data_" + name[:-len(".h5")].split("_data_")[-1]
+                path = os.path.join(self.outDir, name)
+                if not os.path.exists(path):
+                    log.warning(f'no data file {path} to link in {master}')
+                    continue
+                with h5py.File(path, "r") as data:
+                    datasets = list(data["entry/data"])
+                for dataset in datasets:
+                    group = f.require_group("entry/data/" + dataset)
+                    group.attrs["NX_class"] = "NXdata"
+                    if link not in group:
+                        group[link] = h5py.ExternalLink(name, "/entry/data/" + dataset)
+        log.info(f'linked {len(files)} data files in {master}')
@@ -1,35 +1,259 @@
 import zmq
-import logging, os, argparse
+import logging, os, sys, argparse, json, tempfile
 import multiprocessing
 import time
+import collections
 
 logging.basicConfig(format='%(asctime)s | %(levelname)s: %(message)s', level=logging.INFO)
 
 import decoding
+import hdfWriter
 
-def receiver(id, ip, port, outDir):
-    verbosity=100
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fileWriter import metrics
+from fileWriter.segmentLog import SegmentWriter
+
+# s to hold images of a series whose start message was not seen yet
+HOLDTIMEOUT = 1.
+# s without data after the end of the series until a receiver reports the series
+DRAINTIME = 0.1
+# number of ended series whose late images are recognized
+ENDED = 16
+
+def controlAddress():
+    """
+    return ipc address of the coordinator
+    """
+    return 'ipc://' + os.path.join(tempfile.gettempdir(), f'eigerStream2_{os.getpid()}')
+
+class Receiver():
+    """
+    receiver process: writes the image messages it pulls from the detector.
+    start and end messages are forwarded to the coordinator, which sends
+    them to all receivers, so every receiver knows the series metadata and
+    reports its data files at the end of the series. Every receiver has its
+    own DEALER connection to the coordinator and connects to the detector only
+    after the coordinator welcomed it, when all receivers are connected.
+    """
+    def __init__(self, id, ip, port, outDir, metricsPort=0, format='cbor', control=None, metricsHost='127.0.0.1'):
+        self.id = id
+        self.outDir = outDir
+        self.sink = hdfWriter.Cbor2Hdf(outDir, id) if format == 'hdf5' else None
+        self.log = SegmentWriter(os.path.join(outDir, f'stream2_{id:02d}')) if format == 'segment' else None
+        self.series = None # (series_unique_id, series_number) of the open series, None after its end
+        self.ended = collections.deque(maxlen=ENDED) # recently ended series
+        self.nImages = {} # series: images written by this receiver
+        self.held = [] # (receive time, series, frame) of images waiting for the start message
+        
+        self.received = metrics.registry.counter("eiger_stream_received_messages_total", "received ZMQ messages")
+        self.receivedBytes = metrics.registry.counter("eiger_stream_received_bytes_total", "received ZMQ bytes")
+        self.processed = metrics.registry.counter("eiger_stream_processed_messages_total", "processed stream2 messages")
+        self.errors = metrics.registry.counter("eiger_stream_errors_total", "stream2 messages failing to process")
+        self.late = metrics.registry.counter("eiger_stream_late_images_total", "images received after the end of their series, dropped in hdf5 format")
+        self.processTime = metrics.registry.histogram("eiger_stream_process_seconds", "stream2 message processing latency")
+        metrics.registry.gauge("eiger_stream_held_images", "images waiting for the start message", fn=lambda: len(self.held))
+        if metricsPort:
+            metrics.serve(metricsPort + id, metricsHost) # one endpoint per receiver process
+        
+        context = zmq.Context()
+        self.coordinator = context.socket(zmq.DEALER)
+        self.coordinator.connect(control)
+        self.coordinator.send_multipart([b'hello', str(id).encode()])
+        self.coordinator.recv_multipart() # welcome
+        self.data = context.socket(zmq.PULL)
+        self.data.connect(f'tcp://{ip}:{port}')
+        logging.info(f'receiver {id} connected to tcp://{ip}:{port}')
     
-    context = zmq.Context()
-    receiver = context.socket(zmq.PULL)
-    receiver.connect(f'tcp://{ip}:{port}')
-    logging.info(f'receiver {id} connected to tcp://{ip}:{port}, printing after {verbosity} received frames')
+    def run(self):
+        poller = zmq.Poller()
+        poller.register(self.data, zmq.POLLIN)
+        poller.register(self.coordinator, zmq.POLLIN)
+        while True:
+            try:
+                events = dict(poller.poll(10))
+                if self.coordinator in events:
+                    kind, frame = self.coordinator.recv_multipart(copy = False)
+                    if kind.bytes == b'start':
+                        self.startSeries(frame)
+                    else:
+                        self.endSeries(frame)
+                elif self.data in events: # the data socket may have been drained by endSeries
+                    self.receive(self.data.recv(copy = False))
+                if self.held and time.time() - self.held[0][0] > HOLDTIMEOUT:
+                    logging.warning(f'receiver {self.id}: no start message, writing {len(self.held)} held images')
+                    self.release()
+            
+            except Exception as e:
+                self.errors.inc()
+                logging.error(e)
     
-    msgs = 0
-    while True:
+    def receive(self, frame):
+        """
+        process a message from the detector
+        return: series of an image message, None for start and end messages
+        """
+        self.received.inc()
+        self.receivedBytes.inc(len(frame))
+        header = decoding.peekMessage(frame.buffer)
+        if header["type"] == "image":
+            series = (header["series_unique_id"], header["series_number"])
+            if series == self.series:
+                self.write(frame, series)
+            elif series in self.ended:
+                self.late.inc()
+                if self.sink: # its data files are already reported and linked
+                    logging.warning(f'receiver {self.id}: dropped image {header["image_number"]} received after the end of series {series[1]}')
+                else:
+                    logging.warning(f'receiver {self.id}: image {header["image_number"]} received after the end of series {series[1]}')
+                    self.write(frame)
+            else:
+                self.held.append((time.time(), series, frame))
+            return series
+        # start or end
+        self.coordinator.send_multipart([b'message', frame], copy = False)
+        self.processed.inc()
+        return None
+    
+    def write(self, frame, series=None):
+        """
+        write an image message, counted for the report of series if given
+        """
         try:
-            if receiver.poll(10):
-                frames = receiver.recv(copy = False)
-                msgs += 1
-                if msgs%verbosity == 0:
-                    logging.info(f'worker {id} received {msgs} frames')
-                
-                decoding.processMessage(frames, outDir)
+            with self.processTime.time():
+                if self.log:
+                    header = decoding.peekMessage(frame.buffer)
+                    self.log.append(header["series_number"], header["image_number"], [frame])
+                else:
+                    decoding.processMessage(frame.buffer, self.outDir, self.sink)
+            if series is not None:
+                self.nImages[series] = self.nImages.get(series, 0) + 1
+            self.processed.inc()
+        except Exception:
+            self.errors.inc()
+            raise
+    
+    def release(self, series=None):
+        """
+        write held images of series, all held images if series is None
+        """
+        held = self.held
+        self.held = []
+        for item in held:
+            if series is None or item[1] == series:
+                self.write(item[2], item[1])
+            else:
+                self.held.append(item)
+    
+    def startSeries(self, frame):
+        message = decoding.loads(frame.buffer)
+        self.series = (message["series_unique_id"], message["series_number"])
+        if self.sink:
+            self.sink.startSeries(message)
+        self.release(self.series)
+    
+    def endSeries(self, frame):
+        """
+        write the remaining images of the series and report them to the coordinator.
+        The data socket is drained until it is idle for DRAINTIME, or until a
+        message of the next series arrives: the detector sends the messages of
+        every connection in order, so all images of the series are received.
+        """
+        message = decoding.loads(frame.buffer)
+        series = (message["series_unique_id"], message["series_number"])
+        while self.data.poll(DRAINTIME * 1000): # images still queued or in flight
+            if self.receive(self.data.recv(copy = False)) != series:
+                break
+        self.release(series)
+        self.ended.append(series)
+        if self.series == series:
+            self.series = None
+        files = self.sink.end(message) if self.sink else []
+        if self.log:
+            self.log.flush()
+        report = {"id": self.id, "series_unique_id": series[0], "series_number": series[1],
+                  "images": self.nImages.pop(series, 0), "files": files}
+        self.coordinator.send_multipart([b'report', json.dumps(report).encode()])
+
+    def close(self):
+        if self.log:
+            self.log.close()
+
+def receiver(id, ip, port, outDir, metricsPort=0, format='cbor', control=None, metricsHost='127.0.0.1'):
+    receiver = Receiver(id, ip, port, outDir, metricsPort, format, control, metricsHost)
+    try:
+        receiver.run()
+    finally:
+        receiver.close()
+
+def coordinator(nProcesses, outDir, format, control):
+    """
+    send start and end messages to all receivers, write the series metadata
+    and collect the reports of the receivers at the end of the series.
+    The receivers are welcomed when all of them are connected, unlike a
+    PUB socket the ROUTER socket then reaches every receiver.
+    """
+    context = zmq.Context()
+    receivers = context.socket(zmq.ROUTER)
+    receivers.bind(control)
+    identities = [] # ROUTER identities of the connected receivers
+    sink = hdfWriter.Cbor2Hdf(outDir) if format == 'hdf5' else None
+    log = SegmentWriter(os.path.join(outDir, 'stream2_control')) if format == 'segment' else None
+    reports = {} # series: list of receiver reports
+    ends = {} # series: end message
+    expected = {} # series: number of images of the start message
+    
+    try:
+        while True:
+            try:
+                identity, kind, payload = receivers.recv_multipart(copy = False)
+                if kind.bytes == b'hello':
+                    identities.append(identity.bytes)
+                    if len(identities) == nProcesses:
+                        for receiver in identities:
+                            receivers.send_multipart([receiver, b'welcome'])
+                        logging.info(f'{nProcesses} receivers connected')
+                elif kind.bytes == b'message':
+                    message = decoding.loads(payload.buffer)
+                    series = (message["series_unique_id"], message["series_number"])
+                    if message["type"] == "start":
+                        expected[series] = message.get("number_of_images")
+                        if sink:
+                            sink.writeMaster(message)
+                        elif log:
+                            log.append(series[1], None, [payload])
+                        else:
+                            decoding.processMessage(payload.buffer, outDir)
+                    else:
+                        ends[series] = message
+                        if sink:
+                            logging.info(f'end of series {series[1]}') # data files are linked with the reports
+                        elif log:
+                            log.append(series[1], None, [payload])
+                            log.flush()
+                        else:
+                            decoding.processMessage(payload.buffer, outDir)
+                    for receiver in identities:
+                        receivers.send_multipart([receiver, message["type"].encode(), payload], copy = False)
+            
+                else:
+                    report = json.loads(payload.bytes)
+                    series = (report["series_unique_id"], report["series_number"])
+                    reports.setdefault(series, []).append(report)
+                    if len(reports[series]) == nProcesses:
+                        end = ends.pop(series)
+                        files = [name for report in reports[series] for name in report["files"]]
+                        nImages = sum(report["images"] for report in reports.pop(series))
+                        if sink:
+                            sink.linkData(end, files)
+                        logging.info(f'series {series[1]} done: {nImages} of {expected.pop(series, None) or "?"} images, {len(files)} data files')
         
-        except Exception as e:
-            logging.error(e)
+            except Exception as e:
+                logging.error(e)
+    finally:
+        if log:
+            log.close()
             
-             
+
 def statusPoller(ip):
     import EigerClient
     c = EigerClient.EigerClient(ip)
@@ -64,6 +288,10 @@ def parseArgs():
     parser.add_argument("-p", "--port", help="EIGER2 stream2 port", type=int, default=31001)
     parser.add_argument("-n", "--nProcesses", help="number of receiver processes", type=int, default=4)
     parser.add_argument("-d", "--dir", help="/path/to/output/dir ", default = ".")
+    parser.add_argument("-f", "--format", help="cbor: dump every message to a .cbor file, hdf5: aggregate images into .h5 data files, segment: append messages to segment logs", choices=["cbor", "hdf5", "segment"], default="cbor")
+    parser.add_argument("-m", "--metricsPort", help="serve metrics of receiver process n on http://METRICSHOST:METRICSPORT+n/metrics", type=int, default=0)
+    parser.add_argument("--metricsHost", help="interface of the metrics endpoints, 0.0.0.0 for all interfaces", type=str, default="127.0.0.1")
+    parser.add_argument("--noStatus", help="do not configure and poll the detector, e.g. for a replayed stream", action="store_true")
 
     args = parser.parse_args()
 
@@ -74,7 +302,11 @@ if __name__ == "__main__":
     
     os.makedirs(args.dir, exist_ok=True)
     
-    multiprocessing.Process(target=statusPoller, args=(args.ip, )).start()
+    if not args.noStatus:
+        multiprocessing.Process(target=statusPoller, args=(args.ip, )).start()
    
+    control = controlAddress()
     for id in range(args.nProcesses):
-        multiprocessing.Process(target=receiver, args=(id, args.ip, args.port, args.dir)).start()
+        multiprocessing.Process(target=receiver, args=(id, args.ip, args.port, args.dir, args.metricsPort, args.format, control, args.metricsHost)).start()
+    
+    coordinator(args.nProcesses, args.dir, args.format, control)
@@ -0,0 +1,533 @@
+"""
+Threaded receive/decode pipeline for the EIGER ZMQ stream.
+
+A receiver thread does nothing but pull multipart messages from the
+ZMQ socket into a bounded ingest queue. A pool of worker threads takes
+the messages from the queue and passes them to the FileWriter.
+Image messages are decoded concurrently, header and end of series
+messages are processed in stream order: they wait until all preceding
+messages are done and block subsequent images until they are finished.
+
+Writers which rely on sequential frames (e.g. Stream2Hdf) should be used
+with a single worker. Writers storing the messages without decoding
+(FileWriter.undecoded, e.g. Stream2Seg) are called directly by the receiver
+thread, so they see the messages in stream order.
+
+ProcessPipeline scales the image decoding across several processes.
+A coordinator thread pulls the messages from the detector and distributes
+the image messages to a pool of decode processes. The decoded (uncompressed)
+image messages are returned to the coordinator which passes them to the
+FileWriter together with the header and end of series messages in stream
+order, so one FileWriter (e.g. Stream2Hdf) still sees complete series.
+The decoded images of a series are passed in frame order through a bounded
+reorder buffer, which skips missing frames after a timeout. A decode process
+which dies is replaced, the images lost with it are given up after LOSTTIMEOUT.
+"""
+
+__author__ = "SasG"
+__date__ = "17/05/17"
+__version__ = "0.0.1"
+__reviewer__ = ""
+
+import threading
+import Queue
+import time
+import multiprocessing
+import tempfile
+import bisect
+import json
+import os
+import zmq
+from fileWriter import metrics
+from fileWriter import fileWriter
+from fileWriter import reorder
+from fileWriter.reorder import ReorderBuffer
+
+# s between checks of the decode processes
+PROCESSCHECK = 1.
+# s to wait for the images outstanding when a decode process died before they are given up
+LOSTTIMEOUT = 1.
+
+def registerMetrics(pipeline):
+    """
+    expose the pipeline statistics as gauges eiger_stream_pipeline{stat=...}
+    """
+    for key in pipeline.statistics():
+        metrics.registry.gauge("eiger_stream_pipeline", "pipeline counters and queue depths",
+                               fn=lambda key=key: pipeline.statistics()[key], stat=key)
+
+class SequenceGate():
+    """
+    keep header and end of series messages in stream order while
+    image messages are processed concurrently
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = set() # sequence numbers of queued or running messages
+        self._controls = [] # sequence numbers of pending header/end messages
+
+    def register(self, seq, control):
+        """
+        register message in stream order, called by the receiver thread
+        """
+        with self._cond:
+            self._pending.add(seq)
+            if control:
+                self._controls.append(seq)
+
+    def enter(self, seq, control):
+        """
+        block until message seq may be processed
+        """
+        with self._cond:
+            if control: # wait for all preceding messages
+                while min(self._pending) != seq:
+                    self._cond.wait()
+            else: # wait for preceding header/end messages
+                while self._controls and self._controls[0] < seq:
+                    self._cond.wait()
+
+    def leave(self, seq, control):
+        """
+        mark message seq as done
+        """
+        with self._cond:
+            self._pending.discard(seq)
+            if control:
+                self._controls.remove(seq)
+            self._cond.notify_all()
+
+class StreamPipeline():
+    """
+    receive thread feeding a bounded ingest queue and a pool of decode workers
+    """
+    def __init__(self, stream, fw, nWorkers=1, queueSize=1000, verbose=False):
+        """
+        create pipeline
+        args:
+            stream:     ZMQStream object
+            fw:         FileWriter object
+            nWorkers:   number of decode/write worker threads
+            queueSize:  maximum number of messages in the ingest queue
+            verbose:    verbosity
+        """
+        self._stream = stream
+        self._fw = fw
+        self._undecoded = getattr(fw, "undecoded", False) # writer stores messages without decoding
+        self._nWorkers = max(1, nWorkers)
+        self._verbose = verbose
+
+        self._queue = Queue.Queue(maxsize=queueSize)
+        self._gate = SequenceGate()
+        self._running = False
+        self._threads = []
+
+        self._lock = threading.Lock()
+        self.counters = {"received": 0, # messages pulled from the socket
+                         "processed": 0, # messages handed to the FileWriter
+                         "errors": 0, # messages raising an exception
+                         "queueFull": 0, # receiver stalls due to a full ingest queue
+                         "maxQueueDepth": 0, # high water mark of the ingest queue
+                         "busyWorkers": 0, # workers currently processing a message
+                         }
+
+    def start(self):
+        """
+        start receiver and worker threads
+        """
+        self._running = True
+        self._threads = [threading.Thread(target=self._receive, name="receiver")]
+        for i in range(self._nWorkers):
+            self._threads.append(threading.Thread(target=self._work, name="worker%d" %i))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        registerMetrics(self)
+        print "[OK] started pipeline with %d worker(s), queue size %d" %(self._nWorkers, self._queue.maxsize)
+        return self
+
+    def stop(self, timeout=10):
+        """
+        stop receiving, process remaining queued messages and join threads
+        """
+        self._running = False
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        return self.statistics()
+
+    def statistics(self):
+        """
+        return dict of pipeline counters including the current queue depth
+        """
+        with self._lock:
+            stats = dict(self.counters)
+        stats["queueDepth"] = self._queue.qsize()
+        return stats
+
+    def report(self):
+        """
+        return pipeline statistics as string
+        """
+        return "[INFO] pipeline: " + ", ".join("%s: %d" %(k, v) for k, v in sorted(self.statistics().items()))
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.counters[key] += n
+
+    def _receive(self):
+        """
+        receiver thread: poll socket and put messages into the ingest queue
+        """
+        seq = 0
+        while self._running:
+            frames = self._stream.receive()
+            if not frames:
+                continue
+            if self._undecoded: # store in stream order on the receiver thread
+                self._count("received")
+                self._process(seq, frames)
+                seq += 1
+                continue
+            control = "dimage-" not in frames[0].bytes
+            self._gate.register(seq, control)
+            item = (seq, control, frames)
+            try:
+                self._queue.put_nowait(item)
+            except Queue.Full:
+                self._count("queueFull")
+                self._queue.put(item) # back pressure to the ZMQ socket
+            seq += 1
+            with self._lock:
+                self.counters["received"] += 1
+                self.counters["maxQueueDepth"] = max(self.counters["maxQueueDepth"], self._queue.qsize())
+
+    def _work(self):
+        """
+        worker thread: take messages from the ingest queue and pass them to the FileWriter
+        """
+        while self._running or not self._queue.empty():
+            try:
+                seq, control, frames = self._queue.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            self._gate.enter(seq, control)
+            self._count("busyWorkers")
+            try:
+                self._process(seq, frames)
+            finally:
+                self._count("busyWorkers", -1)
+                self._gate.leave(seq, control)
+
+    def _process(self, seq, frames):
+        """
+        pass message to the FileWriter
+        """
+        try:
+            self._fw.decodeFrames(frames)
+            self._count("processed")
+        except Exception as e:
+            self._count("errors")
+            print "[ERR] processing message %d: %s" %(seq, str(e))
+
+def decodeWorker(id, inAddress, outAddress):
+    """
+    decode process: receive image messages from the coordinator, decompress the
+    image data and return the message with uncompressed data. The decode time
+    is returned with the message, the metrics of this process are not served.
+    args:
+        id:         worker id
+        inAddress:  zmq address of the coordinator dispatch socket
+        outAddress: zmq address of the coordinator collect socket
+    """
+    fw = fileWriter.FileWriter("noname", ".", "dummy")
+
+    context = zmq.Context()
+    receiver = context.socket(zmq.PULL)
+    receiver.connect(inAddress)
+    sender = context.socket(zmq.PUSH)
+    sender.connect(outAddress)
+
+    while True:
+        frames = receiver.recv_multipart(copy=False)
+        seq, frames = frames[0], frames[1:]
+        try:
+            message = fileWriter.StreamMessage(frames)
+            start = time.time()
+            data = fw.readImage(message)
+            seconds = time.time() - start
+            info = dict(message.info)
+            info["encoding"] = "<" # data is returned uncompressed
+            info["size"] = data.nbytes
+            info["decoded"] = True # decode time and bytes are counted by the coordinator
+            reply = [seq, repr(seconds), frames[0], json.dumps(info), data] + frames[3:]
+        except Exception as e:
+            print "[ERR] decode process %d: %s" %(id, str(e))
+            reply = [seq] # return sequence number only to release the slot
+        sender.send_multipart(reply, copy=False)
+
+class ProcessPipeline():
+    """
+    coordinator thread distributing image decoding to a pool of processes
+    """
+    def __init__(self, stream, fw, nProcesses=4, queueSize=1000, verbose=False):
+        """
+        create pipeline
+        args:
+            stream:     ZMQStream object
+            fw:         FileWriter object
+            nProcesses: number of decode processes
+            queueSize:  maximum number of messages queued for the decode processes
+            verbose:    verbosity
+        """
+        self._stream = stream
+        self._fw = fw
+        self._undecoded = getattr(fw, "undecoded", False) # writer stores messages without decoding
+        self._nProcesses = max(1, nProcesses)
+        self._queueSize = queueSize
+        self._verbose = verbose
+
+        tmp = os.path.join(tempfile.gettempdir(), "eigerStream-%d" %os.getpid())
+        self._inAddress = "ipc://%s-dispatch" %tmp
+        self._outAddress = "ipc://%s-collect" %tmp
+
+        self._running = False
+        self._thread = None
+        self._processes = []
+
+        self._seq = 0 # stream sequence number
+        self._outstanding = set() # sequence numbers of images in the decode processes
+        self._held = [] # (seq, control, frames) waiting for preceding images, sorted by seq
+        self._lost = [] # (deadline, seqs) of images outstanding when a decode process died
+        self._reorder = ReorderBuffer(window=max(reorder.WINDOW, 2 * self._nProcesses)) # decoded images by frame number
+
+        self._lock = threading.Lock()
+        self.counters = {"received": 0, # messages pulled from the socket
+                         "dispatched": 0, # images sent to the decode processes
+                         "decoded": 0, # images returned by the decode processes
+                         "processed": 0, # messages handed to the FileWriter
+                         "errors": 0, # messages failing to decode or write
+                         "queueFull": 0, # receiver stalls due to busy decode processes
+                         "restarts": 0, # decode processes replaced after they died
+                         }
+
+    def start(self):
+        """
+        start decode processes and coordinator thread
+        """
+        self._running = True
+        self._processes = [self._startProcess(id) for id in range(self._nProcesses)]
+
+        self._thread = threading.Thread(target=self._coordinate, name="coordinator")
+        self._thread.daemon = True
+        self._thread.start()
+        registerMetrics(self)
+        print "[OK] started pipeline with %d decode process(es)" %self._nProcesses
+        return self
+
+    def stop(self, timeout=10):
+        """
+        stop coordinator and decode processes
+        """
+        self._running = False
+        if self._thread:
+            self._thread.join(timeout)
+        for process in self._processes:
+            process.terminate()
+        self._processes = []
+        return self.statistics()
+
+    def _startProcess(self, id):
+        process = multiprocessing.Process(target=decodeWorker, args=(id, self._inAddress, self._outAddress))
+        process.daemon = True
+        process.start()
+        return process
+
+    def statistics(self):
+        """
+        return dict of pipeline counters including the number of messages in flight
+        """
+        with self._lock:
+            stats = dict(self.counters)
+            stats["outstanding"] = len(self._outstanding)
+            stats["held"] = len(self._held)
+            stats["reorder"] = len(self._reorder)
+            stats["gaps"] = self._reorder.counters["gaps"]
+            stats["late"] = self._reorder.counters["late"]
+        return stats
+
+    def report(self):
+        """
+        return pipeline statistics as string
+        """
+        return "[INFO] pipeline: " + ", ".join("%s: %d" %(k, v) for k, v in sorted(self.statistics().items()))
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.counters[key] += n
+
+    def _coordinate(self):
+        """
+        coordinator thread: dispatch image messages, collect decoded images and
+        pass all messages in stream order to the FileWriter
+        """
+        context = zmq.Context.instance()
+        dispatcher = context.socket(zmq.PUSH)
+        dispatcher.set_hwm(self._queueSize)
+        dispatcher.bind(self._inAddress)
+        collector = context.socket(zmq.PULL)
+        collector.bind(self._outAddress)
+
+        poller = zmq.Poller()
+        poller.register(collector, zmq.POLLIN)
+        poller.register(self._stream._receiver, zmq.POLLIN)
+        pending = None # image message not yet accepted by the decode processes
+        check = time.time() + PROCESSCHECK
+
+        while self._running:
+            events = dict(poller.poll(100))
+            if collector in events:
+                while collector.poll(0):
+                    self._collect(collector.recv_multipart(copy=False))
+            self._release(self._reorder.poll()) # skip missing frames on timeout
+            if time.time() >= check:
+                self._checkProcesses()
+                check = time.time() + PROCESSCHECK
+
+            if pending is None and self._stream._receiver in events:
+                frames = self._stream.receive(0)
+                self._count("received")
+                if self._undecoded: # store without decoding in stream order
+                    self._write(frames)
+                    continue
+                pending = self._dispatch(frames)
+                stalled = False
+
+            if pending is not None:
+                try:
+                    dispatcher.send_multipart(pending, copy=False, flags=zmq.NOBLOCK)
+                    self._count("dispatched")
+                    pending = None
+                    poller.register(dispatcher, 0)
+                    poller.register(self._stream._receiver, zmq.POLLIN)
+                except zmq.Again: # decode processes busy, stop reading from the detector until they accept the message
+                    if not stalled:
+                        self._count("queueFull")
+                        stalled = True
+                    poller.register(self._stream._receiver, 0)
+                    poller.register(dispatcher, zmq.POLLOUT)
+
+        dispatcher.close(linger=0)
+        collector.close(linger=0)
+
+    def _checkProcesses(self):
+        """
+        replace decode processes which died. The images outstanding at that time
+        which are not returned within LOSTTIMEOUT are given up as errors, so the
+        messages waiting for them are written.
+        """
+        now = time.time()
+        for id, process in enumerate(self._processes):
+            if process.is_alive():
+                continue
+            print "[ERR] decode process %d died with exit code %s, starting a new one" %(id, process.exitcode)
+            self._processes[id] = self._startProcess(id)
+            with self._lock:
+                self.counters["restarts"] += 1
+                self._lost.append((now + LOSTTIMEOUT, set(self._outstanding)))
+
+        while self._lost and self._lost[0][0] <= now:
+            seqs = self._lost.pop(0)[1]
+            with self._lock:
+                lost = seqs & self._outstanding
+                self._outstanding -= lost
+                self.counters["errors"] += len(lost)
+            if lost:
+                print "[ERR] gave up %d image(s) of a dead decode process" %len(lost)
+                self._flush()
+
+    def _dispatch(self, frames):
+        """
+        assign stream sequence number and return image message for the decode processes.
+        header and end of series messages are written directly or held
+        until all preceding images were returned.
+        """
+        with self._lock:
+            seq = self._seq
+            self._seq += 1
+            if "dimage-" in frames[0].bytes:
+                self._outstanding.add(seq)
+                return [str(seq)] + frames
+            if self._outstanding or self._held:
+                self._held.append((seq, True, frames))
+                return None
+        self._writeControl(frames)
+        return None
+
+    def _collect(self, reply):
+        """
+        handle decoded image message returned by a decode process
+        """
+        seq = int(reply[0].bytes)
+        frames = reply[2:]
+        self._count("decoded")
+        if frames:
+            fileWriter.DECODETIME.observe(float(reply[1].bytes))
+            fileWriter.DECODEDBYTES.inc(len(frames[2]))
+        with self._lock:
+            self._outstanding.discard(seq)
+            if not frames:
+                self.counters["errors"] += 1
+            elif self._held and self._held[0][0] < seq: # wait for preceding header/end
+                bisect.insort(self._held, (seq, False, frames))
+                frames = None
+        if frames:
+            self._writeImage(frames)
+        self._flush()
+
+    def _flush(self):
+        """
+        write held messages as soon as all preceding images were returned
+        """
+        while True:
+            with self._lock:
+                if not self._held:
+                    return
+                seq, control, frames = self._held[0]
+                if control and self._outstanding and min(self._outstanding) < seq:
+                    return
+                self._held.pop(0)
+            if control:
+                self._writeControl(frames)
+            else:
+                self._writeImage(frames)
+
+    def _writeControl(self, frames):
+        """
+        write header or end of series message after the images of the previous series
+        """
+        self._release(self._reorder.flush())
+        self._reorder.reset()
+        self._write(frames)
+
+    def _writeImage(self, frames):
+        """
+        write decoded images in frame order
+        """
+        frame = json.loads(frames[0].bytes)["frame"]
+        self._release(self._reorder.push(frame, frames))
+
+    def _release(self, messages):
+        for frames in messages:
+            self._write(frames)
+
+    def _write(self, frames):
+        """
+        pass message to the FileWriter
+        """
+        try:
+            self._fw.decodeFrames(frames)
+            self._count("processed")
+        except Exception as e:
+            self._count("errors")
+            print "[ERR] processing message: %s" %str(e)
@@ -0,0 +1,259 @@
+"""
+End-to-end throughput benchmark of the stream receivers.
+Replays the recorded stream1 (streamData) or stream2 (stream2data) session
+with server.py at a target image rate, drives EIGERStream.py with each file
+writer and stream2/receiver.py, and reports the sustained images/s, MB/s,
+CPU usage and peak RSS of the receiver process tree.
+
+A run starts when the first message is sent and ends when the receiver
+reports all messages processed and all write jobs done on its metrics
+endpoint (-m/--metricsPort).
+
+usage: benchmark.py [-h] [-w WRITERS [WRITERS ...]] [-s2] [-f {cbor,hdf5,segment}] [-r RATE]
+                    [-l LOOP] [-z PORT] [-m METRICSPORT] [--python2 PYTHON2]
+                    [--workers WORKERS] [-n NPROCESSES] [--passthrough]
+                    [-d DIR] [--csv CSV]
+
+example: python3 benchmark.py -w none h5 cbf -l 50 -r 200 --csv results.csv
+"""
+
+import argparse
+import logging
+import os, sys, time, signal, subprocess, tempfile, shutil, threading, csv
+import urllib.request
+import zmq
+
+import server
+
+logging.basicConfig(format='%(asctime)s | %(levelname)s: %(message)s', level=logging.INFO)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# stream1 writers: file extension passed to EIGERStream.py -f, "none" decodes without writing
+WRITERS = ["none", "raw", "bytes", "seg", "sparse", "tif", "cbf", "h5", "log"]
+
+TIMEOUT = 60 # s to wait for the receiver to finish after the last message was sent
+
+def scrape(ports):
+    """
+    return dict of metric samples "name{labels}": value summed over the endpoints on ports,
+    None if no endpoint is reachable
+    """
+    samples = None
+    for port in ports:
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=1) as response:
+                text = response.read().decode()
+        except OSError:
+            continue
+        samples = samples or {}
+        for line in text.splitlines():
+            if line and not line.startswith('#'):
+                key, value = line.rsplit(' ', 1)
+                samples[key] = samples.get(key, 0.) + float(value)
+    return samples
+
+def stream1Errors(samples):
+    return samples.get('eiger_stream_pipeline{stat="errors"}', 0) + samples.get('eiger_stream_writer_pool{stat="errors"}', 0)
+
+def stream2Errors(samples):
+    return samples.get('eiger_stream_errors_total', 0)
+
+def stream1Done(samples, sent):
+    pool = lambda stat: samples.get(f'eiger_stream_writer_pool{{stat="{stat}"}}', 0)
+    return samples.get('eiger_stream_pipeline{stat="processed"}', 0) >= sent["messages"] \
+        and pool("submitted") == pool("completed") + pool("errors")
+
+def stream2Done(samples, sent):
+    return samples.get('eiger_stream_processed_messages_total', 0) + samples.get('eiger_stream_errors_total', 0) \
+        + samples.get('eiger_stream_late_images_total', 0) >= sent["messages"]
+
+class ProcessMonitor(threading.Thread):
+    """
+    sample CPU time and RSS of a process and its children from /proc
+    """
+    def __init__(self, pid, interval=0.1):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.cpu = {} # pid: cpu time in s, kept for exited children
+        self.maxRss = 0 # peak RSS of the process tree in bytes
+        self._done = threading.Event()
+        self._tick = os.sysconf('SC_CLK_TCK')
+        self._page = os.sysconf('SC_PAGE_SIZE')
+
+    def tree(self):
+        parents = {}
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    with open(f'/proc/{entry}/stat') as f:
+                        fields = f.read().rsplit(')', 1)[1].split()
+                except OSError:
+                    continue
+                parents.setdefault(int(fields[1]), []).append(int(entry))
+        pids, i = [self.pid], 0
+        while i < len(pids):
+            pids.extend(parents.get(pids[i], []))
+            i += 1
+        return pids
+
+    def sample(self):
+        rss = 0
+        for pid in self.tree():
+            try:
+                with open(f'/proc/{pid}/stat') as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                with open(f'/proc/{pid}/statm') as f:
+                    rss += int(f.read().split()[1]) * self._page
+            except OSError:
+                continue
+            self.cpu[pid] = (int(fields[11]) + int(fields[12])) / self._tick # utime + stime
+        self.maxRss = max(self.maxRss, rss)
+
+    def cpuTime(self):
+        return sum(self.cpu.values())
+
+    def run(self):
+        while not self._done.is_set():
+            self.sample()
+            time.sleep(self.interval)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        self.sample()
+
+def run(name, command, metricsPorts, done, errors, session, args):
+    """
+    start receiver command, replay session to it and return the benchmark result dict
+    """
+    logfile = open(os.path.join(args.dir, f'{name}.log'), 'w')
+    receiver = subprocess.Popen(command, cwd=ROOT, stdout=logfile, stderr=subprocess.STDOUT, start_new_session=True)
+    context = zmq.Context()
+    socket = context.socket(zmq.PUSH)
+    socket.bind(f'tcp://127.0.0.1:{args.port}')
+    try:
+        t0 = time.time()
+        while scrape(metricsPorts) is None:
+            if receiver.poll() is not None or time.time() - t0 > TIMEOUT:
+                raise RuntimeError(f'{name}: receiver did not start, see {logfile.name}')
+            time.sleep(0.1)
+        time.sleep(1) # let all receiver sockets connect
+
+        monitor = ProcessMonitor(receiver.pid)
+        monitor.start()
+        cpu0 = monitor.cpuTime()
+        t0 = time.time()
+        sent = server.replay(socket, session, args.rate, args.loop, args.useStream2)
+        samples = scrape(metricsPorts) or {}
+        while not done(samples, sent):
+            if time.time() - t0 - sent["elapsed"] > TIMEOUT:
+                raise RuntimeError(f'{name}: receiver did not process all messages, see {logfile.name}')
+            time.sleep(0.05)
+            samples = scrape(metricsPorts) or {}
+        elapsed = time.time() - t0
+        monitor.stop()
+    finally:
+        socket.close(linger=0)
+        context.term()
+        stop(receiver)
+        logfile.close()
+
+    return {"receiver": name,
+            "images": sent["images"],
+            "seconds": round(elapsed, 3),
+            "images/s": round(sent["images"] / elapsed, 1),
+            "MB/s": round(sent["bytes"] / elapsed / 1e6, 2),
+            "CPU %": round(100 * (monitor.cpuTime() - cpu0) / elapsed, 1),
+            "RSS MB": round(monitor.maxRss / 1e6, 1),
+            "errors": int(errors(samples)),
+            }
+
+def stop(receiver):
+    """
+    interrupt the receiver process group, kill it if it does not exit
+    """
+    try:
+        os.killpg(receiver.pid, signal.SIGINT)
+        receiver.wait(10)
+    except subprocess.TimeoutExpired:
+        os.killpg(receiver.pid, signal.SIGKILL)
+        receiver.wait()
+    except ProcessLookupError:
+        pass
+
+def stream1Command(writer, args):
+    filename = os.path.join(args.dir, writer, 'bench' if writer == 'none' else f'bench.{writer}')
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    command = [args.python2, 'EIGERStream.py', '-i', '127.0.0.1', '-p', str(args.port), '-f', filename,
+               '-m', str(args.metricsPort), '-w', str(args.workers), '-n', str(args.nProcesses)]
+    if args.passthrough:
+        command.append('--passthrough')
+    return command
+
+def stream2Command(args):
+    outDir = os.path.join(args.dir, 'stream2')
+    os.makedirs(outDir, exist_ok=True)
+    return [sys.executable, os.path.join('stream2', 'receiver.py'), '-i', '127.0.0.1', '-p', str(args.port), '-d', outDir,
+            '-n', str(args.nProcesses or 4), '-m', str(args.metricsPort), '-f', args.format, '--noStatus']
+
+def report(results, args):
+    keys = list(results[0].keys())
+    widths = [max(len(key), *(len(str(result[key])) for result in results)) for key in keys]
+    print('  '.join(key.rjust(width) for key, width in zip(keys, widths)))
+    for result in results:
+        print('  '.join(str(result[key]).rjust(width) for key, width in zip(keys, widths)))
+
+    if args.csv:
+        exists = os.path.exists(args.csv)
+        with open(args.csv, 'a', newline='') as f:
+            writer = csv.DictWriter(f, ["time", "rate", "workers", "nProcesses"] + keys)
+            if not exists:
+                writer.writeheader()
+            for result in results:
+                writer.writerow(dict(result, time=time.strftime('%Y-%m-%d %H:%M:%S'), rate=args.rate,
+                                     workers=args.workers, nProcesses=args.nProcesses))
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='end-to-end throughput benchmark of the stream receivers')
+    parser.add_argument('-w', '--writers', nargs='+', choices=WRITERS, default=WRITERS, help="EIGERStream.py file writers to benchmark")
+    parser.add_argument('-s2', '--useStream2', action="store_true", help="benchmark stream2/receiver.py with the stream2 session instead")
+    parser.add_argument('-f', '--format', choices=["cbor", "hdf5", "segment"], default="cbor", help="stream2/receiver.py output format")
+    parser.add_argument('-r', '--rate', type=float, default=0, help="image messages per second, 0 sends as fast as possible")
+    parser.add_argument('-l', '--loop', type=int, default=10, help="number of replays of the recorded session")
+    parser.add_argument('-z', '--port', type=int, default=9999, help="zmq tcp port")
+    parser.add_argument('-m', '--metricsPort', type=int, default=9100, help="first metrics port of the receiver")
+    parser.add_argument('--python2', default='python2', help="python 2 interpreter running EIGERStream.py")
+    parser.add_argument('--workers', type=int, default=1, help="EIGERStream.py decode/write worker threads")
+    parser.add_argument('-n', '--nProcesses', type=int, default=0, help="EIGERStream.py decode processes, stream2/receiver.py processes (default 4)")
+    parser.add_argument('--passthrough', action="store_true", help="run EIGERStream.py .h5 in passthrough mode")
+    parser.add_argument('-d', '--dir', help="output directory, default is a temporary directory removed afterwards")
+    parser.add_argument('--csv', help="append results to csv file")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parseArgs()
+    keep = args.dir is not None
+    args.dir = os.path.abspath(args.dir or tempfile.mkdtemp(prefix='eigerBenchmark'))
+    os.makedirs(args.dir, exist_ok=True)
+
+    session = server.messages(args.useStream2)
+    results = []
+    try:
+        if args.useStream2:
+            ports = range(args.metricsPort, args.metricsPort + (args.nProcesses or 4))
+            results.append(run(f'stream2_{args.format}', stream2Command(args), ports, stream2Done, stream2Errors, session, args))
+        else:
+            for writer in args.writers:
+                logging.info(f'benchmark EIGERStream.py writer {writer}')
+                try:
+                    results.append(run(writer, stream1Command(writer, args), [args.metricsPort], stream1Done, stream1Errors, session, args))
+                except RuntimeError as e:
+                    logging.error(e)
+    finally:
+        if results:
+            report(results, args)
+        if not keep:
+            shutil.rmtree(args.dir, ignore_errors=True)
@@ -2,41 +2,146 @@ import argparse
 import zmq
 import logging
 import json, os, glob, time
-import argparse
 
 logging.basicConfig(format='%(asctime)s | %(levelname)s: %(message)s', level=logging.NOTSET)
 
-def server(port, useStream2=False):
+DATADIR = os.path.dirname(os.path.abspath(__file__))
+
+# number of frames of a stream1 global header message per header_detail
+HEADERFRAMES = {"all": 8, "basic": 2, "none": 1}
+
+# series number offset of each replay, so that receivers do not overwrite the files of the previous replay
+SERIESOFFSET = 1000
+
+def server(port, useStream2=False, rate=0, loop=1, ip='127.0.0.1'):
+    """
+    replay the recorded session to tcp://ip:port
+    rate: image messages per second, 0 sends as fast as possible
+    loop: number of replays of the session, 0 replays forever
+    return: dict of sent messages, images, bytes and elapsed time in s
+    """
     context = zmq.Context(4)
     zmq_socket = context.socket(zmq.PUSH)
-    zmq_socket.bind(f'tcp://127.0.0.1:{port}')
-    logging.info(f'serving to tcp://127.0.0.1:{port}')
+    zmq_socket.bind(f'tcp://{ip}:{port}')
+    logging.info(f'serving to tcp://{ip}:{port}')
+
+    try:
+        return replay(zmq_socket, messages(useStream2), rate, loop, useStream2)
+    finally:
+        zmq_socket.close(linger=-1) # deliver queued messages
+        context.term()
 
-    for i, message in enumerate(frameGetter(useStream2)):
-        logging.info(f'server sending message {i}')
-        zmq_socket.send_multipart(message)
+def replay(socket, session, rate=0, loop=1, stream2=False):
+    """
+    send the messages of session over socket, images paced to rate per second
+    """
+    stats = {"messages": 0, "images": 0, "bytes": 0, "elapsed": 0.}
+    t0 = time.time()
+    i = 0
+    while loop == 0 or i < loop:
+        for message, isImage in renumber(session, i * SERIESOFFSET, stream2):
+            if isImage:
+                if rate:
+                    delay = t0 + stats["images"] / rate - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                stats["images"] += 1
+            socket.send_multipart(message)
+            stats["messages"] += 1
+            stats["bytes"] += sum(len(frame) for frame in message)
+        i += 1
+        logging.info(f'replayed session {i}: {stats["messages"]} messages, {stats["images"]} images')
+    stats["elapsed"] = time.time() - t0
+    return stats
 
-def frameGetter(stream2=False):
+def messages(stream2=False):
+    """
+    return the recorded session as list of (list of frames, is image message)
+    """
     if stream2:
         dir = 'stream2data'
     else:
         dir = 'streamData'
-    files = sorted(glob.glob(os.path.join(dir,'*')))
+    files = sorted(glob.glob(os.path.join(DATADIR, dir, '*')))
+    frames = []
     for file in files:
-        with open(file, 'r') as f:
-            yield f.read()
-        
+        with open(file, 'rb') as f:
+            frames.append(f.read())
+
+    if stream2: # one cbor frame per message, the map starts with "type": "image"
+        return [([frame], b'\x64type\x65image' in frame[:16]) for frame in frames]
+    return groupFrames(frames)
+
+def renumber(session, offset, stream2=False):
+    """
+    return session with the series numbers increased by offset
+    """
+    if not offset:
+        return session
+    renumbered = []
+    for message, isImage in session:
+        if stream2:
+            import cbor2
+            content = dict(cbor2.loads(message[0]))
+            content["series_number"] += offset
+            message = [cbor2.dumps(cbor2.CBORTag(55799, content))]
+        else:
+            header = json.loads(message[0])
+            header["series"] += offset
+            message = [json.dumps(header).encode()] + message[1:]
+        renumbered.append((message, isImage))
+    return renumbered
+
+def groupFrames(frames):
+    """
+    group the dumped stream1 frames into multipart messages
+    """
+    session = []
+    i = 0
+    while i < len(frames):
+        header = parseHeader(frames[i])
+        if header is None:
+            raise ValueError(f'frame {i} is not the first frame of an EIGER stream message')
+        htype = header["htype"]
+        if htype.startswith("dheader-"):
+            n = HEADERFRAMES[header["header_detail"]]
+        elif htype.startswith("dimage-"):
+            n = 4
+        else:
+            n = 1
+        message = frames[i:i+n]
+        i += n
+        if i < len(frames) and parseHeader(frames[i]) is None: # appendix
+            message.append(frames[i])
+            i += 1
+        session.append((message, htype.startswith("dimage-")))
+    return session
+
+def parseHeader(frame):
+    """
+    return the header dict if frame starts a stream1 message, else None
+    """
+    try:
+        header = json.loads(frame)
+    except ValueError:
+        return None
+    if isinstance(header, dict) and header.get("htype", "").startswith(("dheader-", "dimage-", "dseries_end")):
+        return header
+    return None
 
 def parseArgs():
-    parser = argparse.ArgumentParser(description='ZMQ test server')
-    parser.add_argument('--port', '-z', type=int, default=99999, help="zmq tcp port")
+    parser = argparse.ArgumentParser(description='ZMQ test server replaying recorded EIGER stream sessions')
+    parser.add_argument('--ip', '-i', type=str, default='127.0.0.1', help="zmq tcp interface to bind")
+    parser.add_argument('--port', '-z', type=int, default=9999, help="zmq tcp port")
     parser.add_argument('--useStream2', '-s2', action="store_true", help="use stream2 cbor frames")
+    parser.add_argument('--rate', '-r', type=float, default=0, help="image messages per second, 0 sends as fast as possible")
+    parser.add_argument('--loop', '-l', type=int, default=1, help="number of replays of the session, 0 replays forever")
 
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = parseArgs()
-    t0 = time.time()
-    server(args.port, args.useStream2)
-    logging.info(f'finished in {time.time()-t0} seconds')
+    stats = server(args.port, args.useStream2, args.rate, args.loop, args.ip)
+    logging.info(f'sent {stats["messages"]} messages ({stats["images"]} images, {stats["bytes"]/1e6:.1f} MB) '
+                 f'in {stats["elapsed"]:.2f} seconds: {stats["images"]/max(stats["elapsed"], 1e-9):.1f} images/s')